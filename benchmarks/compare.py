@@ -0,0 +1,63 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Compare two result files written by run.py.
+
+    $ python benchmarks/compare.py before.json after.json
+
+Prints the best time of each benchmark in both files and the ratio
+after/before; ratios above the threshold (default 1.2) are flagged.
+"""
+import sys
+import json
+import optparse
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog BEFORE.json AFTER.json')
+    parser.add_option('-t', '--threshold', type='float', default=1.2,
+        help='flag benchmarks that got slower by more than this factor')
+    opts, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('two result files are required')
+
+    before, after = load(args[0]), load(args[1])
+    if before.get('library') != after.get('library'):
+        print 'warning: the results were taken on different library sizes'
+
+    names = sorted(set(before['results']) | set(after['results']))
+    width = max(len(name) for name in names)
+    regressions = 0
+    for name in names:
+        old = before['results'].get(name, { }).get('min')
+        new = after['results'].get(name, { }).get('min')
+        if old is None or new is None:
+            print '%-*s  %10s  %10s' % (width, name,
+                    '-' if old is None else '%.4f' % old,
+                    '-' if new is None else '%.4f' % new)
+            continue
+        ratio = new / old if old else float('inf')
+        flag = ''
+        if ratio > opts.threshold:
+            flag = '  SLOWER'
+            regressions += 1
+        print '%-*s  %10.4f  %10.4f  %6.2fx%s' % (width, name, old, new,
+                                                   ratio, flag)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Measure pipeline throughput with and without message batching.
+
+    $ PYTHONPATH=src python benchmarks/pipeline_batching.py -n 1000000
+
+Pushes n trivial messages through a three-stage parallel pipeline (a
+counter, a filter that drops every tenth message and a sink) once per
+batch size and reports messages per second as JSON, in the same
+layout as run.py.
+"""
+import sys
+import time
+import json
+import optparse
+
+from musicdir.util.pipeline import Pipeline, BUBBLE
+
+def produce(n):
+    for i in xrange(n):
+        yield i
+
+def keep():
+    msg = yield
+    while True:
+        if msg % 10 == 0:
+            msg = yield BUBBLE
+        else:
+            msg = yield msg
+
+def sink(counter):
+    while True:
+        yield
+        counter[0] += 1
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--messages', type='int', default=1000000)
+    parser.add_option('-b', '--batch-sizes', default='1,16,64,256',
+        help='comma separated batch sizes to try')
+    parser.add_option('-o', '--output', help='write results to this JSON file')
+    opts, args = parser.parse_args(args)
+
+    results = { }
+    for batch_size in [int(b) for b in opts.batch_sizes.split(',')]:
+        counter = [0]
+        start = time.time()
+        Pipeline([produce(opts.messages), keep(), sink(counter)]) \
+                .run_parallel(batch_size=batch_size)
+        elapsed = time.time() - start
+        assert counter[0] == opts.messages - (opts.messages + 9) // 10
+        results['batch_%i' % batch_size] = {
+            'min': elapsed,
+            'repeat': 1,
+            'messages_per_second': opts.messages / elapsed,
+        }
+        print >>sys.stderr, 'batch size %4i: %6.2fs, %9.0f msg/s' % (
+                batch_size, elapsed, opts.messages / elapsed)
+
+    out = json.dumps({'messages': opts.messages, 'results': results},
+                     indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print out
+
+if __name__ == '__main__':
+    main()
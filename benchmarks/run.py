@@ -0,0 +1,258 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Time the import, query and tag I/O hot paths on a synthetic library.
+
+    $ PYTHONPATH=src python benchmarks/run.py -o before.json
+    $ git checkout other-branch
+    $ PYTHONPATH=src python benchmarks/run.py -o after.json
+
+Each benchmark is run several times; the result file records the
+minimum, median and maximum wall time (in seconds) of every benchmark
+along with the library size and the commit it was run against, so two
+result files can be compared directly.
+"""
+import os
+import sys
+import time
+import json
+import shutil
+import optparse
+import tempfile
+import platform
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synth
+
+from musicdir.library import Library, File, Session
+from musicdir.mediafile import MediaFile
+from musicdir.util import sorted_walk
+from musicdir.ui import commands
+from musicdir import export
+from musicdir.catalog import Catalog
+
+# One query per get_filter syntax.
+QUERIES = [
+    ('all', [ ]),
+    ('like_artist', [u'artist:0001']),
+    ('like_release', [u'album:0001-0']),
+    ('like_title', [u'title:Track 0']),
+    ('like_path', [u'path:Track 01']),
+    ('range_year', [u'year:1990..1999']),
+    ('range_bitrate', [u'bitrate:<128000']),
+    ('range_size', [u'size:>1000000']),
+    ('exact_artist', [u'artist=Artist 0001']),
+    ('exact_release', [u'album=Release 0001-01']),
+    ('exact_title', [u'title=Track 01']),
+    ('exact_path', [u'path=missing']),
+    ('exact_year', [u'year=1999']),
+    # filled in with the first track's date (see date_values)
+    ('date_month', [u'date:%(month)s']),
+    ('date_day', [u'date:%(day)s']),
+    ('tag', [u'+rock']),
+    ('tags', [u'+rock', u'+jazz']),
+    ('free_text', [u'Track']),
+    ('free_text_and', [u'Artist', u'Track 01']),
+]
+
+def date_values(lib):
+    """The month and day of the first dated track, for the date
+    queries: synth.py's dates are random, and a month or day nobody
+    released anything on would only time an empty result.
+    """
+    from musicdir.library import Track
+    date = lib.session.query(Track.date).filter(Track.date != None) \
+            .order_by(Track.id).limit(1).scalar()
+    if date is None:
+        return { 'month': u'1999-06', 'day': u'1999-06-15' }
+    return { 'month': unicode(date.strftime('%Y-%m')),
+             'day': unicode(date.isoformat()) }
+
+def catalog_size(cat):
+    """Bytes held by the Catalog cat: its arrays, its packed strings,
+    and its name dictionaries with the names in them.
+    """
+    size = sum(sys.getsizeof(column) for column in cat.columns.values())
+    for strings in (cat.titles, cat.paths):
+        size += sys.getsizeof(strings.data) + sys.getsizeof(strings.offsets)
+    for names in (cat.artists, cat.releases):
+        size += sys.getsizeof(names)
+        size += sum(sys.getsizeof(id) + sys.getsizeof(name)
+                    for id, name in names.iteritems())
+    return size
+
+class _Quiet(object):
+    """Swallow everything commands print while they are timed."""
+    def write(self, data):
+        pass
+    def flush(self):
+        pass
+
+def timed(func, repeat):
+    """Run func repeat times, returning min/median/max wall times. A
+    benchmark that raises is reported with its error instead, so one
+    broken code path doesn't hide the numbers for the others.
+    """
+    times = [ ]
+    for i in range(repeat):
+        stdout = sys.stdout
+        sys.stdout = _Quiet()
+        try:
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        except Exception, exc:
+            return {'error': '%s: %s' % (type(exc).__name__, exc)}
+        finally:
+            sys.stdout = stdout
+    times.sort()
+    return {
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'max': times[-1],
+        'repeat': repeat,
+    }
+
+def open_library(dbpath):
+    """Open a fresh Library. The session is thread-local and shared,
+    so the previous one has to be discarded first.
+    """
+    Session.remove()
+    return Library('sqlite:///' + dbpath)
+
+def git_revision():
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        return out.strip() or None
+    except OSError:
+        return None
+
+def run(workdir, artists, releases, tracks, repeat):
+    results = { }
+    libdir = os.path.join(workdir, 'library')
+
+    # {{{ generate
+    start = time.time()
+    paths = synth.generate(libdir, artists, releases, tracks)
+    results['generate'] = {'min': time.time() - start, 'repeat': 1}
+    # }}}
+
+    # {{{ filesystem and tag I/O
+    results['sorted_walk'] = timed(lambda: list(sorted_walk(libdir)), repeat)
+
+    sample = paths[:200]
+    def read_tags():
+        for path in sample:
+            mf = MediaFile(path)
+            mf.title, mf.artist, mf.album, mf.length, mf.bitrate
+    results['mediafile_read'] = timed(read_tags, repeat)
+
+    def write_tags():
+        for path in sample:
+            mf = MediaFile(path)
+            mf.comments = u'benchmark'
+            mf.save()
+    results['mediafile_write'] = timed(write_tags, repeat)
+
+    def checksum():
+        for path in sample:
+            File(path=path).checksum()
+    results['file_checksum'] = timed(checksum, repeat)
+    # }}}
+
+    # {{{ import
+    dbpath = os.path.join(workdir, 'musicdir.db')
+    def import_all():
+        if os.path.exists(dbpath):
+            os.remove(dbpath)
+        lib = open_library(dbpath)
+        opts, args = commands.import_cmd.parser.parse_args([libdir])
+        commands.import_func(lib, None, opts, args)
+    # Importing is slow; never repeat it more than a few times.
+    results['import'] = timed(import_all, min(repeat, 3))
+    # }}}
+
+    # {{{ queries
+    lib = open_library(dbpath)
+    synth.tag(lib)
+    dates = date_values(lib)
+    for name, fields in QUERIES:
+        fields = [ field % dates if '%(' in field else field
+                   for field in fields ]
+        results['tracks_' + name] = timed(lambda: lib.tracks(fields), repeat)
+    results['releases_all'] = timed(lambda: lib.releases([ ]), repeat)
+    results['artists_all'] = timed(lambda: lib.artists([ ]), repeat)
+    results['stats'] = timed(lambda: commands.stats_func(lib, None, None, [ ]), repeat)
+    for format in ('csv', 'jsonl'):
+        results['export_' + format] = timed(
+                lambda: export.export(lib, _Quiet(), format), repeat)
+    # }}}
+
+    # {{{ catalog
+    cat = Catalog(lib)
+    results['catalog_load'] = timed(cat.load, repeat)
+    sizes = { 'catalog_bytes_per_track': catalog_size(cat) // max(len(cat), 1) }
+    # }}}
+
+    return results, sizes
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-a', '--artists', type='int', default=20)
+    parser.add_option('-r', '--releases', type='int', default=5,
+        help='releases per artist')
+    parser.add_option('-t', '--tracks', type='int', default=10,
+        help='tracks per release')
+    parser.add_option('-n', '--repeat', type='int', default=5,
+        help='number of runs per benchmark')
+    parser.add_option('-o', '--output', help='write results to this JSON file')
+    parser.add_option('-k', '--keep', action='store_true',
+        help='keep the generated library')
+    opts, args = parser.parse_args(args)
+
+    workdir = tempfile.mkdtemp(prefix='musicdir-bench-')
+    try:
+        results, sizes = run(workdir, opts.artists, opts.releases, opts.tracks,
+                      opts.repeat)
+    finally:
+        if opts.keep:
+            print >>sys.stderr, 'library kept in %s' % workdir
+        else:
+            shutil.rmtree(workdir)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'library': {
+            'artists': opts.artists,
+            'releases': opts.artists * opts.releases,
+            'tracks': opts.artists * opts.releases * opts.tracks,
+        },
+        'results': results,
+        'sizes': sizes,
+    }
+    out = json.dumps(report, indent=2, sort_keys=True)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print out
+
+if __name__ == '__main__':
+    main()
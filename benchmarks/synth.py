@@ -0,0 +1,216 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Generate a synthetic music library for benchmarking.
+
+The files are tiny but valid MP3, FLAC, Ogg Vorbis and MPEG-4 streams
+built from scratch (no encoder or network access needed), tagged
+through MediaFile exactly like a real library would be.
+
+    $ python benchmarks/synth.py /tmp/library 20 5 10
+"""
+import os
+import sys
+import struct
+import random
+import datetime
+
+from musicdir.mediafile import MediaFile
+from musicdir.util import mkdirall
+
+import mutagen.ogg
+
+FORMATS = ('mp3', 'flac', 'ogg', 'm4a')
+
+# A 1x1 transparent PNG used as embedded and folder art.
+PNG = '\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00' \
+      '\x01\x08\x06\x00\x00\x00\x1f\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc' \
+      '\xf8\x0f\x00\x00\x01\x01\x00\x05\x18\xd8N\x00\x00\x00\x00IEND\xaeB`\x82'
+
+# Tags given to the tracks by tag().
+TAGS = (u'rock', u'jazz', u'pop', u'ambient', u'live', u'favourite')
+
+# {{{ raw streams
+def mp3_stream(frames=40):
+    """MPEG-1 layer III, 128 kbps, 44.1 kHz frames of silence."""
+    header = '\xff\xfb\x90\x64'
+    return (header + '\x00' * (417 - len(header))) * frames
+
+def flac_stream(seconds=1):
+    """A FLAC stream consisting of nothing but a STREAMINFO block."""
+    rate, channels, bits = 44100, 2, 16
+    samples = rate * seconds
+    info = struct.pack('>HH', 4096, 4096) + '\x00' * 6
+    packed = (rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36) | samples
+    info += struct.pack('>Q', packed) + '\x00' * 16
+    # last-metadata-block flag, type 0 (STREAMINFO), 24 bit length
+    return 'fLaC' + struct.pack('>I', (1 << 31) | len(info)) + info
+
+def ogg_stream(seconds=1):
+    """An Ogg Vorbis stream: identification, comment and setup headers
+    followed by a single page carrying the final granule position.
+    """
+    rate = 44100
+    ident = '\x01vorbis' + struct.pack('<IBIiii', 0, 2, rate, 0, 128000, 0) \
+            + '\xb8\x01'
+    comment = '\x03vorbis' + struct.pack('<I', 0) + struct.pack('<I', 0) + '\x01'
+    setup = '\x05vorbis' + '\x00' * 16
+
+    pages = [ ]
+    first = mutagen.ogg.OggPage()
+    first.packets = [ident]
+    first.first = True
+    first.serial = 1
+    first.sequence = 0
+    pages.append(first)
+
+    headers = mutagen.ogg.OggPage()
+    headers.packets = [comment, setup]
+    headers.serial = 1
+    headers.sequence = 1
+    pages.append(headers)
+
+    audio = mutagen.ogg.OggPage()
+    audio.packets = ['\x00' * 32]
+    audio.serial = 1
+    audio.sequence = 2
+    audio.position = rate * seconds
+    audio.last = True
+    pages.append(audio)
+
+    return ''.join(page.write() for page in pages)
+
+def _atom(name, data):
+    return struct.pack('>I', len(data) + 8) + name + data
+
+def _full_atom(name, data, version=0, flags=0):
+    return _atom(name, struct.pack('>I', (version << 24) | flags) + data)
+
+def mp4_stream(seconds=1):
+    """An MPEG-4 audio file with a single AAC track and no samples."""
+    scale = 44100
+    duration = scale * seconds
+    ftyp = _atom('ftyp', 'M4A ' + struct.pack('>I', 0) + 'M4A mp42isom')
+    mvhd = _full_atom('mvhd', struct.pack('>IIII', 0, 0, scale, duration)
+            + struct.pack('>IH', 0x00010000, 0x0100) + '\x00' * 10
+            + struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0,
+                          0x40000000)
+            + '\x00' * 24 + struct.pack('>I', 2))
+    mdhd = _full_atom('mdhd', struct.pack('>IIIIHH', 0, 0, scale, duration,
+                                          0x55c4, 0))
+    hdlr = _full_atom('hdlr', struct.pack('>I', 0) + 'soun' + '\x00' * 12
+            + 'SoundHandler\x00')
+    esds = _full_atom('esds',
+            '\x03\x19\x00\x01\x00'
+            + '\x04\x11\x40\x15\x00\x00\x00' + struct.pack('>II', 128000, 128000)
+            + '\x05\x02\x12\x10' + '\x06\x01\x02')
+    mp4a = _atom('mp4a', '\x00' * 6 + struct.pack('>H', 1) + '\x00' * 8
+            + struct.pack('>HHHHI', 2, 16, 0, 0, scale << 16) + esds)
+    stsd = _full_atom('stsd', struct.pack('>I', 1) + mp4a)
+    stts = _full_atom('stts', struct.pack('>I', 0))
+    stsc = _full_atom('stsc', struct.pack('>I', 0))
+    stsz = _full_atom('stsz', struct.pack('>II', 0, 0))
+    stco = _full_atom('stco', struct.pack('>I', 0))
+    stbl = _atom('stbl', stsd + stts + stsc + stsz + stco)
+    minf = _atom('minf', _full_atom('smhd', struct.pack('>I', 0)) + stbl)
+    mdia = _atom('mdia', mdhd + hdlr + minf)
+    trak = _atom('trak', mdia)
+    moov = _atom('moov', mvhd + trak)
+    return ftyp + moov + _atom('mdat', '')
+
+STREAMS = {
+    'mp3': mp3_stream,
+    'flac': flac_stream,
+    'ogg': ogg_stream,
+    'm4a': mp4_stream,
+}
+# }}} end raw streams
+
+def write_track(path, fmt, tags, art=None):
+    """Write a tagged file of the given format to path."""
+    with open(path, 'wb') as f:
+        f.write(STREAMS[fmt]())
+    mf = MediaFile(path)
+    for key, value in tags.items():
+        setattr(mf, key, value)
+    if art is not None:
+        mf.art = art
+    mf.save()
+
+def generate(directory, artists=10, releases=5, tracks=10,
+             formats=FORMATS, art=True, seed=0):
+    """Populate directory with artists * releases * tracks files laid
+    out as Artist/Release/NN Title.ext. Returns the list of paths.
+    """
+    rnd = random.Random(seed)
+    paths = [ ]
+    for a in range(artists):
+        artist = u'Artist %04i' % a
+        for r in range(releases):
+            album = u'Release %04i-%02i' % (a, r)
+            reldir = os.path.join(directory, artist.encode('utf8'),
+                                  album.encode('utf8'))
+            mkdirall(os.path.join(reldir, 'x'))
+            if art:
+                with open(os.path.join(reldir, 'folder.png'), 'wb') as f:
+                    f.write(PNG)
+            fmt = formats[(a * releases + r) % len(formats)]
+            # a release's tracks come out on the same day
+            date = datetime.date(1970 + rnd.randint(0, 40),
+                                 rnd.randint(1, 12), rnd.randint(1, 28))
+            for t in range(tracks):
+                path = os.path.join(reldir, '%02i Track %02i.%s' % (t + 1, t + 1, fmt))
+                write_track(path, fmt, {
+                    'title': u'Track %02i' % (t + 1),
+                    'artist': artist,
+                    'album': album,
+                    'albumartist': artist,
+                    'genre': rnd.choice([u'Rock', u'Jazz', u'Pop', u'Ambient']),
+                    'track': t + 1,
+                    'tracktotal': tracks,
+                    'date': date,
+                    'bpm': rnd.randint(60, 180),
+                }, PNG if art else None)
+                paths.append(path)
+    return paths
+
+def tag(lib, names=TAGS, seed=0):
+    """Tag the tracks of lib, which the importer never does: each gets
+    one to three of names, with random weights, in a single insert.
+    Returns the number of taggings.
+    """
+    from musicdir.library import Tag, TrackTag, Track
+    rnd = random.Random(seed)
+    tags = dict((name, Tag(name=name)) for name in names)
+    lib.session.add_all(tags.values())
+    lib.session.flush()
+    rows = [ ]
+    for (id,) in lib.session.query(Track.id).order_by(Track.id):
+        for name in rnd.sample(names, rnd.randint(1, 3)):
+            rows.append({ 'track_id': id, 'tag_id': tags[name].id,
+                          'weight': rnd.randint(1, 100), 'origin': u'synth' })
+    if rows:
+        lib.session.execute(TrackTag.__table__.insert(), rows)
+    # the tag index reloads on a new generation only
+    lib.bump_generation()
+    lib.session.commit()
+    return len(rows)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print 'usage: %s DIRECTORY [ARTISTS [RELEASES [TRACKS]]]' % sys.argv[0]
+        sys.exit(1)
+    counts = [int(arg) for arg in sys.argv[2:5]]
+    paths = generate(sys.argv[1], *counts)
+    print 'wrote %i files' % len(paths)
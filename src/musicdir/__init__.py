@@ -15,5 +15,10 @@
 __version__ = '0.01'
 __author__ = 'coolkehon <coolkehon [at] gmail>'
 
-import musicdir.library
-Library = musicdir.library.Library
+def Library(*args, **kwargs):
+    """Open a musicdir.library.Library. The library module (and with
+    it SQLAlchemy) is only imported when a library is opened, so that
+    commands run by the library daemon start quickly.
+    """
+    from musicdir.library import Library
+    return Library(*args, **kwargs)
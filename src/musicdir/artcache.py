@@ -0,0 +1,232 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Content-addressed cache for cover art.
+
+Every image is stored once on disk under the SHA-1 of its contents and
+indexed by an ArtBlob row, so the same cover found in a folder.jpg and
+embedded in each track of an album ends up as a single blob that all
+of the track files point to through TrackFile.cover. Folder art is
+attached to the track files through that same blob's Attachment.
+
+Embedded art is read in a small background thread pool; the results
+are folded into the session by collect(), which must be called from
+the thread that owns the library session. A track file whose cover
+isn't cached (it had none when imported, or it was evicted) has it
+read when cover() asks for it.
+"""
+import os
+import hashlib
+import imghdr
+import datetime
+import logging
+from multiprocessing.pool import ThreadPool
+
+from musicdir.library import File, Attachment, TrackFile, ArtBlob, \
+        track_attachments, track_file_attachments, release_attachments, \
+        artist_attachments
+from musicdir.mediafile import MediaFile, UnreadableFileError
+from musicdir.util import bytestring_path, syspath, mkdirall, soft_remove
+
+from sqlalchemy import func
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_THREADS = 2
+
+# what an evicted blob's Attachment has to be taken out of
+ATTACHMENT_TABLES = (track_attachments, track_file_attachments,
+                     release_attachments, artist_attachments)
+
+log = logging.getLogger('musicdir')
+
+def _read_art(path):
+    """Read the embedded art of the media file at path. Returns a
+    (sha1, data) pair or None when the file has no art. Runs in the
+    extraction pool, so it must not touch the database.
+    """
+    try:
+        data = MediaFile(syspath(path)).art
+    except UnreadableFileError:
+        return None
+    if not data:
+        return None
+    data = str(data)
+    return hashlib.sha1(data).hexdigest(), data
+
+# {{{ ArtCache
+class ArtCache(object):
+    """A size-capped, least recently used store of cover images."""
+    def __init__(self, lib, directory, max_size=DEFAULT_MAX_SIZE,
+                 threads=DEFAULT_THREADS):
+        self.lib = lib
+        self.directory = bytestring_path(os.path.expanduser(directory))
+        self.max_size = max_size
+        self.threads = threads
+        self._pool = None
+        self._pending = [ ]
+
+    def path_for(self, sha1, data):
+        """Return the on-disk location for the blob with the given
+        digest. Blobs are fanned out over 256 directories.
+        """
+        ext = imghdr.what(None, h=data) or 'jpg'
+        if ext == 'jpeg':
+            ext = 'jpg'
+        return os.path.join(self.directory, sha1[:2], '%s.%s' % (sha1, ext))
+
+    def lookup(self, sha1):
+        """Return the cached Attachment for the digest, marking it as
+        recently used, or None if it is not cached.
+        """
+        blob = self.lib.session.query(ArtBlob).filter(ArtBlob.sha1 == sha1).first()
+        if blob is None:
+            return None
+        blob.accessed = datetime.datetime.utcnow()
+        return blob.attachment
+
+    def store(self, data, sha1=None):
+        """Add image data to the cache and return the Attachment that
+        refers to it. Data that is already cached is not written again.
+        """
+        if sha1 is None:
+            sha1 = hashlib.sha1(data).hexdigest()
+
+        attachment = self.lookup(sha1)
+        if attachment is not None:
+            return attachment
+
+        path = self.path_for(sha1, data)
+        if not os.path.exists(syspath(path)):
+            mkdirall(path)
+            tmp = path + '.tmp'
+            with open(syspath(tmp), 'wb') as f:
+                f.write(data)
+            os.rename(syspath(tmp), syspath(path))
+
+        file = File(path=path, size=len(data))
+        file.sha1_checksum = sha1
+        attachment = Attachment(file=file, name=u'cover')
+        self.lib.session.add(ArtBlob(sha1=sha1, size=len(data), attachment=attachment))
+        return attachment
+
+    def store_file(self, path):
+        """Add the image at path (a folder.jpg, for instance) to the
+        cache and return its Attachment.
+        """
+        with open(syspath(path), 'rb') as f:
+            data = f.read()
+        return self.store(data)
+
+    def extract(self, trackfile):
+        """Schedule extraction of the embedded art of trackfile. The
+        track file's cover is set by a later call to collect().
+        """
+        if self._pool is None:
+            self._pool = ThreadPool(self.threads)
+        result = self._pool.apply_async(_read_art, (trackfile.file.path,))
+        self._pending.append((trackfile, result))
+
+    def cover(self, trackfile):
+        """Return the cover Attachment of trackfile, marking it as
+        recently used, or reading the file's embedded art into the
+        cache if it has none. Returns None if the file has no art.
+        """
+        if trackfile.cover is not None:
+            blob = self.lib.session.query(ArtBlob) \
+                    .filter(ArtBlob.attachment_id == trackfile.cover.id).first()
+            if blob is not None:
+                blob.accessed = datetime.datetime.utcnow()
+            return trackfile.cover
+        if trackfile.file is None or trackfile.file.path is None:
+            return None
+        art = _read_art(trackfile.file.path)
+        if art is None:
+            return None
+        trackfile.cover = self.store(art[1], art[0])
+        return trackfile.cover
+
+    def collect(self, wait=False):
+        """Store the art of finished extractions and point their track
+        files at it. If wait is set, block until every scheduled
+        extraction has finished. Returns the number of covers set.
+        """
+        done = 0
+        pending = [ ]
+        for trackfile, result in self._pending:
+            if not wait and not result.ready():
+                pending.append((trackfile, result))
+                continue
+            try:
+                art = result.get()
+            except Exception, exc:
+                log.debug(u'art extraction failed: %s' % exc)
+                continue
+            if art is not None:
+                sha1, data = art
+                trackfile.cover = self.store(data, sha1)
+                done += 1
+        self._pending = pending
+        return done
+
+    def size(self):
+        """Total size in bytes of the cached blobs."""
+        return self.lib.session.query(func.sum(ArtBlob.size)).scalar() or 0
+
+    def evict(self):
+        """Remove least recently used blobs until the cache fits in
+        max_size. Track files that used an evicted blob lose their
+        cover (and, if it was their folder art, the attachment);
+        cover() extracts embedded art again when it is asked for.
+        Returns the number of blobs removed.
+        """
+        session = self.lib.session
+        session.flush()
+        excess = self.size() - self.max_size
+        if excess <= 0:
+            return 0
+
+        removed = 0
+        blobs = session.query(ArtBlob).order_by(ArtBlob.accessed, ArtBlob.id)
+        for blob in blobs.all():
+            if excess <= 0:
+                break
+            attachment = blob.attachment
+            session.query(TrackFile)\
+                    .filter(TrackFile.cover_id == attachment.id)\
+                    .update({TrackFile.cover_id: None}, synchronize_session=False)
+            for table in ATTACHMENT_TABLES:
+                session.execute(table.delete()
+                        .where(table.c.attachment_id == attachment.id))
+            soft_remove(attachment.file.path)
+            session.delete(blob)
+            session.delete(attachment.file)
+            session.delete(attachment)
+            excess -= blob.size or 0
+            removed += 1
+
+        # Track files loaded in this session still point at the blobs.
+        session.flush()
+        session.expire_all()
+        return removed
+
+    def close(self):
+        """Finish outstanding extractions and trim the cache."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self.collect(wait=True)
+        self.lib.session.flush()
+        self.evict()
+# }}} end ArtCache
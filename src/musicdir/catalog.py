@@ -0,0 +1,257 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""A compact, read-only catalog of the library's tracks.
+
+Browsing and writing playlists only read tracks, and a Track object
+(with its state for the session's identity map and change tracking)
+takes around a kilobyte. The catalog keeps every track as a position
+in parallel arrays of machine numbers instead, with its title and the
+path of its first file packed into byte strings; artist and release
+names are kept once per artist and release. A track costs 44 bytes of
+numbers and offsets (on a 64-bit machine) plus its title and path;
+benchmarks/run.py reports the total per track.
+
+The catalog is loaded with one query. While the library's generation
+doesn't change, it is up to date. When it does and tracks were only
+added since (the library's count of edits is the same), the tracks
+above the highest id loaded are appended; after any other change it
+loads again.
+"""
+import array
+import datetime
+
+# The value of a number column for a track without one.
+MISSING = -1
+
+# Number columns: name and array typecode.
+NUMBERS = [
+    ('id', 'l'),
+    ('artist_id', 'i'),
+    ('release_id', 'i'),
+    ('track', 'i'),
+    ('disc', 'i'),
+    ('date', 'i'),   # as a date ordinal
+    ('length', 'f'), # seconds
+    ('bpm', 'i'),
+]
+
+class Record(object):
+    """One track of the catalog, made on demand."""
+    __slots__ = ('id', 'artist', 'release', 'title', 'track', 'disc',
+                 'date', 'length', 'bpm', 'path')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def __repr__(self):
+        return 'Record(%i, %r)' % (self.id, self.title)
+
+class Strings(object):
+    """Strings packed end to end in a bytearray, UTF-8 encoded unless
+    they are byte strings already.
+    """
+    def __init__(self):
+        self.data = bytearray()
+        self.offsets = array.array('I', [ 0 ])
+
+    def append(self, value):
+        if value is not None:
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            self.data.extend(str(value))
+        self.offsets.append(len(self.data))
+
+    def raw(self, i):
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+    def text(self, i):
+        return self.raw(i).decode('utf8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+class Catalog(object):
+    def __init__(self, lib):
+        self.lib = lib
+        self.clear()
+
+    def clear(self):
+        self.columns = dict((name, array.array(code)) for name, code in NUMBERS)
+        self.titles = Strings()
+        self.paths = Strings()
+        self.artists = { }   # artist id -> name
+        self.releases = { }  # release id -> name
+        self.watermark = 0   # highest track id loaded
+        self.edits = None    # the library's count of edits when loaded
+        self.generation = None
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    # {{{ loading
+    def _query(self, after):
+        from sqlalchemy import select
+        from musicdir.library import Artist, Release, Track, TrackFile, File
+        tracks = Track.__table__
+        artists = Artist.__table__
+        releases = Release.__table__
+        trackfiles = TrackFile.__table__
+        files = File.__table__
+        joined = tracks.outerjoin(artists, artists.c.id == tracks.c.artist_id) \
+                .outerjoin(releases, releases.c.id == tracks.c.release_id) \
+                .outerjoin(trackfiles, trackfiles.c.track_id == tracks.c.id) \
+                .outerjoin(files, files.c.id == trackfiles.c.file_id)
+        return select([ tracks.c.id, tracks.c.artist_id, tracks.c.release_id,
+                        tracks.c.track, tracks.c.disc, tracks.c.date,
+                        tracks.c.length, tracks.c.bpm, artists.c.name,
+                        releases.c.name, tracks.c.title, files.c.path ],
+                      tracks.c.id > after, from_obj=[ joined ]) \
+                .order_by(tracks.c.id, trackfiles.c.id)
+
+    def _read(self, after):
+        """Append the tracks with ids above after."""
+        columns = [ self.columns[name] for name, code in NUMBERS ]
+        ids = self.columns['id']
+        artists, releases = self.artists, self.releases
+        for row in self.lib.session.execute(self._query(after)):
+            if ids and ids[-1] == row[0]:
+                # another file of the same track
+                continue
+            numbers = list(row[:8])
+            if numbers[5] is not None:
+                numbers[5] = numbers[5].toordinal()
+            for column, value in zip(columns, numbers):
+                column.append(MISSING if value is None else value)
+            if row[1] is not None and row[1] not in artists:
+                artists[row[1]] = row[8]
+            if row[2] is not None and row[2] not in releases:
+                releases[row[2]] = row[9]
+            self.titles.append(row[10])
+            self.paths.append(row[11])
+        if ids:
+            self.watermark = ids[-1]
+
+    def load(self):
+        """Read all of the catalog."""
+        self.clear()
+        self.generation = self.lib.generation()
+        self.edits = self.lib.edits()
+        self._read(0)
+
+    def refresh(self):
+        """Bring the catalog up to date with the library."""
+        if self.edits is None:
+            self.load()
+            return
+        generation = self.lib.generation()
+        if generation == self.generation:
+            return
+        if self.lib.edits() != self.edits:
+            self.load()
+            return
+        self.generation = generation
+        self._read(self.watermark)
+    # }}} end loading
+
+    # {{{ reading
+    def value(self, name, i):
+        """The value of column name for the track at position i."""
+        if name == 'title':
+            return self.titles.text(i)
+        elif name == 'path':
+            return self.paths.raw(i) or None
+        elif name == 'artist':
+            return self.artists.get(self.columns['artist_id'][i])
+        elif name == 'release':
+            return self.releases.get(self.columns['release_id'][i])
+        value = self.columns[name][i]
+        if value == MISSING:
+            return None
+        if name == 'date':
+            return datetime.date.fromordinal(value)
+        return value
+
+    def record(self, i):
+        """The track at position i as a Record."""
+        return Record(**dict((name, self.value(name, i))
+                             for name in Record.__slots__))
+
+    def records(self, positions=None):
+        if positions is None:
+            positions = xrange(len(self))
+        for i in positions:
+            yield self.record(i)
+    # }}} end reading
+
+    # {{{ filtering and sorting
+    def filter(self, name, test, positions=None):
+        """The positions (of all tracks, or of positions) whose value of
+        column name passes test. Number columns are tested without
+        making records.
+        """
+        if positions is None:
+            positions = xrange(len(self))
+        if name in self.columns and name != 'date':
+            column = self.columns[name]
+            return [ i for i in positions
+                     if column[i] != MISSING and test(column[i]) ]
+        return [ i for i in positions if test(self.value(name, i)) ]
+
+    def search(self, text, positions=None):
+        """The positions of tracks whose artist, release or title
+        contains text, ignoring case.
+        """
+        text = text.lower()
+        if positions is None:
+            positions = xrange(len(self))
+        # names are tested once per artist and release
+        artists = set(id for id, name in self.artists.iteritems()
+                      if name and text in name.lower())
+        releases = set(id for id, name in self.releases.iteritems()
+                       if name and text in name.lower())
+        artist_ids = self.columns['artist_id']
+        release_ids = self.columns['release_id']
+        titles = self.titles
+        return [ i for i in positions
+                 if artist_ids[i] in artists or release_ids[i] in releases
+                 or text in titles.text(i).lower() ]
+
+    def sort_key(self, name):
+        """A function giving the sort key of the track at a position:
+        'artist' (artist, release, disc, track), 'album' (release, disc,
+        track), 'title', or a number column.
+        """
+        columns = self.columns
+        artists, releases = self.artists, self.releases
+        def album(i):
+            return ((releases.get(columns['release_id'][i]) or u'').lower(),
+                    columns['release_id'][i], columns['disc'][i],
+                    columns['track'][i])
+        if name == 'artist':
+            return lambda i: ((artists.get(columns['artist_id'][i]) or u'').lower(),
+                              album(i))
+        elif name == 'album':
+            return album
+        elif name == 'title':
+            return lambda i: self.titles.text(i).lower()
+        return columns[name].__getitem__
+
+    def sort(self, name, positions=None, reverse=False):
+        """positions (or all tracks) sorted by sort_key(name)."""
+        if positions is None:
+            positions = xrange(len(self))
+        return sorted(positions, key=self.sort_key(name), reverse=reverse)
+    # }}} end filtering and sorting
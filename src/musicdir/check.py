@@ -0,0 +1,182 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Check that the library's files are still where it thinks they are.
+
+The file rows are streamed in path order and grouped by directory, so
+that a single listdir tells which of a directory's files are gone and
+only the files that are still there are stat'ed; directories are
+checked in a thread pool, as the time goes into waiting on the disk.
+A file is reported as
+    missing     no longer at its path
+    resized     its size differs from the one recorded
+    modified    changed since it was added (same size, newer mtime)
+Missing files can be relinked to files of the same name and size found
+in other directories, or pruned from the library.
+"""
+import os
+import datetime
+from multiprocessing.pool import ThreadPool
+
+from musicdir.util import bytestring_path, syspath, sorted_walk
+
+MISSING = 'missing'
+RESIZED = 'resized'
+MODIFIED = 'modified'
+
+DEFAULT_THREADS = 8
+
+# Rows grouped into directories at a time.
+CHUNK_SIZE = 2000
+
+# Rows per transaction when pruning or relinking.
+BATCH_SIZE = 500
+
+def stream_files(lib, roots=None):
+    """Yield the (id, path, size, dateadded, sha1_checksum) rows of
+    the library's files in path order, limited to the files below roots
+    if given. Uses its own connection, and keeps it until exhausted.
+    """
+    from sqlalchemy import select, or_, and_
+    from musicdir.library import File
+    files = File.__table__
+    query = select([files.c.id, files.c.path, files.c.size,
+                    files.c.dateadded, files.c.sha1_checksum])
+    if roots:
+        below = [ ]
+        for root in roots:
+            # paths are stored as they were given to import
+            root = os.path.normpath(bytestring_path(root))
+            # Everything below root sorts between root/ and root0.
+            below.append(or_(files.c.path == root,
+                             and_(files.c.path > root + os.sep,
+                                  files.c.path < root + chr(ord(os.sep) + 1))))
+        query = query.where(or_(*below))
+    for row in lib.db.execute(query.order_by(files.c.path)):
+        if row[1] is not None:
+            yield (row[0], str(row[1]), row[2], row[3], row[4])
+
+def _by_directory(rows):
+    """Group chunks of rows by directory, yielding lists of
+    (directory, rows) groups.
+    """
+    groups = { }
+    count = 0
+    for row in rows:
+        groups.setdefault(os.path.dirname(row[1]), [ ]).append(row)
+        count += 1
+        if count >= CHUNK_SIZE:
+            yield groups.items()
+            groups = { }
+            count = 0
+    if groups:
+        yield groups.items()
+
+def _check_directory(group):
+    """Check the rows of a directory, returning the list of their
+    (kind, row) problems.
+    """
+    directory, rows = group
+    try:
+        names = set(os.listdir(syspath(directory)))
+    except OSError:
+        names = set()
+
+    problems = [ ]
+    for row in rows:
+        if os.path.basename(row[1]) not in names:
+            problems.append((MISSING, row))
+            continue
+        try:
+            st = os.stat(syspath(row[1]))
+        except OSError:
+            problems.append((MISSING, row))
+            continue
+        size, dateadded = row[2], row[3]
+        if size is not None and st.st_size != size:
+            problems.append((RESIZED, row))
+        elif dateadded is not None \
+                and datetime.datetime.utcfromtimestamp(st.st_mtime) > dateadded:
+            problems.append((MODIFIED, row))
+    return problems
+
+def check(lib, roots=None, threads=DEFAULT_THREADS):
+    """Yield a (kind, row) pair for every file in the library (or
+    below roots) that is missing, resized or modified, where row is as
+    yielded by stream_files. Problems come in no particular order.
+    """
+    pool = ThreadPool(threads)
+    try:
+        for groups in _by_directory(stream_files(lib, roots)):
+            for problems in pool.imap_unordered(_check_directory, groups):
+                for problem in problems:
+                    yield problem
+    finally:
+        pool.terminate()
+        pool.join()
+
+def find_candidates(directories):
+    """Index the files below directories by (name, size), for relinking
+    missing files to.
+    """
+    candidates = { }
+    for directory in directories:
+        for root, dirs, files in sorted_walk(bytestring_path(directory)):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    size = os.path.getsize(syspath(path))
+                except OSError:
+                    continue
+                candidates.setdefault((name, size), [ ]).append(path)
+    return candidates
+
+def relink_targets(lib, rows, candidates):
+    """Pick a new path for each missing file in rows: the one file of
+    the same name and size among candidates that isn't in the library
+    yet (and has the same checksum, if the file has one). Returns a
+    list of (row, path) pairs.
+    """
+    from musicdir.library import checksums
+    matches = [ (row, candidates.get((os.path.basename(row[1]), row[2]), [ ]))
+                for row in rows ]
+    taken = lib.known_paths(p for row, paths in matches for p in paths)
+    found = [ ]
+    for row, paths in matches:
+        paths = [ p for p in paths if p not in taken ]
+        if row[4] is not None:
+            paths = [ p for p in paths if checksums(p)[0] == row[4] ]
+        if len(paths) == 1:
+            found.append((row, paths[0]))
+            taken.add(paths[0])
+    return found
+
+def relink(lib, targets):
+    """Point files at their new paths, BATCH_SIZE files per
+    transaction. targets is a list of (row, path) pairs.
+    """
+    for i in range(0, len(targets), BATCH_SIZE):
+        lib.set_paths((row[0], path) for row, path in targets[i:i+BATCH_SIZE])
+        lib.session.commit()
+    return len(targets)
+
+def prune(lib, ids):
+    """Drop the files with the given ids from the library, BATCH_SIZE
+    files per transaction.
+    """
+    ids = list(ids)
+    for i in range(0, len(ids), BATCH_SIZE):
+        lib.forget_files(ids[i:i+BATCH_SIZE])
+        lib.session.commit()
+    return len(ids)
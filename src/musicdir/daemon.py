@@ -0,0 +1,254 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""A library daemon answering musicdir commands on a Unix socket.
+
+`musicdir serve` opens the library once and keeps it, and everything
+loaded with it, warm; the command line forwards its arguments and
+working directory to the daemon and copies back what the command
+prints, skipping the start up work of opening the library itself.
+
+Both directions use frames of a one byte type, a four byte big endian
+length and the data. The client sends a 'c' frame with its working
+directory, an 'f' frame with its config file path, an 'a' frame per
+argument and a final 'g'. The daemon answers with 'o' (stdout) and 'e'
+(stderr) frames followed by an 'x' frame holding the exit status, or
+with a single 'r' frame if it won't run the command (for another
+library, say), in which case the client runs it itself.
+
+Requests are handled one at a time, as the library session is not
+shared between threads.
+"""
+import os
+import sys
+import errno
+import signal
+import socket
+import struct
+import traceback
+import SocketServer
+
+from musicdir.util import mkdirall, syspath
+
+HEADER = struct.Struct('>cI')
+
+# Bytes of output collected before a frame is sent.
+OUTPUT_BUFFER_SIZE = 8192
+
+def _write_frame(out, kind, data=''):
+    out.write(HEADER.pack(kind, len(data)) + data)
+
+def _read_frame(infile):
+    """Return the next (kind, data) frame, or None at the end of the
+    stream.
+    """
+    header = infile.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    kind, size = HEADER.unpack(header)
+    data = infile.read(size)
+    if len(data) < size:
+        return None
+    return kind, data
+
+class _FrameWriter(object):
+    """A file-like object sending what is written to it as frames of
+    the given kind.
+    """
+    def __init__(self, out, kind):
+        self.out = out
+        self.kind = kind
+        self.buffer = [ ]
+        self.size = 0
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf8')
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= OUTPUT_BUFFER_SIZE:
+            self.flush()
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self.buffer:
+            data = ''.join(self.buffer)
+            self.buffer = [ ]
+            self.size = 0
+            _write_frame(self.out, self.kind, data)
+        self.out.flush()
+
+    def isatty(self):
+        return False
+
+# {{{ server
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        cwd, configpath, argv = None, None, [ ]
+        while True:
+            frame = _read_frame(self.rfile)
+            if frame is None:
+                return
+            kind, data = frame
+            if kind == 'c':
+                cwd = data
+            elif kind == 'f':
+                configpath = data
+            elif kind == 'a':
+                argv.append(data)
+            elif kind == 'g':
+                break
+
+        stdout = _FrameWriter(self.wfile, 'o')
+        stderr = _FrameWriter(self.wfile, 'e')
+        old_cwd = os.getcwd()
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = stdout, stderr
+        status = 0
+        try:
+            if cwd is not None:
+                os.chdir(syspath(cwd))
+            if not self.server.run(argv, configpath):
+                status = None
+        except SystemExit, exc:
+            status = exc.code
+            if status is None:
+                status = 0
+            elif not isinstance(status, int):
+                print >>sys.stderr, status
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            os.chdir(old_cwd)
+
+        if status is None:
+            # Nothing has run, so nothing has been printed.
+            _write_frame(self.wfile, 'r')
+        else:
+            stdout.flush()
+            stderr.flush()
+            _write_frame(self.wfile, 'x', str(status))
+        self.wfile.flush()
+
+class Daemon(SocketServer.UnixStreamServer):
+    """Serves commands on the Unix socket at path. run is called with
+    the arguments and config file path of each request, in the
+    request's working directory and with stdout and stderr sent to the
+    client; it returns False to refuse the request and may raise
+    SystemExit to set the exit status.
+    """
+    def __init__(self, path, run):
+        self.path = path
+        self.run = run
+        mkdirall(path)
+        if os.path.exists(syspath(path)):
+            sock = _connect(path)
+            if sock is not None:
+                sock.close()
+                raise IOError(errno.EADDRINUSE,
+                              'a daemon is already listening', path)
+            # Left behind by a daemon that didn't exit cleanly.
+            os.unlink(syspath(path))
+
+        # The socket runs commands on our behalf; keep it to ourselves.
+        umask = os.umask(077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, syspath(path), _Handler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        try:
+            os.unlink(syspath(self.path))
+        except OSError:
+            pass
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+def serve(path, run):
+    """Answer requests on the socket at path until interrupted or
+    terminated.
+    """
+    daemon = Daemon(path, run)
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.server_close()
+# }}} end server
+
+# {{{ client
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(syspath(path))
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+def forward(path, argv, configpath):
+    """Run a command in the daemon listening at path. Returns its exit
+    status, or None if no daemon is listening or it refused the
+    command.
+    """
+    sock = _connect(path)
+    if sock is None:
+        return None
+    started = False
+    try:
+        out = sock.makefile('wb')
+        _write_frame(out, 'c', os.getcwd())
+        _write_frame(out, 'f', configpath or '')
+        for arg in argv:
+            _write_frame(out, 'a', arg)
+        _write_frame(out, 'g')
+        out.flush()
+
+        infile = sock.makefile('rb')
+        while True:
+            frame = _read_frame(infile)
+            if frame is None:
+                raise socket.error('connection closed')
+            kind, data = frame
+            if kind == 'o':
+                started = True
+                sys.stdout.write(data)
+            elif kind == 'e':
+                started = True
+                sys.stderr.write(data)
+            elif kind == 'x':
+                sys.stdout.flush()
+                return int(data)
+            elif kind == 'r':
+                return None
+    except socket.error:
+        if not started:
+            return None
+        # Running the command again would repeat what it has done.
+        print >>sys.stderr, 'musicdir: lost connection to daemon'
+        return 1
+    finally:
+        sock.close()
+# }}} end client
@@ -0,0 +1,237 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Export the library as a flat table, one row per track file.
+
+Rows are read with plain SQL expressions (no ORM objects are made) a
+chunk of tracks at a time, paging on the track id, so that exporting
+any number of tracks takes the same memory and every chunk's query
+costs the same. Each chunk goes to a writer: CSV, JSON Lines or, when
+pyarrow is installed, Parquet, which is written a row group per chunk
+from columns collected in arrays.
+"""
+import csv
+import json
+import array
+
+DEFAULT_CHUNK_SIZE = 5000
+
+# (name, type) of the exported columns; types are int, float, str
+# (text), 'bytes' (paths), 'date' and 'datetime'.
+COLUMNS = [
+    ('track_id', int),
+    ('artist', str),
+    ('release', str),
+    ('release_date', 'date'),
+    ('title', str),
+    ('track', int),
+    ('disc', int),
+    ('genre', str),
+    ('date', 'date'),
+    ('composer', str),
+    ('length', float),
+    ('bpm', int),
+    ('file_id', int),
+    ('path', 'bytes'),
+    ('size', int),
+    ('dateadded', 'datetime'),
+    ('bitrate', int),
+    ('format', str),
+]
+COLUMN_NAMES = [ name for name, type in COLUMNS ]
+
+# array typecodes of the Parquet writer's numeric columns ('l' is as
+# wide as a C long, which is 64 bits on most platforms)
+INT_TYPECODE = 'l' if array.array('l').itemsize == 8 else 'i'
+FLOAT_TYPECODE = 'd'
+
+class ExportError(Exception):
+    pass
+
+def _select():
+    from sqlalchemy import select
+    from musicdir.library import Artist, Release, Track, TrackFile, File
+    tracks = Track.__table__
+    artists = Artist.__table__
+    releases = Release.__table__
+    trackfiles = TrackFile.__table__
+    files = File.__table__
+    joined = tracks.outerjoin(artists, artists.c.id == tracks.c.artist_id) \
+            .outerjoin(releases, releases.c.id == tracks.c.release_id) \
+            .outerjoin(trackfiles, trackfiles.c.track_id == tracks.c.id) \
+            .outerjoin(files, files.c.id == trackfiles.c.file_id)
+    columns = [ tracks.c.id, artists.c.name, releases.c.name, releases.c.date,
+                tracks.c.title, tracks.c.track, tracks.c.disc, tracks.c.genre,
+                tracks.c.date, tracks.c.composer, tracks.c.length,
+                tracks.c.bpm, files.c.id, files.c.path, files.c.size,
+                files.c.dateadded, trackfiles.c.bitrate, trackfiles.c.format ]
+    return tracks, trackfiles, select(columns, from_obj=[ joined ])
+
+def chunks(lib, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the exported rows in lists, chunk_size tracks (and all of
+    their files) at a time, ordered by track id.
+    """
+    from sqlalchemy import select, and_
+    tracks, trackfiles, query = _select()
+    query = query.order_by(tracks.c.id, trackfiles.c.id)
+    ids = select([ tracks.c.id ]).order_by(tracks.c.id).limit(chunk_size)
+    last = 0
+    while True:
+        # the chunk's last id bounds the join, which never needs an
+        # OFFSET and so doesn't get slower further in
+        bound = lib.db.execute(ids.where(tracks.c.id > last)
+                               .offset(chunk_size - 1).limit(1)).scalar()
+        if bound is None:
+            rows = lib.db.execute(query.where(tracks.c.id > last)).fetchall()
+        else:
+            rows = lib.db.execute(query.where(and_(tracks.c.id > last,
+                                  tracks.c.id <= bound))).fetchall()
+        if rows:
+            yield rows
+        if bound is None:
+            return
+        last = bound
+
+def _isoformat(value):
+    return value.isoformat() if value is not None else None
+
+def _decode(value):
+    return str(value).decode('utf8', 'replace') if value is not None else None
+
+def _encode(value):
+    return value.encode('utf8') if value is not None else None
+
+def _converters(types):
+    """A function per column turning its values into ones the text
+    writers can write, given a converter per column type. Columns with
+    nothing to convert get None, and are passed through as they are.
+    """
+    return [ types.get(type) for name, type in COLUMNS ]
+
+def _convert(rows, converters):
+    pairs = [ (i, f) for i, f in enumerate(converters) if f is not None ]
+    for row in rows:
+        row = list(row)
+        for i, f in pairs:
+            row[i] = f(row[i])
+        yield row
+
+# {{{ writers
+class CSVWriter(object):
+    """Writes a header and a line per row, in UTF-8."""
+    converters = _converters({ str: _encode, 'bytes': str,
+                               'date': _isoformat, 'datetime': _isoformat })
+
+    def __init__(self, out):
+        self.writer = csv.writer(out)
+        self.writer.writerow(COLUMN_NAMES)
+
+    def write(self, rows):
+        self.writer.writerows(_convert(rows, self.converters))
+
+    def close(self):
+        pass
+
+class JSONLinesWriter(object):
+    """Writes a JSON object per row and line."""
+    converters = _converters({ 'bytes': _decode,
+                               'date': _isoformat, 'datetime': _isoformat })
+
+    def __init__(self, out):
+        self.out = out
+        self.encoder = json.JSONEncoder(sort_keys=True)
+
+    def write(self, rows):
+        encode = self.encoder.encode
+        self.out.write(''.join(encode(dict(zip(COLUMN_NAMES, row))) + '\n'
+                               for row in _convert(rows, self.converters)))
+
+    def close(self):
+        pass
+
+class ParquetWriter(object):
+    """Writes a Parquet row group per chunk. Numeric columns are
+    collected in arrays of machine numbers with a validity bitmap and
+    handed to pyarrow as buffers, without a Python object per value.
+    """
+    def __init__(self, out):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ExportError('Parquet export needs pyarrow')
+        self.pa = pyarrow
+        int_type = pyarrow.int64() if INT_TYPECODE == 'l' else pyarrow.int32()
+        self.types = { int: int_type, float: pyarrow.float64(),
+                       str: pyarrow.string(), 'bytes': pyarrow.binary(),
+                       'date': pyarrow.date32(),
+                       'datetime': pyarrow.timestamp('us') }
+        self.schema = pyarrow.schema([ pyarrow.field(name, self.types[type])
+                                       for name, type in COLUMNS ])
+        self.writer = pyarrow.parquet.ParquetWriter(out, self.schema)
+
+    def _numeric_column(self, rows, i, type):
+        values = array.array(INT_TYPECODE if type is int else FLOAT_TYPECODE)
+        valid = bytearray((len(rows) + 7) // 8)
+        for n, row in enumerate(rows):
+            v = row[i]
+            if v is None:
+                values.append(0)
+            else:
+                values.append(type(v))
+                valid[n >> 3] |= 1 << (n & 7)
+        return self.pa.Array.from_buffers(self.types[type], len(rows),
+                [ self.pa.py_buffer(bytes(valid)),
+                  self.pa.py_buffer(values.tostring()) ])
+
+    def write(self, rows):
+        pa = self.pa
+        columns = [ ]
+        for i, (name, type) in enumerate(COLUMNS):
+            field = self.schema.field_by_name(name)
+            if type in (int, float):
+                columns.append(self._numeric_column(rows, i, type))
+            elif type == 'bytes':
+                columns.append(pa.array([ None if row[i] is None else str(row[i])
+                                          for row in rows ], field.type))
+            else:
+                columns.append(pa.array([ row[i] for row in rows ], field.type))
+        self.writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+WRITERS = {
+    'csv': CSVWriter,
+    'jsonl': JSONLinesWriter,
+    'parquet': ParquetWriter,
+}
+# }}} end writers
+
+def export(lib, out, format='csv', chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    """Write the library to the file object out in format. progress,
+    if given, is called with the number of rows written after each
+    chunk. Returns the number of rows written.
+    """
+    if format not in WRITERS:
+        raise ExportError('unknown export format: %s' % format)
+    writer = WRITERS[format](out)
+    count = 0
+    for rows in chunks(lib, chunk_size):
+        writer.write(rows)
+        count += len(rows)
+        if progress is not None:
+            progress(count)
+    writer.close()
+    return count
@@ -0,0 +1,255 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""The similar artists graph.
+
+The similar_artists rows are loaded with one query into compressed
+sparse rows: the edges of every artist lie next to each other in one
+array of target nodes and one of weights (the match percentage, as a
+fraction), and an array of offsets says where each artist's edges
+start. Nodes are numbered in artist id order (artists that turn up
+later are added at the end); ids maps node numbers back to artist ids.
+
+Rows added later are read by id and kept in a small overlay next to the
+arrays until there are enough of them to make reloading worth it; rows
+that were changed or deleted make the graph reload.
+"""
+import array
+import heapq
+
+# A similarity without a match percentage counts as a full match.
+DEFAULT_WEIGHT = 1.0
+
+# Reload once the overlay holds this fraction of the loaded edges.
+RELOAD_RATIO = 0.25
+
+# Nodes expanded per hop by expand().
+EXPAND_WIDTH = 50
+
+# Personalized PageRank: the probability of jumping back to the seeds,
+# and the residual (per edge) below which a node isn't pushed.
+RESTART = 0.15
+EPSILON = 1e-4
+
+def _weight(match_percent):
+    if match_percent is None:
+        return DEFAULT_WEIGHT
+    return match_percent / 100.0
+
+class SimilarityGraph(object):
+    def __init__(self, lib):
+        self.lib = lib
+        self.ids = array.array('l')      # node -> artist id
+        self.nodes = { }                 # artist id -> node
+        self.offsets = array.array('l', [ 0 ])
+        self.targets = array.array('l')
+        self.weights = array.array('d')
+        self.overlay = { }               # node -> {target: weight}
+        self.added = 0                   # edges in the overlay
+        self.watermark = None            # highest row id read
+        self.stamp = None                # row count and sums up to watermark
+
+    def _node(self, artist_id):
+        node = self.nodes.get(artist_id)
+        if node is None:
+            node = self.nodes[artist_id] = len(self.ids)
+            self.ids.append(artist_id)
+        return node
+
+    def _stamp(self, watermark):
+        from sqlalchemy import select, func
+        from musicdir.library import SimilarArtist
+        edges = SimilarArtist.__table__
+        return tuple(self.lib.session.execute(
+                select([ func.count(edges.c.id), func.total(edges.c.match_percent),
+                         func.total(edges.c.similar_artist_id) ],
+                       edges.c.id <= watermark)).first())
+
+    def _rows(self, after=None):
+        from sqlalchemy import select, and_
+        from musicdir.library import SimilarArtist
+        edges = SimilarArtist.__table__
+        where = and_(edges.c.artist_id != None, edges.c.similar_artist_id != None,
+                     edges.c.artist_id != edges.c.similar_artist_id)
+        if after is not None:
+            where = and_(where, edges.c.id > after)
+        return select([ edges.c.id, edges.c.artist_id, edges.c.similar_artist_id,
+                        edges.c.match_percent ], where)
+
+    def load(self):
+        """Read all of the graph."""
+        from musicdir.library import SimilarArtist
+        edges = SimilarArtist.__table__
+        sources, targets = array.array('l'), array.array('l')
+        weights = array.array('d')
+        watermark = 0
+        query = self._rows().order_by(edges.c.artist_id, edges.c.similar_artist_id)
+        for id, artist_id, similar_id, match_percent in self.lib.session.execute(query):
+            watermark = max(watermark, id)
+            weight = _weight(match_percent)
+            if sources and sources[-1] == artist_id and targets[-1] == similar_id:
+                # the same pair from another source: keep the best match
+                weights[-1] = max(weights[-1], weight)
+                continue
+            sources.append(artist_id)
+            targets.append(similar_id)
+            weights.append(weight)
+
+        # nodes in artist id order, so the rows (sorted by artist id)
+        # come in node order
+        self.ids = array.array('l', sorted(set(sources).union(targets)))
+        self.nodes = dict((id, node) for node, id in enumerate(self.ids))
+        nodes = self.nodes
+        self.targets = array.array('l', [ nodes[id] for id in targets ])
+        self.weights = weights
+        counts = [ 0 ] * (len(self.ids) + 1)
+        for id in sources:
+            counts[nodes[id] + 1] += 1
+        for node in range(len(self.ids)):
+            counts[node + 1] += counts[node]
+        self.offsets = array.array('l', counts)
+        self.overlay, self.added = { }, 0
+        self.watermark = watermark
+        self.stamp = self._stamp(watermark)
+
+    def refresh(self):
+        """Bring the graph up to date: read the rows added since it was
+        loaded, or all of it again if older rows changed.
+        """
+        if self.stamp is None or self._stamp(self.watermark) != self.stamp:
+            self.load()
+            return
+        for id, artist_id, similar_id, match_percent in \
+                self.lib.session.execute(self._rows(self.watermark)):
+            self.watermark = max(self.watermark, id)
+            node, target = self._node(artist_id), self._node(similar_id)
+            weight = _weight(match_percent)
+            edges = self.overlay.setdefault(node, { })
+            if target not in edges:
+                self.added += 1
+            edges[target] = max(edges.get(target, 0), weight)
+        self.stamp = self._stamp(self.watermark)
+        if self.added > RELOAD_RATIO * max(len(self.targets), 1000):
+            self.load()
+
+    def edges(self, node):
+        """The (target node, weight) pairs of node's edges."""
+        if node + 1 < len(self.offsets):
+            start, end = self.offsets[node], self.offsets[node + 1]
+            pairs = zip(self.targets[start:end], self.weights[start:end])
+        else:
+            pairs = [ ]
+        extra = self.overlay.get(node)
+        if extra:
+            merged = dict(pairs)
+            for target, weight in extra.iteritems():
+                merged[target] = max(merged.get(target, 0), weight)
+            pairs = merged.items()
+        return pairs
+
+    def _seeds(self, artist_ids):
+        return [ self.nodes[id] for id in set(artist_ids) if id in self.nodes ]
+
+    def _result(self, scores, seeds, n):
+        best = heapq.nlargest(n + len(seeds), scores.iteritems(),
+                              key=lambda item: item[1])
+        seeds = set(seeds)
+        return [ (self.ids[node], score) for node, score in best
+                 if node not in seeds ][:n]
+
+    def neighbours(self, artist_id, n=10):
+        """The n artists most similar to artist_id, as (artist id,
+        weight) pairs, best first.
+        """
+        node = self.nodes.get(artist_id)
+        if node is None:
+            return [ ]
+        return [ (self.ids[target], weight) for target, weight in
+                 heapq.nlargest(n, self.edges(node), key=lambda edge: edge[1]) ]
+
+    def expand(self, artist_ids, hops=2, n=10, width=EXPAND_WIDTH):
+        """The n artists best reached from artist_ids in up to hops
+        steps, scored by the product of the weights along the best path.
+        Only the width best artists reached by a hop are followed.
+        """
+        seeds = self._seeds(artist_ids)
+        scores = dict.fromkeys(seeds, 1.0)
+        frontier = seeds
+        for hop in range(hops):
+            reached = { }
+            for node in frontier:
+                score = scores[node]
+                for target, weight in self.edges(node):
+                    score_t = score * weight
+                    if score_t > scores.get(target, 0) and score_t > reached.get(target, 0):
+                        reached[target] = score_t
+            if not reached:
+                break
+            scores.update(reached)
+            frontier = heapq.nlargest(width, reached, key=reached.get)
+        return self._result(scores, seeds, n)
+
+    def pagerank(self, artist_ids, n=10, restart=RESTART, epsilon=EPSILON):
+        """The n artists ranked highest by PageRank personalized to
+        artist_ids, as (artist id, score) pairs. The ranks are
+        approximated by pushing residual probability from node to node
+        until none holds more than epsilon per edge, which only visits
+        the part of the graph near the seeds.
+        """
+        seeds = self._seeds(artist_ids)
+        if not seeds:
+            return [ ]
+        ranks = { }
+        residual = dict.fromkeys(seeds, 1.0 / len(seeds))
+        queue = list(seeds)
+        while queue:
+            node = queue.pop()
+            mass = residual.pop(node, 0)
+            if not mass:
+                continue
+            edges = self.edges(node)
+            total = sum(weight for target, weight in edges)
+            if not total:
+                # nowhere to go: it all stays here
+                ranks[node] = ranks.get(node, 0) + mass
+                continue
+            ranks[node] = ranks.get(node, 0) + restart * mass
+            share = (1 - restart) * mass / total
+            for target, weight in edges:
+                before = residual.get(target, 0)
+                after = residual[target] = before + share * weight
+                threshold = epsilon * self.degree(target)
+                if after > threshold >= before:
+                    queue.append(target)
+        return self._result(ranks, seeds, n)
+
+    def degree(self, node):
+        """The number of edges of node."""
+        count = 0
+        if node + 1 < len(self.offsets):
+            count = self.offsets[node + 1] - self.offsets[node]
+        return max(count + len(self.overlay.get(node, ())), 1)
+
+# graphs by database, kept for the life of the process
+_graphs = { }
+
+def graph(lib):
+    """Return the up to date SimilarityGraph of lib."""
+    key = str(lib.db.url)
+    if key not in _graphs:
+        _graphs[key] = SimilarityGraph(lib)
+    g = _graphs[key]
+    g.lib = lib
+    g.refresh()
+    return g
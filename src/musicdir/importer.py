@@ -1,39 +1,65 @@
 import os, sys
+import re
 import codecs
 
 from musicdir.ui import print_
 from musicdir.util import *
 from musicdir.library import *
-from musicdir.mediafile import UnreadableFileError
+from musicdir.mediafile import MediaFile, UnreadableFileError
+
+AUDIO_RE = re.compile(r'\.(m4a|mp4|mp3|flac|ogg|ape|wv|mpc)$', re.I)
+ATTACHMENT_RE = re.compile(r'\.(nfo|cue|log|xml)$', re.I)
+COVER_RE = re.compile(r'(folder|cover|cd|front)\.(jpg|jpeg|png|bmp|tiff|svg)$', re.I)
+
+def artist_filter(name):
+    """The filter finding the artist called name. Artists are found by
+    search key (see library.search_key), so that "Beatles, The" finds
+    "The Beatles"; names without a key are matched as they are.
+    """
+    key = search_key(name)
+    if not key:
+        return Artist.name == name
+    return Artist.search_name == key
+
+def find_artist(session, name):
+    """The artist called name (the first found), or a new one."""
+    artist = session.query(Artist).filter(artist_filter(name)) \
+            .order_by(Artist.id).first()
+    if artist is None:
+        artist = Artist(name=name)
+    return artist
 
 def import_tracks(lib=None, files=[ ], attachments=[ ], cover=None):
     return [ import_track(lib=lib, file=file, attachments=attachments, cover=cover) for file in files ]
     
-def import_track(lib=None, file=None, attachments=[ ], cover=None):
+def import_track(lib=None, file=None, attachments=[ ], cover=None, mediafile=None):
+    """Add file to the library as a track. mediafile may hold the
+    file's already read tags; otherwise they are read here.
+    """
     if os.path.exists(file.path):
         session = lib.session
 
         # get trackfile if it exists
-        trackfile = session.query(TrackFile).filter(File.id == file.id).first()
+        trackfile = None
+        if file.id is not None:
+            trackfile = session.query(TrackFile).filter(TrackFile.file_id == file.id).first()
         if trackfile is not None \
             and trackfile.track is not None:
             return trackfile
 
         # read metadata in
-        f = MediaFile(file.path)
+        f = mediafile
+        if f is None:
+            f = MediaFile(file.path)
 
         # get / create artist
         artist = None
         if f.artist != None and len(f.artist) > 0:
-            artist = session.query(Artist).filter(Artist.name == f.artist).first()
-            if artist is None:
-                artist = Artist(name=f.artist)
+            artist = find_artist(session, f.artist)
 
         # album artist shall suffice if artist is not defined
         elif f.albumartist != None and len(f.albumartist) > 0:
-            artist = session.query(Artist).filter(Artist.name == f.albumartist).first()
-            if artist is None:
-                artist = Artist(name=f.albumartist)
+            artist = find_artist(session, f.albumartist)
         
         # get / create release
         release = None
@@ -50,16 +76,19 @@ def import_track(lib=None, file=None, attachments=[ ], cover=None):
 
             # get album artist
             if not f.comp and f.albumartist != None and len(f.albumartist) > 0:
-                filter = and_(filter, Artist.name == f.albumartist)
+                filter = and_(filter, artist_filter(f.albumartist))
 
             release = query.filter(filter).first()
             if release == None:
                 release = Release(name=f.album, tracktotal=f.tracktotal, disctotal=f.disctotal, compilation=f.comp)
                 
                 if f.albumartist != None and len(f.albumartist) > 0:
-                    release.artist = session.query(Artist).filter(Artist.name == f.albumartist).first()
-                    if release.artist is None:
-                        release.artist = Artist(name=f.albumartist)
+                    # the track's artist may be new, and not found yet
+                    key = search_key(f.albumartist)
+                    if artist is not None and key and key == artist.search_name:
+                        release.artist = artist
+                    else:
+                        release.artist = find_artist(session, f.albumartist)
 
         # get / create track
         track = None
@@ -109,4 +138,37 @@ def import_track(lib=None, file=None, attachments=[ ], cover=None):
 
         return trackfile
 
-
+def refresh_track(lib=None, trackfile=None, mediafile=None):
+    """Bring trackfile's track up to date with the tags of its file,
+    which have changed. If the artist, release or title changed, the
+    file is imported again as (possibly) another track; otherwise the
+    track is updated in place. Returns the track file.
+    """
+    file = trackfile.file
+    f = mediafile
+    if f is None:
+        f = MediaFile(file.path)
+    file.size = os.path.getsize(file.path)
+
+    track = trackfile.track
+    artist = track.artist.name if track is not None and track.artist is not None else None
+    release = track.release.name if track is not None and track.release is not None else None
+    if track is None or track.title != f.title \
+            or artist != (f.artist or f.albumartist or None) \
+            or release != (f.album or None):
+        attachments, cover = list(trackfile.attachments), trackfile.cover
+        lib.session.delete(trackfile)
+        lib.session.flush()
+        return import_track(lib=lib, file=file, attachments=attachments,
+                            cover=cover, mediafile=f)
+
+    track.genre = f.genre
+    track.track = f.track
+    track.disc = f.disc
+    track.length = f.length
+    track.bpm = f.bpm
+    track.composer = f.composer
+    track.date = f.date
+    trackfile.bitrate = f.bitrate
+    trackfile.format = f.format
+    return trackfile
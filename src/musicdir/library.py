@@ -17,32 +17,96 @@ import os
 import re
 import sys
 import time, datetime
+import array
 import hashlib
+import heapq
+import random
+import unicodedata
 from string import Template
 
 from sqlalchemy import *
 from sqlalchemy.orm import *
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.sql import table, column
 
 from musicdir.util import bytestring_path, syspath
-from musicdir.mediafile import MediaFile
 # }}} end imports
 
 metadata = MetaData()
 Session = scoped_session(sessionmaker())
 Base = declarative_base(metadata=metadata)
 
+PRESUM_SIZE = 2048
+CHECKSUM_BLOCK_SIZE = 64 * 1024
+
+def checksums(path):
+    """Return the SHA-1 of the file at path and its presum (the SHA-1
+    of the first PRESUM_SIZE bytes), reading the file only once.
+    """
+    full = hashlib.sha1()
+    with open(syspath(path), 'rb') as f:
+        head = f.read(PRESUM_SIZE)
+        full.update(head)
+        while True:
+            block = f.read(CHECKSUM_BLOCK_SIZE)
+            if not block:
+                break
+            full.update(block)
+    return full.hexdigest(), hashlib.sha1(head).hexdigest()
+
+# {{{ search keys
+# Letters search_key() spells out, where NFKD leaves them whole.
+SEARCH_FOLDS = { u'\xdf': u'ss', u'\xe6': u'ae', u'\u0153': u'oe',
+                 u'\xf8': u'o', u'\u0142': u'l', u'\u0111': u'd' }
+
+# Keys search_key() remembers before it starts over.
+SEARCH_MEMO_SIZE = 100000
+_search_keys = { }
+
+def search_key(text):
+    """text as get_filter compares it: decomposed (NFKD) without the
+    combining marks, lowercased, without punctuation, with symbols and
+    runs of spaces made one space, and with a "The" at either end
+    dropped, so that names are found without their accents and "Beatles,
+    The" finds "The Beatles". Keys are memoized.
+    """
+    if text is None:
+        return None
+    key = _search_keys.get(text)
+    if key is not None:
+        return key
+    if not isinstance(text, unicode):
+        text = text.decode('utf8', 'replace')
+    chars = [ ]
+    for c in unicodedata.normalize('NFKD', text).lower():
+        kind = unicodedata.category(c)[0]
+        if kind in 'LN':
+            chars.append(SEARCH_FOLDS.get(c, c))
+        elif kind not in 'MP':
+            chars.append(u' ')
+    words = u''.join(chars).split()
+    if len(words) > 1 and words[0] == u'the':
+        del words[0]
+    elif len(words) > 1 and words[-1] == u'the':
+        del words[-1]
+    key = u' '.join(words)
+    if len(_search_keys) >= SEARCH_MEMO_SIZE:
+        _search_keys.clear()
+    _search_keys[text] = key
+    return key
+# }}} end search keys
+
 # {{{ File(Base)
 class File(Base):
     __tablename__ = 'files'
 
     id = Column(Integer, primary_key=True)
     path = Column(BLOB)
-    size = Column(Integer)
+    size = Column(Integer, index=True)
     dateadded = Column(DateTime)
     sha1_checksum = Column(Text)
-    sha1_presum = Column(Text) # first 2048 bytes of file
+    sha1_presum = Column(Text) # first PRESUM_SIZE bytes of file
 
     def __init__(self, path=None, size=None, dateadded=None):
         self.path = path
@@ -59,8 +123,7 @@ class File(Base):
 
     def checksum(self):
         if self.exists():
-            self.sha1_checksum = hashlib.sha1(file(self.path, 'r').read()).hexdigest()
-            self.sha1_presum = hashlib.sha1(file(self.path, 'r').read(2048)).hexdigest()
+            self.sha1_checksum, self.sha1_presum = checksums(self.path)
         return self.sha1_checksum if self.sha1_checksum is not None else None
 # }}} end File(Base)
 
@@ -71,7 +134,7 @@ class Attachment(Base):
     id = Column(Integer, primary_key=True)
     name = Column(UnicodeText)
     description = Column(UnicodeText)
-    file_id = Column(Integer, ForeignKey(File.id))
+    file_id = Column(Integer, ForeignKey(File.id), index=True)
 
     file = relationship(File, primaryjoin=file_id == File.id)
 
@@ -156,12 +219,14 @@ class Artist(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(UnicodeText)
+    search_name = Column(UnicodeText, index=True) # search_key(name)
 
     attachments = relationship(Attachment, secondary=artist_attachments)
     tags = relationship(ArtistTag)
 
     def __init__(self, name=None):
         self.name = name
+        self.search_name = search_key(name)
 # }}} end Artist(Base)
 
 # {{{ SimilarArtist(Base)
@@ -185,9 +250,10 @@ class Release(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(UnicodeText)
+    search_name = Column(UnicodeText, index=True) # search_key(name)
     type = Column(UnicodeText)
-    artist_id = Column(Integer, ForeignKey(Artist.id))
-    date = Column(Date)
+    artist_id = Column(Integer, ForeignKey(Artist.id), index=True)
+    date = Column(Date, index=True)
     tracktotal = Column(Integer)
     disctotal = Column(Integer)
     compilation = Column(Boolean)
@@ -198,6 +264,7 @@ class Release(Base):
 
     def __init__(self, name=None, type=None, artist=None, date=None, tracktotal=None, disctotal=None, compilation=None):
         self.name = name
+        self.search_name = search_key(name)
         self.type = type
         self.artist = artist
         self.date = date
@@ -211,16 +278,22 @@ class Track(Base):
     __tablename__ = 'tracks'
 
     id = Column(Integer, primary_key=True)
-    artist_id = Column(Integer, ForeignKey(Artist.id))
-    release_id = Column(Integer, ForeignKey(Release.id))
+    artist_id = Column(Integer, ForeignKey(Artist.id), index=True)
+    release_id = Column(Integer, ForeignKey(Release.id), index=True)
     title = Column(UnicodeText)
+    search_title = Column(UnicodeText, index=True) # search_key(title)
     track = Column(Integer)
     disc = Column(Integer)
     genre = Column(UnicodeText)
-    date = Column(Date)
+    date = Column(Date, index=True)
     composer = Column(UnicodeText)
-    length = Column(Integer)
-    bpm = Column(Integer)
+    length = Column(Integer, index=True)
+    bpm = Column(Integer, index=True)
+    # kept by fill_sort_keys() for ls --sort (see SORT_ORDERS)
+    sort_artist = Column(UnicodeText)
+    sort_album = Column(UnicodeText)
+    added = Column(DateTime, index=True) # when its first file was added
+    bitrate = Column(Integer, index=True) # of its best file
 
     artist = relationship(Artist, primaryjoin=artist_id == Artist.id, backref='tracks')
     release = relationship(Release, primaryjoin=release_id == Release.id, backref='tracks')
@@ -232,18 +305,21 @@ class Track(Base):
         self.artist = artist
         self.release = release
         self.title = title
+        self.search_title = search_key(title)
         self.track = track
         self.disc = disc
         self.genre = genre
         self.date = date
         self.composer = composer
         self.length = length
+        self.bpm = bpm
     # }}} end __init__(self, ...)
 
     # {{{ write(self)
     def write(self):
         """Write the track's metadata to the associated file.
         """
+        from musicdir.mediafile import MediaFile
         for file in self.files:
             f = MediaFile(syspath(file.path))
             # TODO save values to mediafile
@@ -286,8 +362,8 @@ class TrackFile(Base):
     __tablename__ = 'track_files'
 
     id = Column(Integer, primary_key=True)
-    track_id = Column(Integer, ForeignKey(Track.id))
-    file_id = Column(Integer, ForeignKey(File.id))
+    track_id = Column(Integer, ForeignKey(Track.id), index=True)
+    file_id = Column(Integer, ForeignKey(File.id), index=True)
     cover_id = Column(Integer, ForeignKey(Attachment.id))
     bitrate = Column(Integer)
     format = Column(UnicodeText)
@@ -299,6 +375,445 @@ class TrackFile(Base):
 
 # }}} end TrackFile(Base)
 
+# {{{ ArtBlob(Base)
+class ArtBlob(Base):
+    """Index entry for a cover image in the content-addressed art
+    cache. The image itself lives on disk as the attachment's file;
+    identical images share a single blob.
+    """
+    __tablename__ = 'art_cache'
+
+    id = Column(Integer, primary_key=True)
+    sha1 = Column(String(40), index=True, unique=True)
+    size = Column(Integer)
+    accessed = Column(DateTime)
+    attachment_id = Column(Integer, ForeignKey(Attachment.id))
+
+    attachment = relationship(Attachment, primaryjoin=attachment_id == Attachment.id)
+
+    def __init__(self, sha1=None, size=None, attachment=None):
+        self.sha1 = sha1
+        self.size = size
+        self.attachment = attachment
+        self.accessed = datetime.datetime.utcnow()
+# }}} end ArtBlob(Base)
+
+# {{{ LibraryState(Base)
+class LibraryState(Base):
+    """The library's generation, a number that changes whenever
+    commands change the library, for caches of what it holds. The one
+    row starts from the time it was made, so that a library created
+    anew doesn't repeat the generations of an old one. edits counts
+    the changes other than adding tracks, after which caches that only
+    append what was added have to load again.
+    """
+    __tablename__ = 'library_state'
+
+    id = Column(Integer, primary_key=True)
+    generation = Column(Integer, nullable=False)
+    edits = Column(Integer, nullable=False, default=0)
+# }}} end LibraryState(Base)
+
+# {{{ schema versions
+# The schema version is stored in SQLite's user_version, so opening a
+# library that is up to date doesn't have to inspect every table. Bump
+# SCHEMA_VERSION whenever the schema changes: new tables are created by
+# create_all, but anything else (new columns on existing tables, new
+# indexes on them) needs an entry in MIGRATIONS, which maps a version
+# to the steps taking a database from the previous version to it. A
+# step is an SQL statement or a function called with the connection.
+# Steps run after create_all, also on new databases, so they must
+# cope with finding the change already made (CREATE INDEX IF NOT
+# EXISTS, add_column).
+SCHEMA_VERSION = 8
+
+def add_column(table, column):
+    """A migration step adding column (name and type, as in CREATE
+    TABLE) to table unless it already has the column.
+    """
+    def step(conn):
+        name = column.split()[0]
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(%s)' % table)]
+        if name not in columns:
+            conn.execute('ALTER TABLE %s ADD COLUMN %s' % (table, column))
+    return step
+
+# {{{ sort and search keys
+# Rows fill_sort_keys() and fill_search_keys() update at a time.
+FILL_BATCH = 5000
+
+def sort_name(name):
+    """name as listings sort it: lowercased, with runs of spaces made
+    one and a leading "The" dropped.
+    """
+    name = u' '.join((name or u'').lower().split())
+    if name.startswith(u'the '):
+        name = name[4:]
+    return name
+
+def _fill(conn, id, query, update, params):
+    """Run update (an executemany statement) over the rows of query,
+    a select led by the column id, FILL_BATCH rows at a time in id
+    order, with the parameters params() makes of each row. Returns the
+    number of rows updated.
+    """
+    count = last = 0
+    while True:
+        rows = conn.execute(query.where(id > last).order_by(id)
+                            .limit(FILL_BATCH)).fetchall()
+        if not rows:
+            return count
+        conn.execute(update, [ params(row) for row in rows ])
+        count += len(rows)
+        last = rows[-1][0]
+
+def fill_sort_keys(conn, ids=None):
+    """Compute the sort keys of the tracks in ids (a select of track
+    ids), or else of the tracks that have none yet. conn is a
+    Connection or Session. Returns the number of tracks updated.
+
+    sort_album orders by release name, release, disc and track number,
+    and sort_artist by artist name and then as sort_album, each as one
+    string, so that a single index covers it. added and bitrate copy
+    the earliest date added and the highest bitrate of the track's
+    files.
+    """
+    tracks, artists, releases = Track.__table__, Artist.__table__, Release.__table__
+    trackfiles, files = TrackFile.__table__, File.__table__
+    first_added = select([ func.min(files.c.dateadded) ],
+                         and_(trackfiles.c.track_id == tracks.c.id,
+                              files.c.id == trackfiles.c.file_id)).as_scalar()
+    best_bitrate = select([ func.max(trackfiles.c.bitrate) ],
+                          trackfiles.c.track_id == tracks.c.id).as_scalar()
+    joined = tracks.outerjoin(artists, artists.c.id == tracks.c.artist_id) \
+            .outerjoin(releases, releases.c.id == tracks.c.release_id)
+    where = tracks.c.sort_artist == None if ids is None else tracks.c.id.in_(ids)
+    query = select([ tracks.c.id, artists.c.name, releases.c.name,
+                     tracks.c.release_id, tracks.c.disc, tracks.c.track,
+                     first_added, best_bitrate ], where, from_obj=[ joined ])
+    update = tracks.update().where(tracks.c.id == bindparam('_id')).values(
+            sort_artist=bindparam('_artist'), sort_album=bindparam('_album'),
+            added=bindparam('_added', type_=tracks.c.added.type),
+            bitrate=bindparam('_bitrate'))
+
+    names = { }
+    def name(value):
+        if value not in names:
+            names[value] = sort_name(value)
+        return names[value]
+    def params(row):
+        id, artist, release, release_id, disc, track, added, bitrate = row
+        album = u'\x01'.join([ name(release), u'%010i' % (release_id or 0),
+                               u'%04i' % max(disc or 0, 0),
+                               u'%04i' % max(track or 0, 0) ])
+        return { '_id': id, '_artist': name(artist) + u'\x01' + album,
+                 '_album': album, '_added': added, '_bitrate': bitrate }
+    return _fill(conn, tracks.c.id, query, update, params)
+
+def fill_search_keys(conn, ids=None):
+    """Compute the search keys of the artists and releases that have
+    none yet, and of the tracks in ids (a select of track ids) or else
+    of the tracks that have none. conn is a Connection or Session.
+    Returns the number of rows updated.
+    """
+    count = 0
+    for table, text, key, where in (
+            (Artist.__table__, 'name', 'search_name', None),
+            (Release.__table__, 'name', 'search_name', None),
+            (Track.__table__, 'title', 'search_title', ids)):
+        if where is None:
+            where = table.c[key] == None
+        else:
+            where = table.c.id.in_(where)
+        update = table.update().where(table.c.id == bindparam('_id')) \
+                .values(**{ key: bindparam('_key') })
+        count += _fill(conn, table.c.id,
+                       select([ table.c.id, table.c[text] ], where), update,
+                       lambda row: { '_id': row[0], '_key': search_key(row[1]) })
+    return count
+
+# ls --sort orders: what each sorts tracks by (then by id), all indexed
+# in MIGRATIONS[4]. NULLs are replaced so that the keyset comparisons
+# of pages can step past them; the replacements are literals, or the
+# expressions wouldn't match those of the indexes.
+SORT_ORDERS = {
+    'artist': Track.sort_artist,
+    'album': Track.sort_album,
+    'date': func.ifnull(Track.date, literal_column("''")),
+    'added': func.ifnull(Track.added, literal_column("''")),
+    'length': func.ifnull(Track.length, literal_column('-1')),
+    'bitrate': func.ifnull(Track.bitrate, literal_column('-1')),
+}
+# }}} end sort and search keys
+
+MIGRATIONS = {
+    # 1: the art_cache table, created by create_all
+    2: [
+        # indexes on the foreign keys the listing joins go through
+        'CREATE INDEX IF NOT EXISTS ix_tracks_artist_id ON tracks (artist_id)',
+        'CREATE INDEX IF NOT EXISTS ix_tracks_release_id ON tracks (release_id)',
+        'CREATE INDEX IF NOT EXISTS ix_releases_artist_id ON releases (artist_id)',
+        'CREATE INDEX IF NOT EXISTS ix_track_files_track_id ON track_files (track_id)',
+        'CREATE INDEX IF NOT EXISTS ix_track_files_file_id ON track_files (file_id)',
+        'CREATE INDEX IF NOT EXISTS ix_attachments_file_id ON attachments (file_id)',
+    ],
+    # 3: the library_state table, created by create_all
+    4: [
+        # sort keys of tracks, and the indexes ls --sort pages through
+        add_column('tracks', 'sort_artist TEXT'),
+        add_column('tracks', 'sort_album TEXT'),
+        add_column('tracks', 'added DATETIME'),
+        add_column('tracks', 'bitrate INTEGER'),
+        'CREATE INDEX IF NOT EXISTS ix_tracks_sort_artist ON tracks (sort_artist)',
+        'CREATE INDEX IF NOT EXISTS ix_tracks_sort_album ON tracks (sort_album)',
+        "CREATE INDEX IF NOT EXISTS ix_tracks_sort_date ON tracks (ifnull(date, ''))",
+        "CREATE INDEX IF NOT EXISTS ix_tracks_sort_added ON tracks (ifnull(added, ''))",
+        'CREATE INDEX IF NOT EXISTS ix_tracks_sort_length ON tracks (ifnull(length, -1))',
+        'CREATE INDEX IF NOT EXISTS ix_tracks_sort_bitrate ON tracks (ifnull(bitrate, -1))',
+        fill_sort_keys,
+    ],
+    5: [
+        # search keys, which get_filter compares instead of the names
+        add_column('artists', 'search_name TEXT'),
+        add_column('releases', 'search_name TEXT'),
+        add_column('tracks', 'search_title TEXT'),
+        'CREATE INDEX IF NOT EXISTS ix_artists_search_name ON artists (search_name)',
+        'CREATE INDEX IF NOT EXISTS ix_releases_search_name ON releases (search_name)',
+        'CREATE INDEX IF NOT EXISTS ix_tracks_search_title ON tracks (search_title)',
+        fill_search_keys,
+    ],
+    6: [
+        # date ranges, which get_filter's date fields compare
+        'CREATE INDEX IF NOT EXISTS ix_tracks_date ON tracks (date)',
+        'CREATE INDEX IF NOT EXISTS ix_releases_date ON releases (date)',
+    ],
+    7: [
+        # the columns get_filter's range fields compare
+        'CREATE INDEX IF NOT EXISTS ix_tracks_length ON tracks (length)',
+        'CREATE INDEX IF NOT EXISTS ix_tracks_bpm ON tracks (bpm)',
+        'CREATE INDEX IF NOT EXISTS ix_tracks_bitrate ON tracks (bitrate)',
+        'CREATE INDEX IF NOT EXISTS ix_tracks_added ON tracks (added)',
+        'CREATE INDEX IF NOT EXISTS ix_files_size ON files (size)',
+    ],
+    8: [
+        # what the catalog checks before appending new tracks
+        add_column('library_state', 'edits INTEGER NOT NULL DEFAULT 0'),
+    ],
+}
+# }}} end schema versions
+
+# The share of rows range_filter() tells SQLite a range matches.
+RANGE_LIKELIHOOD = '0.001'
+
+def range_filter(column, low=None, high=None, likely=True):
+    """column >= low and < high, an end that is None left open. Without
+    statistics SQLite guesses that a range matches too much to be worth
+    an index, so with likely the terms are marked as matching few rows.
+    """
+    if likely:
+        hint = lambda term: func.likelihood(term, literal_column(RANGE_LIKELIHOOD))
+    else:
+        hint = lambda term: term
+    terms = [ ]
+    if low is not None:
+        terms.append(hint(column >= low))
+    if high is not None:
+        terms.append(hint(column < high))
+    return and_(*terms)
+
+def text_filter(column, key_column, value, exact=False):
+    """get_filter's match of value against a name or title column,
+    made on its search key column (see search_key): equal to the key
+    of value with exact, else starting with it if value ends in '*',
+    else containing it. The first two are range scans of the key's
+    index. A value without a key (only punctuation, say) is matched on
+    column itself.
+    """
+    prefix = not exact and value.endswith(u'*')
+    key = search_key(value[:-1] if prefix else value)
+    if not key:
+        return column == value if exact else column.like(u'%' + value + u'%')
+    if exact:
+        return key_column == key
+    elif prefix:
+        return range_filter(key_column, key,
+                            key[:-1] + unichr(ord(key[-1]) + 1))
+    return key_column.like(u'%' + key + u'%')
+
+# {{{ range fields
+def parse_range(text, span):
+    """The half-open range (low, high) of a range field's value: 'A..B'
+    (A through B, either end left out for an open range), '<A', '<=A',
+    '>A', '>=A' or just 'A'. span(value) gives the (low, high) of one
+    value, or None if it doesn't parse. Returns None if text doesn't.
+    """
+    text = text.strip()
+    m = re.match(r'^(.*?)\.\.(.*)$', text)
+    if m != None:
+        first, last = m.group(1).strip(), m.group(2).strip()
+        low = high = None
+        if first:
+            low = span(first)
+            if low is None:
+                return None
+            low = low[0]
+        if last:
+            high = span(last)
+            if high is None:
+                return None
+            high = high[1]
+        if low is None and high is None:
+            return None
+        return low, high
+    m = re.match(r'^(<=|>=|<|>)(.*)$', text)
+    op, value = (m.group(1), m.group(2).strip()) if m != None else (None, text)
+    one = span(value)
+    if one is None:
+        return None
+    low, high = one
+    return { None: (low, high), '<': (None, low), '<=': (None, high),
+             '>': (high, None), '>=': (low, None) }[op]
+
+DATE_RE = re.compile(r'^(\d{4})(?:-(\d{1,2})(?:-(\d{1,2}))?)?$')
+
+def date_span(text):
+    """The first day of the year, month or day text names (YYYY,
+    YYYY-MM or YYYY-MM-DD) and the first day after it, or None.
+    """
+    m = DATE_RE.match(text)
+    if m is None:
+        return None
+    year, month, day = [ int(g) if g else None for g in m.groups() ]
+    try:
+        if day is not None:
+            first = datetime.date(year, month, day)
+            return first, first + datetime.timedelta(days=1)
+        elif month is not None:
+            first = datetime.date(year, month, 1)
+            if month == 12:
+                return first, datetime.date(year + 1, 1, 1)
+            return first, datetime.date(year, month + 1, 1)
+        return datetime.date(year, 1, 1), datetime.date(year + 1, 1, 1)
+    except ValueError:
+        return None
+
+def datetime_span(text):
+    """date_span as times: from midnight of the first day to midnight
+    of the day after.
+    """
+    span = date_span(text)
+    if span is None:
+        return None
+    return tuple(datetime.datetime.combine(day, datetime.time())
+                 for day in span)
+
+def number_span(text):
+    """(n, n + 1) for the whole number text, or None."""
+    if not re.match(r'^\d+$', text):
+        return None
+    return int(text), int(text) + 1
+
+# The date fields of get_filter: the list of filters they go to, how a
+# value parses and the part of the date they match (None for the date
+# itself, else a strftime format).
+DATE_FIELDS = {
+    'year': ('year', date_span, None),
+    'date': ('year', date_span, None),
+    'month': ('month', number_span, '%m'),
+    'day': ('day', number_span, '%d'),
+}
+
+def date_filter(column, name, value, likely=True):
+    """get_filter's match of a date field (see DATE_FIELDS) against the
+    date column, or None if value doesn't parse. year:1999 (or =) is
+    the range from 1999-01-01 up to 2000-01-01 and year:1990..1999 the
+    range up to 2000-01-01, which the column's index answers; month
+    and day compare that part of the date (month:6..8 is summer), which
+    no index can. likely is passed on to range_filter.
+    """
+    group, span, part = DATE_FIELDS[name]
+    bounds = parse_range(value, span)
+    if bounds is None:
+        return None
+    if part is None:
+        return range_filter(column, *bounds, likely=likely)
+    return range_filter(cast(func.strftime(part, column), Integer), *bounds,
+                        likely=False)
+
+def release_tracks(name, value):
+    """get_filter's match of a date field for releases, which have no
+    dates of their own (nothing fills Release.date): an EXISTS over
+    their tracks, on an alias of tracks so that it doesn't correlate
+    with the tracks the release queries join. None if value doesn't
+    parse. The range isn't hinted as likely, or SQLite would search the
+    date's index for every release instead of the release's tracks.
+    """
+    tracks = Track.__table__.alias('dated_tracks')
+    match = date_filter(tracks.c.date, name, value, likely=False)
+    if match is None:
+        return None
+    return exists().where(and_(tracks.c.release_id == Release.id, match))
+
+def file_tracks(match):
+    """The tracks with a file that matches, found from the files: the
+    queries reach files through outer joins, which SQLite won't start
+    from, so an index on files would go unused there.
+    """
+    joined = TrackFile.__table__.join(File.__table__,
+                                      File.id == TrackFile.file_id)
+    return Track.id.in_(select([ TrackFile.track_id ], match,
+                               from_obj=[ joined ]))
+
+# The range fields of get_filter: the column each compares, how a
+# value parses (bitrate:<128000, length:300..600, added:>2026-10-01)
+# and, for columns of files, file_tracks. bitrate and added are those
+# of a track's best and first file, which fill_sort_keys copies onto
+# the track, so only size looks at the files.
+RANGE_FIELDS = {
+    'length': (Track.length, number_span, None),
+    'bpm': (Track.bpm, number_span, None),
+    'bitrate': (Track.bitrate, number_span, None),
+    'size': (File.size, number_span, file_tracks),
+    'added': (Track.added, datetime_span, None),
+}
+
+def number_filter(name, value):
+    """get_filter's match of a range field (see RANGE_FIELDS), a range
+    scan of the column's index, or None if value doesn't parse.
+    """
+    column, span, via = RANGE_FIELDS[name]
+    bounds = parse_range(value, span)
+    if bounds is None:
+        return None
+    match = range_filter(column, *bounds)
+    return match if via is None else via(match)
+# }}} end range fields
+
+# what get_filter's tag matches look up in the tag index
+TAG_KINDS = { Track: 'tracks', Release: 'releases', Artist: 'artists' }
+
+# Rounds of random ids sample_ids() draws before it gives up on
+# guessing ids and reads them all instead.
+SAMPLE_ROUNDS = 8
+
+def reservoir(pairs, n, rnd):
+    """Choose n of the (id, weight) pairs, each with probability in
+    proportion to its weight, in one pass that keeps only n of them
+    (weighted reservoir sampling: the n largest random**(1/weight)).
+    Pairs without a positive weight are never chosen. Returns the ids
+    in random order.
+    """
+    heap = [ ]
+    for id, weight in pairs:
+        if not weight or weight <= 0:
+            continue
+        key = rnd.random() ** (1.0 / weight)
+        if len(heap) < n:
+            heapq.heappush(heap, (key, id))
+        elif key > heap[0][0]:
+            heapq.heapreplace(heap, (key, id))
+    return [ id for key, id in sorted(heap, reverse=True) ]
+
 # {{{ BaseLibrary
 class BaseLibrary(object):
     """Abstract BaseLibrary class for music libraries"""
@@ -344,13 +859,16 @@ class Library(BaseLibrary):
     # {{{ __init__(self, dburi, path, directory, path_format)
     def __init__(self, dburi='sqlite:///musicdir.db',
                        directory='~/Music',
-                       path_formats=None):
+                       path_formats=None,
+                       query_cache=None):
         self.directory = bytestring_path(directory)
         if path_formats is None:
             path_formats = {'default': '$artist/$album/$track $title'}
         elif isinstance(path_formats, basestring):
             path_formats = {'default': path_formats}
         self.path_formats = path_formats
+        # a QueryCache for tracks() and releases(), or None
+        self.query_cache = query_cache
 
         # setup database connections
         self.db = create_engine(dburi)
@@ -359,10 +877,289 @@ class Library(BaseLibrary):
         self.session = Session()
 
         # make sure that the database tables are created
-        metadata.create_all(self.db)
+        self.setup_schema()
 
     # }}} end __init__(self, path, directory, path_format, art_filename)
 
+    def setup_schema(self):
+        """Create the tables and bring an older database up to the
+        current schema version. Does nothing for an SQLite database
+        that is up to date.
+        """
+        if self.db.dialect.name != 'sqlite':
+            metadata.create_all(self.db)
+            return
+
+        conn = self.db.connect()
+        try:
+            version = conn.execute('PRAGMA user_version').scalar()
+            if version >= SCHEMA_VERSION:
+                return
+            trans = conn.begin()
+            metadata.create_all(conn)
+            for v in range(version + 1, SCHEMA_VERSION + 1):
+                for step in MIGRATIONS.get(v, ()):
+                    if callable(step):
+                        step(conn)
+                    else:
+                        conn.execute(step)
+            conn.execute('PRAGMA user_version = %i' % SCHEMA_VERSION)
+            trans.commit()
+        finally:
+            conn.close()
+
+    def generation(self):
+        """The library's generation (see LibraryState)."""
+        state = LibraryState.__table__
+        return self.session.execute(select([ state.c.generation ],
+                                           state.c.id == 1)).scalar()
+
+    def edits(self):
+        """The library's count of edits (see LibraryState)."""
+        state = LibraryState.__table__
+        return self.session.execute(select([ state.c.edits ],
+                                           state.c.id == 1)).scalar() or 0
+
+    def bump_generation(self, edited=True):
+        """Mark the library as changed, in the session's transaction.
+        Everything that adds, changes or removes tracks calls this, so
+        that cached query results of the old generation are dropped.
+        edited=False says that tracks were only added, none changed or
+        removed.
+        """
+        state = LibraryState.__table__
+        edits = 1 if edited else 0
+        if not self.session.execute(state.update().where(state.c.id == 1)
+                .values(generation=state.c.generation + 1,
+                        edits=state.c.edits + edits)).rowcount:
+            self.session.execute(state.insert().values(id=1,
+                    generation=int(time.time() * 1000), edits=edits))
+
+    def update_keys(self, ids=(), query=None):
+        """Recompute the sort and search keys of the tracks with ids (or
+        selected by query), and compute those of new artists, releases
+        and tracks, in the session's transaction. Whatever changes
+        tracks' titles, artists, releases, numbers or files calls this.
+        """
+        self.session.flush()
+        ids = list(ids)
+        if ids or query is not None:
+            tracks = self.id_set('key_tracks', ids, query)
+            fill_sort_keys(self.session, tracks)
+            fill_search_keys(self.session, tracks)
+        fill_sort_keys(self.session)
+        fill_search_keys(self.session)
+
+    def known_paths(self, paths):
+        """Return the set of paths that already belong to a File in the
+        library. Uses its own connection, so it is safe to call from
+        threads other than the one owning the session.
+        """
+        known = set()
+        paths = list(paths)
+        # stay below SQLite's limit on bound parameters
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i+500]
+            rows = self.db.execute(select([File.path], File.path.in_(chunk)))
+            known.update(str(row[0]) for row in rows)
+        return known
+
+    def set_paths(self, paths):
+        """Point files at new paths. paths is a list of (id, path)
+        pairs; the updates are sent as executemany statements in the
+        session's transaction.
+        """
+        files = File.__table__
+        # a bare bindparam would bind str paths as TEXT, which never
+        # compares equal to the BLOBs stored by the ORM
+        update = files.update().where(files.c.id == bindparam('_id')) \
+                .values(path=bindparam('_path', type_=files.c.path.type))
+        params = [ {'_id': id, '_path': path} for id, path in paths ]
+        if params:
+            self.bump_generation()
+        for i in range(0, len(params), 500):
+            self.session.execute(update, params[i:i+500])
+        return len(params)
+
+    def id_set(self, name, ids=(), query=None, clear=True):
+        """Fill the temporary table name (created on first use) with
+        ids and the ids selected by query (which must not take
+        parameters), returning a select of them to use in IN clauses.
+        Statements over thousands of ids read them from here instead of
+        each binding thousands of parameters. With clear=False, the ids
+        are added to those already in the table. The table lives in the
+        session's connection, so use it within a transaction.
+        """
+        session = self.session
+        session.execute('CREATE TEMPORARY TABLE IF NOT EXISTS %s (id INTEGER)' % name)
+        if clear:
+            session.execute('DELETE FROM %s' % name)
+        if query is not None:
+            session.execute('INSERT INTO %s (id) %s' %
+                            (name, query.compile(dialect=self.db.dialect)))
+        ids = [ {'id': id} for id in ids ]
+        if ids:
+            session.execute(text('INSERT INTO %s (id) VALUES (:id)' % name), ids)
+        return select([ column('id') ], from_obj=[ table(name) ])
+
+    def forget_files(self, ids=(), query=None):
+        """Delete the files with the given ids (or selected by query)
+        from the library, along with their track files and the
+        attachments made of them (tracks, releases and artists are left
+        alone). Runs set-based statements in the session's transaction.
+        Returns the number of files deleted.
+        """
+        session = self.session
+        chunk = self.id_set('forget_files', ids, query)
+        trackfiles = select([TrackFile.id], TrackFile.file_id.in_(chunk))
+        # whose added and bitrate may change
+        tracks = self.id_set('forget_tracks', query=select([TrackFile.track_id],
+                TrackFile.file_id.in_(chunk)))
+        attachments = select([Attachment.id], Attachment.file_id.in_(chunk))
+        session.execute(track_file_attachments.delete().where(or_(
+                track_file_attachments.c.track_file_id.in_(trackfiles),
+                track_file_attachments.c.attachment_id.in_(attachments))))
+        for t in (track_attachments, release_attachments, artist_attachments):
+            session.execute(t.delete().where(t.c.attachment_id.in_(attachments)))
+        session.execute(TrackFile.__table__.update()
+                .where(TrackFile.cover_id.in_(attachments))
+                .values(cover_id=None))
+        session.execute(ArtBlob.__table__.delete()
+                .where(ArtBlob.attachment_id.in_(attachments)))
+        session.execute(TrackFile.__table__.delete()
+                .where(TrackFile.file_id.in_(chunk)))
+        session.execute(Attachment.__table__.delete()
+                .where(Attachment.file_id.in_(chunk)))
+        count = session.execute(File.__table__.delete()
+                .where(File.id.in_(chunk))).rowcount
+        if count:
+            self.update_keys(query=tracks)
+            self.bump_generation()
+        # loaded objects may refer to deleted rows
+        session.expire_all()
+        return count
+
+    def track_paths(self, ids):
+        """Return the paths of the files of the tracks with the given
+        ids.
+        """
+        paths = [ ]
+        ids = list(ids)
+        for i in range(0, len(ids), 500):
+            query = select([File.path], TrackFile.track_id.in_(ids[i:i+500]),
+                           from_obj=[ TrackFile.__table__.join(File.__table__,
+                                      File.id == TrackFile.file_id) ])
+            paths.extend(str(row[0]) for row in self.session.execute(query)
+                         if row[0] is not None)
+        return paths
+
+    def remove_tracks(self, ids):
+        """Delete the tracks with the given ids from the library, along
+        with their files and tags, and then the releases, artists, tags
+        and attachments left without anything referring to them. Runs
+        set-based statements in the session's transaction. Returns a
+        dictionary counting the deleted rows by kind.
+        """
+        session = self.session
+        counts = { }
+        tracks = self.id_set('remove_tracks', ids)
+        trackfiles = select([TrackFile.id], TrackFile.track_id.in_(tracks))
+
+        # what may be left orphaned
+        releases = self.id_set('remove_releases', query=select([Track.release_id],
+                Track.id.in_(tracks)))
+        artists = self.id_set('remove_artists', query=select([Track.artist_id],
+                Track.id.in_(tracks)))
+        tags = self.id_set('remove_tags', query=select([TrackTag.tag_id],
+                TrackTag.track_id.in_(tracks)))
+        attachments = self.id_set('remove_attachments',
+                query=select([track_attachments.c.attachment_id],
+                             track_attachments.c.track_id.in_(tracks)))
+        self.id_set('remove_attachments', query=select(
+                [track_file_attachments.c.attachment_id],
+                track_file_attachments.c.track_file_id.in_(trackfiles)),
+                clear=False)
+
+        counts['files'] = self.forget_files(query=select([TrackFile.file_id],
+                TrackFile.track_id.in_(tracks)))
+        session.execute(track_file_attachments.delete().where(
+                track_file_attachments.c.track_file_id.in_(trackfiles)))
+        session.execute(TrackFile.__table__.delete()
+                .where(TrackFile.track_id.in_(tracks)))
+        session.execute(track_attachments.delete()
+                .where(track_attachments.c.track_id.in_(tracks)))
+        session.execute(TrackTag.__table__.delete()
+                .where(TrackTag.track_id.in_(tracks)))
+        counts['tracks'] = session.execute(Track.__table__.delete()
+                .where(Track.id.in_(tracks))).rowcount
+
+        # releases without tracks
+        orphans = self.id_set('orphan_releases', query=select([Release.id],
+                and_(Release.id.in_(releases),
+                     not_(exists().where(Track.release_id == Release.id)))))
+        self.id_set('remove_artists', query=select([Release.artist_id],
+                Release.id.in_(orphans)), clear=False)
+        self.id_set('remove_tags', query=select([ReleaseTag.tag_id],
+                ReleaseTag.release_id.in_(orphans)), clear=False)
+        self.id_set('remove_attachments', query=select(
+                [release_attachments.c.attachment_id],
+                release_attachments.c.release_id.in_(orphans)), clear=False)
+        session.execute(release_attachments.delete()
+                .where(release_attachments.c.release_id.in_(orphans)))
+        session.execute(ReleaseTag.__table__.delete()
+                .where(ReleaseTag.release_id.in_(orphans)))
+        counts['releases'] = session.execute(Release.__table__.delete()
+                .where(Release.id.in_(orphans))).rowcount
+
+        # artists without tracks or releases
+        orphans = self.id_set('orphan_artists', query=select([Artist.id],
+                and_(Artist.id.in_(artists),
+                     not_(exists().where(Track.artist_id == Artist.id)),
+                     not_(exists().where(Release.artist_id == Artist.id)))))
+        self.id_set('remove_tags', query=select([ArtistTag.tag_id],
+                ArtistTag.artist_id.in_(orphans)), clear=False)
+        self.id_set('remove_attachments', query=select(
+                [artist_attachments.c.attachment_id],
+                artist_attachments.c.artist_id.in_(orphans)), clear=False)
+        session.execute(artist_attachments.delete()
+                .where(artist_attachments.c.artist_id.in_(orphans)))
+        session.execute(ArtistTag.__table__.delete()
+                .where(ArtistTag.artist_id.in_(orphans)))
+        session.execute(SimilarArtist.__table__.delete().where(or_(
+                SimilarArtist.artist_id.in_(orphans),
+                SimilarArtist.similar_artist_id.in_(orphans))))
+        counts['artists'] = session.execute(Artist.__table__.delete()
+                .where(Artist.id.in_(orphans))).rowcount
+
+        # tags nothing is tagged with
+        counts['tags'] = session.execute(Tag.__table__.delete().where(and_(
+                Tag.id.in_(tags),
+                not_(exists().where(TrackTag.tag_id == Tag.id)),
+                not_(exists().where(ReleaseTag.tag_id == Tag.id)),
+                not_(exists().where(ArtistTag.tag_id == Tag.id))))).rowcount
+
+        # attachments nothing refers to (cover art stays in the art
+        # cache, which expires it itself)
+        used = [ exists().where(t.c.attachment_id == Attachment.id)
+                 for t in (track_attachments, track_file_attachments,
+                           release_attachments, artist_attachments) ]
+        used.append(exists().where(TrackFile.cover_id == Attachment.id))
+        used.append(exists().where(ArtBlob.attachment_id == Attachment.id))
+        orphans = self.id_set('orphan_attachments', query=select([Attachment.id],
+                and_(Attachment.id.in_(attachments), not_(or_(*used)))))
+        files = self.id_set('orphan_files', query=select([Attachment.file_id],
+                Attachment.id.in_(orphans)))
+        counts['attachments'] = session.execute(Attachment.__table__.delete()
+                .where(Attachment.id.in_(orphans))).rowcount
+        session.execute(File.__table__.delete().where(and_(File.id.in_(files),
+                not_(exists().where(Attachment.file_id == File.id)),
+                not_(exists().where(TrackFile.file_id == File.id)))))
+
+        if counts['tracks']:
+            self.bump_generation()
+        session.expire_all()
+        return counts
+
     # {{{ get_filter(self, obj=None, query=None, fields=None)
     def get_filter(self, obj=None, query=None, fields=None, limit=None):
         """Transform a field into a filter using python regex
@@ -377,72 +1174,79 @@ class Library(BaseLibrary):
             return query
         
         # for or'ing and and'ing together later
-        filters = { 'releases' : [ ], 'artists' : [ ], 'tracks' : [ ], 'paths' : [ ],  'tags' : [ ], 'other' : [ ], 'year' : [ ], 'day' : [ ], 'month' : [ ] }
+        filters = { 'releases' : [ ], 'artists' : [ ], 'tracks' : [ ], 'paths' : [ ],  'tags' : [ ], 'untagged' : [ ], 'other' : [ ], 'year' : [ ], 'day' : [ ], 'month' : [ ] }
+        for name in RANGE_FIELDS:
+            filters[name] = [ ]
 
         for field in fields:
+            # date matches: year=1999, date:1999-05..1999-08, month:6..8
+            m = re.match(r'^(.*?)[:=](.*?)$', field)
+            if m != None and m.group(1).lower() in DATE_FIELDS:
+                if obj is Release:
+                    match = release_tracks(m.group(1).lower(), m.group(2))
+                else:
+                    match = date_filter(Track.date, m.group(1).lower(), m.group(2))
+                if match is not None:
+                    filters[DATE_FIELDS[m.group(1).lower()][0]].append(match)
+                    continue
+
+            # range matches: bitrate:<128000, length:300..600
+            if m != None and m.group(1).lower() in RANGE_FIELDS:
+                match = number_filter(m.group(1).lower(), m.group(2))
+                if match is not None:
+                    filters[m.group(1).lower()].append(match)
+                    continue
+
             # like matches
             m = re.match(r'^(.*?):(.*?)$', field)
             if m != None:
                 if re.match(r'^(album|release)$', m.group(1), re.I):
-                    filters['releases'].append( Release.name.like('%' + m.group(2) + '%') )
+                    filters['releases'].append(text_filter(Release.name, Release.search_name, m.group(2)))
                     continue
                 elif re.match(r'^(artist|author)$', m.group(1), re.I):
-                    filters['artists'].append( Artist.name.like('%' + m.group(2) + '%') )
+                    filters['artists'].append(text_filter(Artist.name, Artist.search_name, m.group(2)))
                     continue
                 elif re.match(r'^(title|track)$', m.group(1), re.I):
-                    filters['tracks'].append( Track.title.like('%' + m.group(2) + '%') )
+                    filters['tracks'].append(text_filter(Track.title, Track.search_title, m.group(2)))
                     continue
                 elif m.group(1).lower() == 'path':
                     filters['paths'].append( File.path.like('%' + m.group(2) + '%') )
                     continue
-                elif m.group(1).lower() == 'year':
-                    filters['year'].append(func.year(Track.date).like('%' + m.group(2) + '%'))
-                    continue
-                elif m.group(1).lower() == 'day':
-                    filters['day'].append(func.day(Track.date).like('%' + m.group(2) + '%'))
-                    continue
-                elif m.group(1).lower() == 'month':
-                    filters['month'].append(func.month(Track.date).like('%' + m.group(2) + '%'))
-                    continue
 
             # exact matches
             m = re.match(r'^(.*?)=(.*?)$', field)
             if m != None:
                 if re.match(r'^(album|release)$', m.group(1), re.I):
-                    filters['releases'].append( Release.name == m.group(2) )
+                    filters['releases'].append(text_filter(Release.name, Release.search_name, m.group(2), True))
                     continue
                 elif re.match(r'^(artist|author)$', m.group(1), re.I):
-                    filters['artists'].append( Artist.name == m.group(2) )
+                    filters['artists'].append(text_filter(Artist.name, Artist.search_name, m.group(2), True))
                     continue
                 elif re.match(r'^(title|track)$', m.group(1), re.I):
-                    filters['tracks'].append( Track.title == m.group(2) )
+                    filters['tracks'].append(text_filter(Track.title, Track.search_title, m.group(2), True))
                     continue
                 elif re.match(r'^path$', m.group(1), re.I):
                     filters['paths'].append( File.path == m.group(2) )
                     continue
-                elif m.group(1).lower() == 'year':
-                    filters['year'].append(func.year(Track.date) == m.group(2))
-                    continue
-                elif m.group(1).lower() == 'day':
-                    filters['day'].append(func.day(Track.date) == m.group(2))
-                    continue
-                elif m.group(1).lower() == 'month':
-                    filters['month'].append(func.month(Track.date) == m.group(2))
-                    continue
 
-            # tag matches
+            # tag matches: +a (tagged a), +a|b (tagged a or b) and ^a
+            # (not tagged a), answered from the tag index
             m = re.match(r'^\+(.*?)$', field)
             if m != None:
-                filters['tags'].append( Tag.name == m.group(1) )
+                filters['tags'].append(m.group(1).split('|'))
+                continue
+            m = re.match(r'^\^(.*?)$', field)
+            if m != None:
+                filters['untagged'].append(m.group(1))
                 continue
 
             # TODO add more regex filters
             # TODO OR tags together, this means we need to be passed a list instead
             # TODO add singleton:(1|true) like boolean value filters
-            filters['other'].append( 
-                    or_(Artist.name.like('%' + field + '%') \
-                            , or_(Release.name.like('%' + field + '%') \
-                            , Track.title.like('%' + field + '%') ) ) )
+            filters['other'].append(or_(
+                    text_filter(Artist.name, Artist.search_name, field),
+                    text_filter(Release.name, Release.search_name, field),
+                    text_filter(Track.title, Track.search_title, field)))
             continue
         
         # finalize filters
@@ -467,10 +1271,15 @@ class Library(BaseLibrary):
         elif len(filters['paths']) > 1:
             query = query.filter(or_(*filters['paths']) )
 
-        if len(filters['tags']) == 1:
-            query = query.filter(filters['tags'][0] )
-        elif len(filters['tags']) > 1:
-            query = query.filter(or_(*filters['tags']) )
+        if filters['tags'] or filters['untagged']:
+            from musicdir import tagindex
+            index = tagindex.index(self, TAG_KINDS[obj])
+            if filters['tags']:
+                ids = index.match(filters['tags'], filters['untagged'])
+                query = query.filter(obj.id.in_(self.id_set('tag_matches', ids)))
+            else:
+                ids = index.any_of(filters['untagged'])
+                query = query.filter(not_(obj.id.in_(self.id_set('tag_matches', ids))))
 
         if len(filters['day']) == 1:
             query = query.filter(filters['day'][0] )
@@ -487,15 +1296,16 @@ class Library(BaseLibrary):
         elif len(filters['year']) > 1:
             query = query.filter(or_(*filters['year']) )
 
+        for name in RANGE_FIELDS:
+            if len(filters[name]) == 1:
+                query = query.filter(filters[name][0] )
+            elif len(filters[name]) > 1:
+                query = query.filter(or_(*filters[name]) )
 
         if len(filters['other']) == 1:
             query = query.filter(filters['other'][0] )
         elif len(filters['other']) > 1:
             query = query.filter(and_(*filters['other']) )
-        
-        # add having clause if needed
-        if len(filters['tags']) > 1:
-            query = query.having(func.count(obj.id) >= len(filters['tags']) )
 
         return query
     # }}} end get_filter(self, obj=None, query=None, fields=None)
@@ -520,9 +1330,7 @@ class Library(BaseLibrary):
                     outerjoin(Track, Track.artist_id == Artist.id).\
                     outerjoin(Release, Release.id == Track.release_id).\
                     outerjoin(TrackFile, TrackFile.track_id == Track.id).\
-                    outerjoin(File, File.id == TrackFile.file_id).\
-                    outerjoin(ArtistTag, ArtistTag.artist_id == Artist.id).\
-                    outerjoin(Tag, ArtistTag.tag_id == Tag.id)
+                    outerjoin(File, File.id == TrackFile.file_id)
 
             query = self.get_filter(obj=Artist, query=query, fields=fields)
             return query.group_by(Artist.id).all()
@@ -532,45 +1340,198 @@ class Library(BaseLibrary):
     def release(self, release_id):
         return self.session.query(Release).filter(Release.id == release_id).first()
 
+    def release_query(self, fields=None, entity=Release):
+        """The query behind releases(), selecting entity (which may be
+        a column, such as Release.id) for each matching release.
+        """
+        # TODO: add support for various artist release search
+        query = self.session.query(entity).\
+                outerjoin(Artist, Artist.id == Release.artist_id).\
+                outerjoin(Track, Track.release_id == Release.id).\
+                outerjoin(TrackFile, TrackFile.track_id == Track.id).\
+                outerjoin(File, File.id == TrackFile.file_id)
+        query = self.get_filter(obj=Release, query=query, fields=fields)
+        return query.group_by(Release.id)
+
     def releases(self, fields=None):
         """Return a list of release objects from the database base on fields
         If no fields then return all releases in database
         """
-        # TODO: add support for various artist release search
-        if filter is not None:
-            query = self.session.query(Release).\
-                    outerjoin(Artist, Artist.id == Release.artist_id).\
-                    outerjoin(Track, Track.release_id == Release.id).\
-                    outerjoin(TrackFile, TrackFile.track_id == Track.id).\
-                    outerjoin(File, File.id == TrackFile.file_id).\
-                    outerjoin(ReleaseTag, ReleaseTag.release_id == Release.id).\
-                    outerjoin(Tag, ReleaseTag.tag_id == Tag.id)
-            query = self.get_filter(obj=Release, query=query, fields=fields)
-            return query.group_by(Release.id).all()
-        else:
-            return self.session.query(Release).group_by(Release.id).all()
+        return self._cached_objects('releases', Release, self.release_query, fields)
+
+    def release_ids(self, fields=None):
+        """Like releases(), but return the ids only."""
+        return self._cached_ids('releases', Release, self.release_query, fields)
 
     def track(self, track_id):
         return self.session.query(Track).filter(Track.id == track_id).first()
 
+    def track_query(self, fields=None, entity=Track):
+        """The query behind tracks(), selecting entity (which may be a
+        column, such as Track.id) for each matching track.
+        """
+        # TODO: add support for featured artist track search
+        query = self.session.query(entity).\
+                outerjoin(Artist, Artist.id == Track.artist_id).\
+                outerjoin(Release, Release.id == Track.release_id).\
+                outerjoin(TrackFile, TrackFile.track_id == Track.id).\
+                outerjoin(File, File.id == TrackFile.file_id)
+        query = self.get_filter(obj=Track, query=query, fields=fields)
+        return query.group_by(Track.id)
+
+    def track_page(self, fields=None, order='artist', limit=None, after=None):
+        """Return the tracks matching fields sorted by order (one of
+        SORT_ORDERS), at most limit of them, starting after the track
+        with id after. A page seeks to its first track in the order's
+        index and reads on from there (keyset pagination), so the last
+        page costs what the first does; the matching ids come from
+        track_ids(), which caches them.
+        """
+        if order not in SORT_ORDERS:
+            raise ValueError('unknown sort order: %s' % order)
+        key = SORT_ORDERS[order]
+        query = self.session.query(Track)
+        if fields:
+            query = query.filter(Track.id.in_(self.id_set('page_tracks',
+                                                          self.track_ids(fields))))
+        def page(query, limit):
+            if limit is not None:
+                query = query.limit(limit)
+            return query.all()
+        if after is None:
+            return page(query.order_by(key, Track.id), limit)
+
+        start = self.session.query(key).filter(Track.id == after).first()
+        if start is None:
+            raise ValueError('no track %i' % after)
+        # the rest of the tracks sharing after's key, then those with
+        # greater keys: two seeks in the index, where comparing (key,
+        # id) pairs would scan every track sharing the key
+        value = literal(start[0])
+        tracks = page(query.filter(and_(key == value, Track.id > after))
+                      .order_by(Track.id), limit)
+        if limit is None or len(tracks) < limit:
+            tracks.extend(page(query.filter(key > value).order_by(key, Track.id),
+                               None if limit is None else limit - len(tracks)))
+        return tracks
+
     def tracks(self, fields=None):
         """Return a list of track objects from the database base on fields
         If no fields then return all tracks in database
         """
-        # TODO: add support for featured artist track search
-        if filter is not None:
-            query = self.session.query(Track).\
-                    outerjoin(Artist, Artist.id == Track.artist_id).\
-                    outerjoin(Release, Release.id == Track.release_id).\
-                    outerjoin(TrackFile, TrackFile.track_id == Track.id).\
-                    outerjoin(File, File.id == TrackFile.file_id).\
-                    outerjoin(TrackTag, TrackTag.track_id == Track.id).\
-                    outerjoin(Tag, TrackTag.tag_id == Tag.id)
+        return self._cached_objects('tracks', Track, self.track_query, fields)
 
-            query = self.get_filter(obj=Track, query=query, fields=fields)
-            return query.group_by(Track.id).all()
-        else:
-            return self.session.query(Track).group_by(Track.id).all()
+    def track_ids(self, fields=None):
+        """Like tracks(), but return the ids only."""
+        return self._cached_ids('tracks', Track, self.track_query, fields)
+
+    def _cached_ids(self, kind, obj, query, fields):
+        """The ids of the obj objects that query (release_query or
+        track_query) finds for fields, from the query cache if it has
+        them.
+        """
+        cache = self.query_cache
+        if cache is None:
+            return [ id for (id,) in query(fields, obj.id) ]
+        generation = self.generation()
+        ids = cache.get(generation, self.db.url, kind, fields)
+        if ids is None:
+            ids = [ id for (id,) in query(fields, obj.id) ]
+            cache.put(generation, self.db.url, kind, fields, ids)
+        return ids
+
+    def _cached_objects(self, kind, obj, query, fields):
+        """Like _cached_ids(), but return the objects. On a cache hit
+        they are loaded by id, without running the query.
+        """
+        cache = self.query_cache
+        if cache is None:
+            return query(fields).all()
+        generation = self.generation()
+        ids = cache.get(generation, self.db.url, kind, fields)
+        if ids is None:
+            objects = query(fields).all()
+            cache.put(generation, self.db.url, kind, fields,
+                      [ o.id for o in objects ])
+            return objects
+        found = dict((o.id, o) for o in self.session.query(obj)
+                     .filter(obj.id.in_(self.id_set('cached_ids', ids))))
+        return [ found[id] for id in ids if id in found ]
+
+    def sample_ids(self, n, fields=None, weight=None, seed=None):
+        """Return the ids of n random tracks matching fields, in random
+        order. weight makes tracks likelier in proportion to 'tags'
+        (the summed weight of their +tag terms in fields, or of all
+        their tags) or to a numeric column of tracks, such as 'length'.
+        Without fields or weight, ids are drawn from the range of track
+        ids, which costs about n lookups however big the library is;
+        otherwise the matching tracks are read once, keeping n.
+        """
+        rnd = random.Random(seed)
+        if weight is None and not fields:
+            ids = self._sample_range(n, rnd)
+            if ids is not None:
+                return ids
+        return reservoir(self._sample_weights(fields, weight), n, rnd)
+
+    def _sample_range(self, n, rnd):
+        """Draw random ids between the lowest and highest track id,
+        keeping those that exist. Returns None if too few of them do.
+        """
+        low, high = self.session.query(func.min(Track.id), func.max(Track.id)).one()
+        if low is None:
+            return [ ]
+        chosen, drawn = [ ], set()
+        for attempt in range(SAMPLE_ROUNDS):
+            need = n - len(chosen)
+            if need <= 0:
+                break
+            draws = [ ]
+            for i in range(2 * need):
+                id = rnd.randint(low, high)
+                if id not in drawn:
+                    drawn.add(id)
+                    draws.append(id)
+            found = set(id for (id,) in self.session.query(Track.id)
+                        .filter(Track.id.in_(self.id_set('sample_draws', draws))))
+            chosen.extend([ id for id in draws if id in found ][:need])
+        if len(chosen) < n:
+            return None
+        return chosen
+
+    def _sample_weights(self, fields, weight):
+        """Yield (id, weight) for the tracks matching fields."""
+        if weight is None:
+            query = self.track_query(fields, Track.id) if fields \
+                    else self.session.query(Track.id)
+            return ((id, 1) for (id,) in query)
+        if weight == 'tags':
+            from musicdir import tagindex
+            index = tagindex.index(self, 'tracks')
+            names = [ ]
+            for field in fields or ( ):
+                if field.startswith('+'):
+                    names.extend(field[1:].split('|'))
+            names = names or index.ids.keys()
+            if fields:
+                ids = array.array('l', sorted(self.track_ids(fields)))
+            else:
+                ids = index.any_of(names)
+            return index.scores(ids, names).iteritems()
+        column = Track.__table__.c.get(weight)
+        if column is None or not isinstance(column.type, Integer) \
+                or column.primary_key or column.foreign_keys:
+            raise ValueError('cannot weight tracks by %s' % weight)
+        if fields:
+            return self.track_query(fields, Track.id).add_column(column)
+        return self.session.query(Track.id, column)
+
+    def sample(self, n, fields=None, weight=None, seed=None):
+        """Like sample_ids(), but return Track objects."""
+        ids = self.sample_ids(n, fields, weight, seed)
+        tracks = dict((track.id, track) for track in self.session.query(Track)
+                      .filter(Track.id.in_(self.id_set('sample_tracks', ids))))
+        return [ tracks[id] for id in ids if id in tracks ]
 
 # }}} end Library(BaseLibrary)
 
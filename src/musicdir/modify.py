@@ -0,0 +1,371 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Apply a batch of track edits read from a JSON or YAML file.
+
+An edit file holds the new values of tracks' fields, keyed by track id,
+either as a mapping
+    {"12": {"title": "Intro", "genre": "Jazz"}, "13": {"bpm": 120}}
+or as a list of objects with an "id":
+    [{"id": 12, "title": "Intro"}, {"id": 13, "bpm": 120}]
+
+Edits are compared with the library first, so that only the fields
+that really change are written. The database is updated with one
+executemany UPDATE per set of changed columns, all in one transaction,
+and then the changed tags (and only those) are written to the tracks'
+files in a thread pool.
+"""
+import os
+import re
+import json
+import datetime
+from multiprocessing.pool import ThreadPool
+
+from musicdir.util import syspath
+
+DEFAULT_THREADS = 4
+
+# Ids per query, below SQLite's limit on bound parameters.
+CHUNK_SIZE = 500
+
+class EditError(Exception):
+    pass
+
+def _text(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value.decode('utf8')
+    return unicode(value)
+
+def _int(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+def _date(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    m = re.match(r'^(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?$', unicode(value).strip())
+    if m is None:
+        raise ValueError('not a date: %s' % value)
+    return datetime.date(int(m.group(1)), int(m.group(2) or 1), int(m.group(3) or 1))
+
+# The editable fields: how values are read, and the track column
+# they go into ('artist' and 'album' are names, resolved to the ids
+# of Artist and Release rows).
+FIELDS = {
+    'title': (_text, 'title'),
+    'artist': (_text, 'artist_id'),
+    'album': (_text, 'release_id'),
+    'track': (_int, 'track'),
+    'disc': (_int, 'disc'),
+    'genre': (_text, 'genre'),
+    'date': (_date, 'date'),
+    'composer': (_text, 'composer'),
+    'bpm': (_int, 'bpm'),
+}
+
+# {{{ reading edit files
+def _load(path):
+    if path == '-':
+        import sys
+        return json.load(sys.stdin)
+    ext = os.path.splitext(path)[1].lower()
+    with open(syspath(path)) as f:
+        if ext in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise EditError('reading YAML edit files needs PyYAML')
+            return yaml.safe_load(f)
+        return json.load(f)
+
+def read_edits(path):
+    """Read the edit file at path ('-' for JSON on standard input).
+    Returns a dictionary mapping track ids to dictionaries of their new
+    field values.
+    """
+    try:
+        data = _load(path)
+    except (IOError, OSError), exc:
+        raise EditError('%s: %s' % (path, exc.strerror))
+    except ValueError, exc:
+        raise EditError('%s: %s' % (path, exc))
+
+    if isinstance(data, dict):
+        items = data.items()
+    elif isinstance(data, list):
+        items = [ ]
+        for entry in data:
+            if not isinstance(entry, dict) or 'id' not in entry:
+                raise EditError('%s: list entries need an id' % path)
+            entry = dict(entry)
+            items.append((entry.pop('id'), entry))
+    else:
+        raise EditError('%s: expected a mapping or a list of edits' % path)
+
+    edits = { }
+    for id, fields in items:
+        if not isinstance(fields, dict):
+            raise EditError('%s: the edit of track %s is not a mapping' % (path, id))
+        try:
+            id = int(id)
+        except ValueError:
+            raise EditError('%s: bad track id: %s' % (path, id))
+        values = edits.setdefault(id, { })
+        for field, value in fields.items():
+            if field not in FIELDS:
+                raise EditError('%s: unknown field %s (track %i)' % (path, field, id))
+            try:
+                values[field] = FIELDS[field][0](value)
+            except ValueError, exc:
+                raise EditError('%s: track %i: %s: %s' % (path, id, field, exc))
+    return edits
+# }}} end reading edit files
+
+def _chunks(items):
+    items = list(items)
+    for i in range(0, len(items), CHUNK_SIZE):
+        yield items[i:i+CHUNK_SIZE]
+
+def current_values(lib, ids):
+    """The current field values of the tracks with the given ids, by
+    id, along with their 'artist_id', 'release_id' and the artist id of
+    their release, 'release_artist_id'.
+    """
+    from sqlalchemy import select
+    from musicdir.library import Artist, Release, Track
+    tracks = Track.__table__
+    artists = Artist.__table__
+    releases = Release.__table__
+    joined = tracks.outerjoin(artists, artists.c.id == tracks.c.artist_id) \
+            .outerjoin(releases, releases.c.id == tracks.c.release_id)
+    columns = [ tracks.c.id, tracks.c.artist_id, tracks.c.release_id,
+                releases.c.artist_id, tracks.c.title, artists.c.name,
+                releases.c.name, tracks.c.track, tracks.c.disc,
+                tracks.c.genre, tracks.c.date, tracks.c.composer,
+                tracks.c.bpm ]
+    names = [ 'artist_id', 'release_id', 'release_artist_id', 'title',
+              'artist', 'album', 'track', 'disc', 'genre', 'date',
+              'composer', 'bpm' ]
+    current = { }
+    for chunk in _chunks(ids):
+        query = select(columns, tracks.c.id.in_(chunk), from_obj=[ joined ])
+        for row in lib.session.execute(query):
+            current[row[0]] = dict(zip(names, row[1:]))
+    return current
+
+def plan(lib, edits):
+    """Work out what edits change. Returns a (changes, current, unknown)
+    tuple: changes maps track ids to the fields that differ from the
+    library, current holds the tracks' values before the edit and
+    unknown lists the ids of tracks that aren't in the library.
+    """
+    current = current_values(lib, edits.keys())
+    changes = { }
+    unknown = [ ]
+    for id, fields in edits.iteritems():
+        if id not in current:
+            unknown.append(id)
+            continue
+        changed = dict((field, value) for field, value in fields.iteritems()
+                       if current[id][field] != value)
+        if changed:
+            changes[id] = changed
+    return changes, current, sorted(unknown)
+
+# {{{ updating the library
+def _name_key(name):
+    """What a name is looked up by: its search key (see
+    library.search_key), as the importer finds artists, or the name
+    itself if it has no key.
+    """
+    from musicdir.library import search_key
+    return search_key(name) or name
+
+def _lookup(lib, table, names, group=()):
+    """Map the _name_key()s of names (with the values of the columns in
+    group, if any) to the lowest id of the rows of table having them.
+    Keys are matched on search_name, names without a key on name.
+    """
+    from sqlalchemy import select, func
+    from musicdir.library import search_key
+    ids = { }
+    for column, values in ((table.c.search_name, set(search_key(n) for n in names)),
+                           (table.c.name, set(n for n in names if not search_key(n)))):
+        values.discard(u'')
+        for chunk in _chunks(values):
+            columns = [ column ] + list(group)
+            query = select(columns + [ func.min(table.c.id) ],
+                           column.in_(chunk)).group_by(*columns)
+            for row in lib.session.execute(query):
+                row = tuple(row)
+                ids[row[:-1] if group else row[0]] = row[-1]
+    return ids
+
+def _artist_ids(lib, names):
+    """Map artist names to Artist ids, adding the artists that don't
+    exist yet. Names are matched by search key, so that "Beatles, The"
+    is the artist "The Beatles".
+    """
+    from musicdir.library import Artist, search_key
+    artists = Artist.__table__
+    found = _lookup(lib, artists, names)
+    missing = { }
+    for name in names:
+        if _name_key(name) not in found:
+            missing.setdefault(_name_key(name), name)
+    if missing:
+        lib.session.execute(artists.insert(),
+                [ {'name': name, 'search_name': search_key(name)}
+                  for name in missing.values() ])
+        found.update(_lookup(lib, artists, missing.values()))
+    return dict((name, found[_name_key(name)]) for name in names)
+
+def _release_ids(lib, keys):
+    """Map (release name, artist id) pairs to Release ids, adding the
+    releases that don't exist yet. Names are matched by search key, as
+    artists are.
+    """
+    from musicdir.library import Release, search_key
+    releases = Release.__table__
+    group = [ releases.c.artist_id ]
+    names = set(name for name, artist_id in keys)
+    found = _lookup(lib, releases, names, group)
+    missing = { }
+    for name, artist_id in keys:
+        if (_name_key(name), artist_id) not in found:
+            missing.setdefault((_name_key(name), artist_id), (name, artist_id))
+    if missing:
+        lib.session.execute(releases.insert(),
+                [ {'name': name, 'search_name': search_key(name),
+                   'artist_id': artist_id}
+                  for name, artist_id in missing.values() ])
+        found.update(_lookup(lib, releases,
+                             set(name for name, artist_id in missing.values()),
+                             group))
+    return dict((key, found[(_name_key(key[0]), key[1])]) for key in keys)
+
+def apply(lib, changes, current):
+    """Write changes to the library in the session's transaction (the
+    caller commits). Tracks with the same set of changed columns are
+    updated by one executemany statement. Returns the number of
+    tracks updated.
+    """
+    from sqlalchemy import bindparam
+    from musicdir.library import Track
+    tracks = Track.__table__
+
+    artist_ids = _artist_ids(lib, set(fields['artist'] for fields in changes.values()
+                                      if fields.get('artist') is not None))
+    rows = { }
+    release_keys = set()
+    for id, fields in changes.iteritems():
+        row = { }
+        for field, value in fields.iteritems():
+            if field == 'artist':
+                row['artist_id'] = artist_ids.get(value)
+            elif field != 'album':
+                row[FIELDS[field][1]] = value
+        rows[id] = row
+        if fields.get('album') is not None:
+            # the new album is by the artist of the old one, or else
+            # by the track's artist
+            if current[id]['release_id'] is not None:
+                artist_id = current[id]['release_artist_id']
+            else:
+                artist_id = row.get('artist_id', current[id]['artist_id'])
+            release_keys.add((fields['album'], artist_id))
+            row['release_id'] = (fields['album'], artist_id)
+        elif 'album' in fields:
+            row['release_id'] = None
+    release_ids = _release_ids(lib, release_keys)
+
+    groups = { }
+    for id, row in rows.iteritems():
+        if isinstance(row.get('release_id'), tuple):
+            row['release_id'] = release_ids[row['release_id']]
+        row['_id'] = id
+        groups.setdefault(tuple(sorted(row)), [ ]).append(row)
+    for columns, params in groups.iteritems():
+        values = dict((column, bindparam(column, type_=tracks.c[column].type))
+                      for column in columns if column != '_id')
+        update = tracks.update().where(tracks.c.id == bindparam('_id')) \
+                .values(**values)
+        for chunk in _chunks(params):
+            lib.session.execute(update, chunk)
+    if rows:
+        lib.update_keys(rows.keys())
+        lib.bump_generation()
+    # loaded tracks may hold the old values
+    lib.session.expire_all()
+    return len(rows)
+# }}} end updating the library
+
+# {{{ writing tags
+def tag_jobs(lib, changes):
+    """Return (path, tags) pairs: the paths of the files of the changed
+    tracks, with the tags to set on them.
+    """
+    from sqlalchemy import select
+    from musicdir.library import TrackFile, File
+    trackfiles = TrackFile.__table__
+    files = File.__table__
+    jobs = [ ]
+    for chunk in _chunks(changes.keys()):
+        query = select([ trackfiles.c.track_id, files.c.path ],
+                       trackfiles.c.track_id.in_(chunk),
+                       from_obj=[ trackfiles.join(files,
+                                  files.c.id == trackfiles.c.file_id) ])
+        for track_id, path in lib.session.execute(query):
+            if path is not None:
+                jobs.append((str(path), changes[track_id]))
+    return jobs
+
+def _write_tags(job):
+    """Set the tags of a file, returning None or the error message."""
+    from musicdir.mediafile import MediaFile
+    path, tags = job
+    try:
+        f = MediaFile(syspath(path))
+        for field, value in tags.iteritems():
+            setattr(f, field, value)
+        f.save()
+    except Exception, exc:
+        return '%s: %s' % (path, exc)
+    return None
+
+def write_tags(jobs, threads=DEFAULT_THREADS, progress=None):
+    """Write the tags of jobs (as returned by tag_jobs) to the files,
+    in a pool of threads. progress, if given, is called with the number
+    of files done after each file. Returns the list of errors.
+    """
+    errors = [ ]
+    pool = ThreadPool(threads)
+    try:
+        for done, error in enumerate(pool.imap_unordered(_write_tags, jobs)):
+            if error is not None:
+                errors.append(error)
+            if progress is not None:
+                progress(done + 1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return errors
+# }}} end writing tags
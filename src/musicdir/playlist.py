@@ -0,0 +1,181 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Write playlists of the tracks matching a query.
+
+The entries (path, length, artist and title of every track file) are
+read with one joined query and written as they come, so a playlist of
+the whole library is written without loading any Track objects. Sorted
+playlists are ordered by the database; shuffled ones first read just
+the track ids, shuffle them and read the entries in that order through
+a temporary table.
+"""
+import random
+
+ORDERS = ('artist', 'album', 'track', 'random', 'shuffle-album')
+
+class PlaylistError(Exception):
+    pass
+
+def _tables():
+    from musicdir.library import Artist, Release, Track, TrackFile, File
+    return (Track.__table__, Artist.__table__, Release.__table__,
+            TrackFile.__table__, File.__table__)
+
+def _select(lib, fields, columns, queue=None):
+    """Select columns from the files of the tracks matching fields (or
+    of the tracks in the table queue).
+    """
+    from sqlalchemy import select, and_
+    from musicdir.library import Track
+    tracks, artists, releases, trackfiles, files = _tables()
+    joined = tracks
+    if queue is not None:
+        joined = queue.join(tracks, tracks.c.id == queue.c.id)
+    joined = joined.join(trackfiles, trackfiles.c.track_id == tracks.c.id) \
+            .join(files, files.c.id == trackfiles.c.file_id) \
+            .outerjoin(artists, artists.c.id == tracks.c.artist_id) \
+            .outerjoin(releases, releases.c.id == tracks.c.release_id)
+    where = files.c.path != None
+    if fields:
+        # the matching ids, selected by the usual track query
+        matching = lib.track_query(fields, Track.id).statement.correlate(None)
+        where = and_(where, tracks.c.id.in_(matching))
+    return select(columns, where, from_obj=[ joined ])
+
+def _entry_columns():
+    tracks, artists, releases, trackfiles, files = _tables()
+    return [ files.c.path, tracks.c.length, artists.c.name, tracks.c.title ]
+
+def _order(order):
+    tracks, artists, releases, trackfiles, files = _tables()
+    album = [ releases.c.name, tracks.c.release_id, tracks.c.disc, tracks.c.track ]
+    if order == 'artist':
+        return [ artists.c.name, tracks.c.artist_id ] + album + [ tracks.c.id ]
+    elif order == 'album':
+        return album + [ tracks.c.id ]
+    return [ tracks.c.title, artists.c.name, tracks.c.id ]
+
+def _shuffled(lib, fields, order, seed):
+    """The matching track ids in random order, or grouped by album with
+    the albums in random order.
+    """
+    tracks = _tables()[0]
+    rnd = random.Random(seed)
+    if order == 'random':
+        ids = [ id for (id,) in lib.session.execute(
+                _select(lib, fields, [ tracks.c.id ]).distinct()
+                .order_by(tracks.c.id)) ]
+        rnd.shuffle(ids)
+        return ids
+    albums = [ ]
+    last = object()
+    query = _select(lib, fields, [ tracks.c.id, tracks.c.release_id ]).distinct() \
+            .order_by(tracks.c.release_id, tracks.c.disc, tracks.c.track, tracks.c.id)
+    for id, release_id in lib.session.execute(query):
+        if release_id is None or release_id != last:
+            albums.append([ ])
+        albums[-1].append(id)
+        last = release_id
+    rnd.shuffle(albums)
+    return [ id for album in albums for id in album ]
+
+def entries(lib, fields=None, order='artist', seed=None):
+    """Yield (path, length, artist, title) for the files of the tracks
+    matching fields, in order: 'artist', 'album', 'track' (by title),
+    'random' or 'shuffle-album' (albums in random order, their tracks in
+    order). seed seeds the random orders.
+    """
+    files = _tables()[4]
+    if order not in ORDERS:
+        raise PlaylistError('unknown playlist order: %s' % order)
+    if order in ('random', 'shuffle-album'):
+        from sqlalchemy.sql import table, column
+        # the queue table's rowids number the ids in the order given
+        lib.id_set('playlist_queue', _shuffled(lib, fields, order, seed))
+        queue = table('playlist_queue', column('id'), column('rowid'))
+        query = _select(lib, None, _entry_columns(), queue) \
+                .order_by(queue.c.rowid, files.c.id)
+        for row in lib.session.execute(query):
+            yield tuple(row)
+    else:
+        query = _select(lib, fields, _entry_columns()).order_by(*_order(order))
+        for row in lib.session.execute(query):
+            yield tuple(row)
+
+def _seconds(length):
+    return int(round(length)) if length is not None else -1
+
+def _title(artist, title):
+    return u'%s - %s' % (artist or u'Unknown Artist', title or u'')
+
+# {{{ writers
+class M3UWriter(object):
+    """Writes an extended M3U playlist, titles in Latin-1 (M3U8 in
+    UTF-8). Paths are written as they are stored.
+    """
+    encoding = 'latin-1'
+
+    def __init__(self, out):
+        self.out = out
+        out.write('#EXTM3U\n')
+
+    def write(self, path, length, artist, title):
+        self.out.write('#EXTINF:%i,%s\n%s\n' % (_seconds(length),
+                       _title(artist, title).encode(self.encoding, 'replace'),
+                       str(path)))
+
+    def close(self):
+        pass
+
+class M3U8Writer(M3UWriter):
+    encoding = 'utf8'
+
+class PLSWriter(object):
+    """Writes a PLS playlist, counting the entries at the end."""
+    def __init__(self, out):
+        self.out = out
+        self.count = 0
+        out.write('[playlist]\n')
+
+    def write(self, path, length, artist, title):
+        self.count += 1
+        self.out.write('File%i=%s\nTitle%i=%s\nLength%i=%i\n' % (
+                       self.count, str(path), self.count,
+                       _title(artist, title).encode('utf8'),
+                       self.count, _seconds(length)))
+
+    def close(self):
+        self.out.write('NumberOfEntries=%i\nVersion=2\n' % self.count)
+
+WRITERS = {
+    'm3u': M3UWriter,
+    'm3u8': M3U8Writer,
+    'pls': PLSWriter,
+}
+# }}} end writers
+
+def write(lib, out, fields=None, format='m3u', order='artist', seed=None):
+    """Write the playlist of the tracks matching fields to the file
+    object out in format. Returns the number of entries written.
+    """
+    if format not in WRITERS:
+        raise PlaylistError('unknown playlist format: %s' % format)
+    writer = WRITERS[format](out)
+    count = 0
+    for entry in entries(lib, fields, order, seed):
+        writer.write(*entry)
+        count += 1
+    writer.close()
+    return count
@@ -0,0 +1,171 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""A cache of the ids matched by track and release queries.
+
+Entries are keyed by the kind of query and its fields, with the
+order and repetition of the fields normalized away (get_filter combines
+them the same way in any order). Every entry belongs to a generation
+of the library: commands that change the library bump the generation
+stored in it, and entries of any other generation are never used.
+
+The cache keeps the most recently used entries up to a number of ids
+in memory and, given a directory, also keeps each entry in a file
+there, so that the next process (a cold start of the command line)
+finds it too.
+"""
+import os
+import array
+import hashlib
+import logging
+from collections import OrderedDict
+
+from musicdir.util import syspath
+
+log = logging.getLogger('musicdir')
+
+# Ids kept in memory, over all entries.
+DEFAULT_SIZE = 1000000
+
+# Entries kept on disk.
+DEFAULT_FILES = 1000
+
+def normalize(kind, fields):
+    """The cache key of a query for kind with fields."""
+    if fields is None:
+        fields = [ ]
+    elif not isinstance(fields, list):
+        fields = [ fields ]
+    return (kind, tuple(sorted(set(f.strip() for f in fields if f.strip()))))
+
+class QueryCache(object):
+    def __init__(self, size=DEFAULT_SIZE, directory=None, files=DEFAULT_FILES):
+        self.size = size
+        self.directory = directory
+        self.files = files
+        self.entries = OrderedDict() # key -> array of ids, oldest first
+        self.used = 0                # ids in entries
+        self.generation = None
+        self.stats = { 'hits': 0, 'disk_hits': 0, 'misses': 0,
+                       'evictions': 0, 'invalidations': 0 }
+
+    def _check(self, generation):
+        """Drop the entries of another generation."""
+        if generation != self.generation:
+            if self.entries:
+                self.stats['invalidations'] += 1
+            self.entries.clear()
+            self.used = 0
+            self.generation = generation
+
+    def _remember(self, key, ids):
+        if len(ids) > self.size:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = ids
+        self.used += len(ids)
+        while self.used > self.size:
+            old, evicted = self.entries.popitem(last=False)
+            self.used -= len(evicted)
+            self.stats['evictions'] += 1
+
+    def get(self, generation, db, kind, fields):
+        """Return the list of ids cached for the query, or None. db
+        names the library (its URL), for the entries on disk.
+        """
+        self._check(generation)
+        key = normalize(kind, fields)
+        ids = self.entries.pop(key, None)
+        if ids is not None:
+            self.entries[key] = ids
+            self.stats['hits'] += 1
+            return ids.tolist()
+        ids = self._read(generation, db, key)
+        if ids is not None:
+            self._remember(key, ids)
+            self.stats['disk_hits'] += 1
+            return ids.tolist()
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, generation, db, kind, fields, ids):
+        """Cache ids as the result of the query."""
+        self._check(generation)
+        key = normalize(kind, fields)
+        ids = array.array('l', ids)
+        self._remember(key, ids)
+        self._write(generation, db, key, ids)
+
+    # {{{ entries on disk
+    def _path(self, db, key):
+        name = hashlib.sha1(repr((str(db), key))).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def _read(self, generation, db, key):
+        # a library that never changed has no generation to check
+        if self.directory is None or generation is None:
+            return None
+        path = self._path(db, key)
+        try:
+            with open(syspath(path), 'rb') as f:
+                stored = int(f.readline())
+                if stored != generation:
+                    ids = None
+                else:
+                    ids = array.array('l')
+                    ids.fromstring(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+        if ids is None:
+            # it will never be used again
+            try:
+                os.remove(syspath(path))
+            except OSError:
+                pass
+        else:
+            # the modification time orders the files for eviction
+            try:
+                os.utime(syspath(path), None)
+            except OSError:
+                pass
+        return ids
+
+    def _write(self, generation, db, key, ids):
+        if self.directory is None or generation is None:
+            return
+        path = self._path(db, key)
+        try:
+            if not os.path.isdir(syspath(self.directory)):
+                os.makedirs(syspath(self.directory))
+            # written aside and renamed, so no reader sees half a file
+            with open(syspath(path + '.tmp'), 'wb') as f:
+                f.write('%i\n' % generation)
+                f.write(ids.tostring())
+            os.rename(syspath(path + '.tmp'), syspath(path))
+            self._trim()
+        except (IOError, OSError), exc:
+            log.debug(u'query cache: cannot write %s: %s' %
+                      (path.decode('utf8', 'replace'), exc))
+
+    def _trim(self):
+        """Remove the least recently used files beyond the limit."""
+        names = os.listdir(syspath(self.directory))
+        if len(names) <= self.files:
+            return
+        paths = [ os.path.join(self.directory, name) for name in names ]
+        paths.sort(key=lambda path: os.path.getmtime(syspath(path)))
+        for path in paths[:len(paths) - self.files]:
+            os.remove(syspath(path))
+            self.stats['evictions'] += 1
+    # }}} end entries on disk
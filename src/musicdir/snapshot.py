@@ -0,0 +1,403 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""The track catalog saved in a file that is read through mmap.
+
+A snapshot holds the arrays of a Catalog as they are in memory, along
+with the artist and release names sorted by their search keys (see
+library.search_key), each track's rank in those, the search keys of
+the titles, and the track positions sorted by artist, by release and
+by title key. Opening one maps the file and reads its header; values
+are unpacked from the mapping when they are asked for, so that looking
+up an artist binary-searches the sorted keys and positions without
+reading (or copying) anything else.
+
+The header records the library generation (and count of edits) the
+snapshot was made at, and it is only used while the library is at that
+generation. Otherwise, if tracks were only added since, update() turns
+it back into a Catalog, lets that append them and writes it again;
+after any other change it loads a new Catalog.
+"""
+import os
+import re
+import sys
+import mmap
+import array
+import struct
+import hashlib
+
+from musicdir.util import syspath
+from musicdir.catalog import Catalog, Strings, NUMBERS, MISSING
+from musicdir.library import search_key
+
+MAGIC = 'MDCATSNP'
+VERSION = 3
+
+# how this machine stores the arrays; snapshots from others are rebuilt
+NATIVE = '%s-%i-%i' % (sys.byteorder, array.array('l').itemsize,
+                       array.array('i').itemsize)
+
+# magic, version, native, generation, watermark, tracks, edits,
+# number of sections
+HEADER = struct.Struct('=8sI16sqqqqI')
+# name, array typecode, items, offset
+SECTION = struct.Struct('=32sc7xqq')
+
+# sections are aligned for the widest item
+ALIGN = 8
+
+class SnapshotError(Exception):
+    pass
+
+# {{{ views into the mapping
+class Column(object):
+    """An array in the mapping, read an item at a time."""
+    def __init__(self, data, offset, typecode, length):
+        self.data = data
+        self.offset = offset
+        self.size = struct.calcsize(typecode)
+        self.format = '=' + typecode
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return struct.unpack_from(self.format, self.data, self.offset + i * self.size)[0]
+
+    def tostring(self):
+        return self.data[self.offset:self.offset + self.length * self.size]
+
+class StringTable(object):
+    """Strings packed end to end, as in catalog.Strings."""
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def raw(self, i):
+        return self.data.data[self.data.offset + self.offsets[i]:
+                              self.data.offset + self.offsets[i + 1]]
+
+    def text(self, i):
+        return self.raw(i).decode('utf8')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def containing(self, value):
+        """The indexes of the strings containing value. Both are search
+        keys, so already folded; the strings are searched as one, in
+        place in the mapping, with matches placed by their offset.
+        """
+        count = len(self)
+        if not value:
+            return range(count)
+        data, base = self.data.data, self.data.offset
+        stop = base + self.offsets[count]
+        end = lambda i: self.offsets[i + 1]
+        found = [ ]
+        start = data.find(value, base, stop)
+        while start >= 0:
+            start -= base
+            # the first string ending after start holds the match if it
+            # ends after the match does
+            i = bisect(count, end, start, right=True)
+            if start + len(value) <= end(i):
+                found.append(i)
+                start = data.find(value, base + end(i), stop)
+            else:
+                start = data.find(value, base + start + 1, stop)
+        return found
+
+def bisect(count, key, value, right=False):
+    """The first index below count whose key is not below value (or,
+    with right, above it), for keys ascending with the index.
+    """
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        k = key(mid)
+        if k < value or (right and k == value):
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+# }}} end views into the mapping
+
+FIELD_NAMES = { 'artist': 'artist', 'author': 'artist', 'album': 'release',
+                'release': 'release', 'title': 'title', 'track': 'title' }
+
+def parse(fields):
+    """Group query fields by what they match: artist, release or title,
+    mapping each to a list of (search key, how) pairs, how being '='
+    for an exact match, '*' for a prefix and ':' for a substring, as in
+    library.text_filter. Returns None if there are other fields, or
+    values without a key, which only the library can answer. Like
+    get_filter, matches on the same thing are or'ed and the rest
+    and'ed.
+    """
+    groups = { }
+    for field in fields:
+        m = re.match(r'^(.*?)([:=])(.*)$', field)
+        if m is None or m.group(1).lower() not in FIELD_NAMES:
+            return None
+        how, value = m.group(2), m.group(3)
+        if how == ':' and value.endswith(u'*'):
+            how, value = '*', value[:-1]
+        key = search_key(value)
+        if not key:
+            return None
+        groups.setdefault(FIELD_NAMES[m.group(1).lower()], [ ]) \
+                .append((key, how))
+    return groups
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.path = path
+        try:
+            f = open(syspath(path), 'rb')
+        except IOError, exc:
+            raise SnapshotError('%s: %s' % (path, exc.strerror))
+        try:
+            try:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError), exc:
+                raise SnapshotError('%s: %s' % (path, exc))
+        finally:
+            f.close()
+        if len(self.map) < HEADER.size:
+            raise SnapshotError('%s: not a catalog snapshot' % path)
+        fields = HEADER.unpack_from(self.map, 0)
+        magic, version, native = fields[:3]
+        if magic != MAGIC or version != VERSION or native.rstrip('\0') != NATIVE:
+            raise SnapshotError('%s: not a catalog snapshot of this version' % path)
+        generation, self.watermark, self.count = fields[3:6]
+        self.generation = None if generation < 0 else generation
+        self.edits = fields[6]
+        self.sections = { }
+        for i in range(fields[7]):
+            name, typecode, length, offset = SECTION.unpack_from(self.map,
+                    HEADER.size + i * SECTION.size)
+            self.sections[name.rstrip('\0')] = Column(self.map, offset, typecode, length)
+
+        try:
+            self.columns = dict((name, self.sections[name]) for name, code in NUMBERS)
+            self.titles = self._strings('titles')
+            self.paths = self._strings('paths')
+            self.artist_names = self._strings('artist_names')
+            self.release_names = self._strings('release_names')
+            self.keys = { 'artist': self._strings('artist_keys'),
+                          'release': self._strings('release_keys'),
+                          'title': self._strings('title_keys') }
+        except KeyError, exc:
+            raise SnapshotError('%s: no section %s' % (path, exc))
+
+    def _strings(self, name):
+        return StringTable(self.sections[name], self.sections[name + '_offsets'])
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    # {{{ lookups
+    def _keys(self, count, keys, key, how):
+        """The indexes below count of the sorted keys (a function giving
+        the artist or release keys, or the title keys in by_title
+        order) equal to key (how '=') or starting with it ('*').
+        """
+        raw = key.encode('utf8')
+        if how == '=':
+            hi = raw
+        else:
+            hi = (key[:-1] + unichr(ord(key[-1]) + 1)).encode('utf8')
+        lo = bisect(count, keys, raw)
+        return xrange(lo, bisect(count, keys, hi, right=(how == '=')))
+
+    def _by_rank(self, kind, ranks):
+        """The positions of the tracks whose artist or release (kind)
+        has one of ranks.
+        """
+        rank = self.sections[kind + '_rank']
+        order = self.sections['by_' + kind]
+        key = lambda i: rank[order[i]]
+        positions = [ ]
+        for r in ranks:
+            lo = bisect(self.count, key, r)
+            hi = bisect(self.count, key, r, right=True)
+            positions.extend(order[i] for i in xrange(lo, hi))
+        return positions
+
+    def _match(self, what, key, how):
+        """The positions of the tracks whose artist, release or title
+        (what) matches key.
+        """
+        keys = self.keys[what]
+        if what == 'title':
+            if how == ':':
+                return keys.containing(key.encode('utf8'))
+            order = self.sections['by_title']
+            sorted_keys = lambda i: keys.raw(order[i])
+            return [ order[i] for i in self._keys(self.count, sorted_keys, key, how) ]
+        if how == ':':
+            ranks = keys.containing(key.encode('utf8'))
+        else:
+            ranks = self._keys(len(keys), keys.raw, key, how)
+        return self._by_rank(what, ranks)
+
+    def find(self, groups):
+        """The positions, in track id order, of the tracks matching
+        groups, as returned by parse().
+        """
+        matches = None
+        for what, terms in groups.items():
+            found = set()
+            for key, how in terms:
+                found.update(self._match(what, key, how))
+            matches = found if matches is None else matches & found
+        if matches is None:
+            return range(self.count)
+        return sorted(matches)
+
+    def value(self, name, i):
+        """As Catalog.value()."""
+        if name == 'title':
+            return self.titles.text(i)
+        elif name == 'path':
+            return self.paths.raw(i) or None
+        elif name in ('artist', 'release'):
+            r = self.sections[name + '_rank'][i]
+            names = self.artist_names if name == 'artist' else self.release_names
+            return names.text(r) if r != MISSING else None
+        value = self.columns[name][i]
+        if value == MISSING:
+            return None
+        if name == 'date':
+            import datetime
+            return datetime.date.fromordinal(value)
+        return value
+    # }}} end lookups
+
+    def to_catalog(self, lib):
+        """A Catalog holding (a copy of) what the snapshot holds."""
+        cat = Catalog(lib)
+        for name, code in NUMBERS:
+            cat.columns[name].fromstring(self.columns[name].tostring())
+        for strings, table in ((cat.titles, self.titles), (cat.paths, self.paths)):
+            strings.data = bytearray(table.data.tostring())
+            strings.offsets = array.array('I')
+            strings.offsets.fromstring(table.offsets.tostring())
+        for kind, names, target in (('artist', self.artist_names, cat.artists),
+                                    ('release', self.release_names, cat.releases)):
+            ids = self.sections[kind + '_ids']
+            for r in range(len(names)):
+                target[ids[r]] = names.text(r)
+        cat.watermark = self.watermark
+        cat.edits = self.edits
+        cat.generation = self.generation
+        return cat
+
+# {{{ writing
+def _names(names):
+    """Sort an {id: name} dictionary by search key, returning the ids,
+    the names and keys as Strings and a dictionary of id -> rank.
+    """
+    items = sorted((search_key(name or u'').encode('utf8'), id, name or u'')
+                   for id, name in names.iteritems())
+    ids = array.array('i', [ id for key, id, name in items ])
+    strings, keys = Strings(), Strings()
+    for key, id, name in items:
+        strings.append(name)
+        keys.append(key)
+    return ids, strings, keys, dict((item[1], r) for r, item in enumerate(items))
+
+def write(cat, path):
+    """Write the Catalog cat as a snapshot at path."""
+    n = len(cat)
+    sections = [ ]
+    for name, code in NUMBERS:
+        sections.append((name, cat.columns[name]))
+    for name, strings in (('titles', cat.titles), ('paths', cat.paths)):
+        sections.append((name, array.array('B', str(strings.data))))
+        sections.append((name + '_offsets', strings.offsets))
+    for kind, names in (('artist', cat.artists), ('release', cat.releases)):
+        ids, strings, keys, ranks = _names(names)
+        column = cat.columns[kind + '_id']
+        rank = array.array('i', [ ranks.get(id, MISSING) for id in column ])
+        # sorted() is stable, so the tracks of a rank stay in id order
+        order = array.array('I', sorted(xrange(n), key=rank.__getitem__))
+        sections.extend([ (kind + '_ids', ids),
+                          (kind + '_names', array.array('B', str(strings.data))),
+                          (kind + '_names_offsets', strings.offsets),
+                          (kind + '_keys', array.array('B', str(keys.data))),
+                          (kind + '_keys_offsets', keys.offsets),
+                          (kind + '_rank', rank), ('by_' + kind, order) ])
+    titles = Strings()
+    for i in xrange(n):
+        titles.append(search_key(cat.titles.text(i)))
+    sections.extend([ ('title_keys', array.array('B', str(titles.data))),
+                      ('title_keys_offsets', titles.offsets),
+                      ('by_title', array.array('I', sorted(xrange(n), key=titles.raw))) ])
+
+    generation = cat.generation if cat.generation is not None else -1
+    offset = HEADER.size + len(sections) * SECTION.size
+    directory = [ ]
+    for name, data in sections:
+        offset += -offset % ALIGN
+        directory.append(SECTION.pack(name, data.typecode, len(data), offset))
+        offset += len(data) * data.itemsize
+
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(syspath(dirname)):
+        os.makedirs(syspath(dirname))
+    # written aside and renamed, so that readers never map half a file
+    with open(syspath(path + '.tmp'), 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, NATIVE, generation, cat.watermark,
+                            n, cat.edits or 0, len(sections)))
+        f.write(''.join(directory))
+        for name, data in sections:
+            f.write('\0' * (-f.tell() % ALIGN))
+            f.write(data.tostring())
+    os.rename(syspath(path + '.tmp'), syspath(path))
+# }}} end writing
+
+def path_for(directory, lib):
+    """The snapshot file of lib in directory."""
+    return os.path.join(directory, hashlib.sha1(str(lib.db.url)).hexdigest())
+
+def update(lib, path):
+    """Return the Snapshot at path, first bringing it up to date with
+    lib if it is missing or of another library generation. Only a
+    library that was just added to is caught up from the snapshot;
+    after anything else it is read again.
+    """
+    try:
+        snap = Snapshot(path)
+    except SnapshotError:
+        snap = None
+    if snap is not None and snap.generation == lib.generation():
+        return snap
+    if snap is not None and snap.edits == lib.edits():
+        cat = snap.to_catalog(lib)
+        cat.refresh()
+    else:
+        cat = Catalog(lib)
+        cat.load()
+    if snap is not None:
+        snap.close()
+    write(cat, path)
+    return Snapshot(path)
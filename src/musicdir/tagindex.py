@@ -0,0 +1,241 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Posting lists of tagged tracks, releases and artists.
+
+For every tag, the index keeps the sorted ids of what is tagged with it
+(and the summed weights of those taggings) in arrays. Tag queries are
+answered by intersecting, merging and subtracting these lists, smallest
+first, instead of joining the tag tables into the query, where a second
+tag (or any other joined table) multiplies the rows to count. When one
+list is much shorter than the other, the intersection gallops through
+the longer one instead of walking it.
+
+An index is loaded with one query and kept for the process (a daemon
+keeps it between commands); it reloads itself when the library's
+generation changes, which costs one lookup of the library state per
+query. Whatever writes tags or taggings must call
+Library.bump_generation for the index to see them.
+"""
+import array
+from bisect import bisect_left
+
+# Intersections gallop when one list is this many times the other.
+GALLOP_RATIO = 8
+
+def _ids():
+    return array.array('l')
+
+# {{{ posting list operations
+def intersect(a, b):
+    """The ids in both of the sorted arrays a and b."""
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return _ids()
+    if len(b) > GALLOP_RATIO * len(a):
+        return _gallop(a, b)
+    out = _ids()
+    i, j = 0, 0
+    while i < len(a) and j < len(b):
+        x, y = a[i], b[j]
+        if x == y:
+            out.append(x)
+            i += 1
+            j += 1
+        elif x < y:
+            i += 1
+        else:
+            j += 1
+    return out
+
+def _gallop(small, large):
+    """Intersect by looking each id of small up in large, searching
+    ahead of the last position in doubling steps and then bisecting.
+    """
+    out = _ids()
+    lo, n = 0, len(large)
+    for x in small:
+        step, hi = 1, lo
+        while hi < n and large[hi] < x:
+            lo = hi
+            hi += step
+            step *= 2
+        lo = bisect_left(large, x, lo, min(hi + 1, n))
+        if lo == n:
+            break
+        if large[lo] == x:
+            out.append(x)
+    return out
+
+def union(a, b):
+    """The ids in either of the sorted arrays a and b."""
+    out = _ids()
+    i, j = 0, 0
+    while i < len(a) and j < len(b):
+        x, y = a[i], b[j]
+        if x == y:
+            out.append(x)
+            i += 1
+            j += 1
+        elif x < y:
+            out.append(x)
+            i += 1
+        else:
+            out.append(y)
+            j += 1
+    out.extend(a[i:])
+    out.extend(b[j:])
+    return out
+
+def difference(a, b):
+    """The ids of the sorted array a that are not in b."""
+    out = _ids()
+    i, j = 0, 0
+    while i < len(a):
+        if j >= len(b):
+            out.extend(a[i:])
+            break
+        x, y = a[i], b[j]
+        if x == y:
+            i += 1
+            j += 1
+        elif x < y:
+            out.append(x)
+            i += 1
+        else:
+            j += 1
+    return out
+# }}} end posting list operations
+
+class TagIndex(object):
+    """The posting lists of one kind of tagging: 'tracks', 'releases'
+    or 'artists'.
+    """
+    def __init__(self, lib, kind):
+        self.lib = lib
+        self.kind = kind
+        self.ids = { }     # tag name -> sorted array of ids
+        self.weights = { } # tag name -> array of weights, parallel to ids
+        self.loaded = False
+        self.generation = None
+
+    def _tables(self):
+        from musicdir.library import Tag, TrackTag, ReleaseTag, ArtistTag
+        if self.kind == 'tracks':
+            return Tag, TrackTag, TrackTag.track_id
+        elif self.kind == 'releases':
+            return Tag, ReleaseTag, ReleaseTag.release_id
+        return Tag, ArtistTag, ArtistTag.artist_id
+
+    def refresh(self):
+        """Reload the index if the library's generation has moved (an
+        edit moves it too).
+        """
+        generation = self.lib.generation()
+        if not self.loaded or generation != self.generation:
+            self.load()
+            self.loaded = True
+            self.generation = generation
+
+    def load(self):
+        from sqlalchemy import select
+        Tag, Tagging, object_id = self._tables()
+        query = select([ Tag.name, object_id, Tagging.weight ],
+                       object_id != None,
+                       from_obj=[ Tagging.__table__.join(Tag.__table__,
+                                  Tag.id == Tagging.tag_id) ]) \
+                .order_by(Tag.name, object_id)
+        self.ids, self.weights = { }, { }
+        name, ids, weights = None, None, None
+        for tag, id, weight in self.lib.session.execute(query):
+            if tag != name:
+                name = tag
+                ids = self.ids.setdefault(tag, _ids())
+                weights = self.weights.setdefault(tag, array.array('d'))
+            # a tag without a weight counts once
+            weight = 1 if weight is None else weight
+            if ids and ids[-1] == id:
+                weights[-1] += weight
+            else:
+                ids.append(id)
+                weights.append(weight)
+
+    def tagged(self, name):
+        """The sorted ids tagged with name."""
+        return self.ids.get(name, _ids())
+
+    def any_of(self, names):
+        """The sorted ids tagged with any of names."""
+        lists = sorted((self.tagged(name) for name in names), key=len)
+        out = _ids()
+        for ids in lists:
+            out = union(out, ids)
+        return out
+
+    def match(self, groups, excluded=()):
+        """The sorted ids tagged with at least one name of every group
+        in groups (a list of lists of names) and with none of excluded.
+        groups must not be empty.
+        """
+        lists = sorted((self.any_of(group) for group in groups), key=len)
+        out = lists[0]
+        for ids in lists[1:]:
+            if not out:
+                break
+            out = intersect(out, ids)
+        if excluded and out:
+            out = difference(out, self.any_of(excluded))
+        return out
+
+    def scores(self, ids, names):
+        """Map each of the sorted ids to the summed weight of its tags
+        among names.
+        """
+        scores = dict.fromkeys(ids, 0)
+        for name in set(names):
+            tagged, weights = self.tagged(name), self.weights.get(name)
+            for id in intersect(ids, tagged):
+                scores[id] += weights[bisect_left(tagged, id)]
+        return scores
+
+def rank(lib, kind, objects, fields):
+    """Sort objects (tracks, releases or artists, as kind says) by the
+    summed weight of their tags among the +tag terms of fields, highest
+    first; ties keep their order.
+    """
+    names = [ ]
+    for field in fields:
+        if field.startswith('+'):
+            names.extend(field[1:].split('|'))
+    if not names:
+        return list(objects)
+    ids = array.array('l', sorted(set(obj.id for obj in objects)))
+    scores = index(lib, kind).scores(ids, names)
+    return sorted(objects, key=lambda obj: -scores[obj.id])
+
+# indexes by database and kind, kept for the life of the process
+_indexes = { }
+
+def index(lib, kind):
+    """Return the up to date TagIndex of lib for kind ('tracks',
+    'releases' or 'artists').
+    """
+    key = (str(lib.db.url), kind)
+    if key not in _indexes:
+        _indexes[key] = TagIndex(lib, kind)
+    idx = _indexes[key]
+    idx.lib = lib
+    idx.refresh()
+    return idx
@@ -21,7 +21,7 @@ import sys
 from difflib import SequenceMatcher
 import logging
 import locale
-from musicdir import util, library
+from musicdir import util
 
 # {{{ UI exception. Commands should throw this in order to display
 # nonrecoverable errors to the user.
@@ -34,6 +34,21 @@ CONFIG_PATH_VAR = 'MUSICDIR_CONFIG'
 DEFAULT_CONFIG_FILE = os.path.expanduser('~/.musicdirrc')
 DEFAULT_LIBRARY = 'sqlite:///' + os.path.expanduser('~/.musicdir.db')
 DEFAULT_DIRECTORY = '~/Music'
+DEFAULT_ART_DIRECTORY = '~/.musicdir/art'
+DEFAULT_ART_CACHE_SIZE = 256 # megabytes
+DEFAULT_SOCKET = '~/.musicdir/socket'
+DEFAULT_QUERY_CACHE_SIZE = 1000000 # track and release ids
+DEFAULT_CATALOG_DIRECTORY = '~/.musicdir/catalog'
+NO_DAEMON_VAR = 'MUSICDIR_NO_DAEMON'
+# commands never forwarded to the daemon (watch runs until interrupted
+# and would keep the daemon from answering anyone else)
+DAEMON_LOCAL_COMMANDS = ('serve', 'watch', 'help', '?')
+# options of commands that read standard input when given '-', which
+# the daemon can't (it isn't passed the client's)
+DAEMON_STDIN_OPTIONS = {
+    'modify': ('-f', '--from'),
+    'mod': ('-f', '--from'),
+}
 DEFAULT_PATH_FORMATS = {
     'default': '$albumartist/$album/$track $title',
     'comp': 'Compilations/$album/$track $title',
@@ -345,28 +360,41 @@ class SubcommandsOptionParser(optparse.OptionParser):
 
 # }}} end SubCommand Parsing Structure
 
-def main(args=None):
-    """Run the main command-line interface for beets."""
+# {{{ config, parser and library setup
+def config_path():
+    """The path of the config file to read, or None."""
+    if CONFIG_PATH_VAR in os.environ:
+        return os.path.expanduser(os.environ[CONFIG_PATH_VAR])
+    return DEFAULT_CONFIG_FILE
 
-    # {{{ read the config file
+def read_config(configpath):
     config = ConfigParser.SafeConfigParser()
-    if CONFIG_PATH_VAR in os.environ:
-        configpath = os.path.expanduser(os.environ[CONFIG_PATH_VAR])
-    else:
-        configpath = DEFAULT_CONFIG_FILE
     if configpath:
         configpath = util.syspath(configpath)
         if os.path.exists(configpath):
             config.readfp(open(util.syspath(configpath)))
+    return config
 
-    # }}} end read config file
+def catalog_path(config, lib):
+    """The catalog snapshot file of lib, or None if snapshots are off
+    (catalog_directory is set to nothing) or there is no config, as
+    when commands are called from code.
+    """
+    if config is None:
+        return None
+    directory = config_val(config, 'musicdir', 'catalog_directory',
+                           DEFAULT_CATALOG_DIRECTORY)
+    if not directory:
+        return None
+    from musicdir import snapshot
+    return snapshot.path_for(os.path.expanduser(directory), lib)
 
-    # {{{ Construct the root parser.
-    from musicdir.ui.commands import default_commands
-    commands = list(default_commands)
-    # commands += plugins.commands()
+def socket_path(config):
+    """The Unix socket of the library daemon."""
+    return os.path.expanduser(
+        config_val(config, 'musicdir', 'socket', DEFAULT_SOCKET))
 
-    parser = SubcommandsOptionParser(subcommands=commands)
+def add_root_options(parser):
     parser.add_option('-l', '--library', dest='libpath',
                       help='library database file to use')
     parser.add_option('-d', '--directory', dest='directory',
@@ -375,15 +403,23 @@ def main(args=None):
                       help="destination path format string")
     parser.add_option('-v', '--verbose', dest='verbose', action='store_true',
                       help='print debugging information')
-    # }}} end Construct the root parser
+    parser.add_option('--profile-startup', action='store_true',
+                      help='report the time taken by each import')
 
-    # Parse the command-line!
-    options, subcommand, suboptions, subargs = parser.parse_args(args)
+def make_parser():
+    from musicdir.ui.commands import default_commands
+    commands = list(default_commands)
+    # commands += plugins.commands()
 
-    # {{{ Open library file.
-    libpath = options.libpath or \
-        config_val(config, 'musicdir', 'library', DEFAULT_LIBRARY)
+    parser = SubcommandsOptionParser(subcommands=commands)
+    add_root_options(parser)
+    return parser
+
+def library_path(options, config):
+    return os.path.expanduser(options.libpath or
+        config_val(config, 'musicdir', 'library', DEFAULT_LIBRARY))
 
+def open_library(options, config):
     directory = options.directory or \
         config_val(config, 'musicdir', 'directory', DEFAULT_DIRECTORY)
 
@@ -402,11 +438,25 @@ def main(args=None):
         if config.has_section('paths'):
             path_formats.update(config.items('paths'))
 
-    lib = library.Library(os.path.expanduser(libpath),
+    # query results are cached in memory (set query_cache_size to 0
+    # to turn that off) and, with a query_cache_directory, on disk
+    from musicdir.querycache import QueryCache
+    query_cache = None
+    cache_size = int(config_val(config, 'musicdir', 'query_cache_size',
+                                DEFAULT_QUERY_CACHE_SIZE))
+    cache_directory = config_val(config, 'musicdir', 'query_cache_directory', None)
+    if cache_size > 0:
+        if cache_directory is not None:
+            cache_directory = os.path.expanduser(cache_directory)
+        query_cache = QueryCache(cache_size, cache_directory)
+
+    from musicdir import library
+    return library.Library(library_path(options, config),
                           directory,
-                          path_formats )
-    # }}} end Open the library file
-    
+                          path_formats,
+                          query_cache )
+
+def run_command(lib, config, options, subcommand, suboptions, subargs):
     # {{{ Configure the logger.
     log = logging.getLogger('musicdir')
     if options.verbose:
@@ -414,7 +464,7 @@ def main(args=None):
     else:
         log.setLevel(logging.INFO)
     # }}} end Configure the logger.
-    
+
     # {{{ Invoke the subcommand.
     try:
         subcommand.func(lib, config, suboptions, subargs)
@@ -422,4 +472,128 @@ def main(args=None):
         message = exc.args[0] if exc.args else None
         subcommand.parser.error(message)
     # }}} end invoke the subcommand
+# }}} end config, parser and library setup
+
+# {{{ library daemon
+class _PreParser(optparse.OptionParser):
+    """Finds the subcommand without knowing the subcommands."""
+    def error(self, msg):
+        raise ValueError(msg)
+
+def reads_stdin(args):
+    """Whether the command args (the subcommand and its arguments)
+    reads standard input (see DAEMON_STDIN_OPTIONS).
+    """
+    options = DAEMON_STDIN_OPTIONS.get(args[0], ())
+    for i, arg in enumerate(args[1:], 1):
+        for option in options:
+            if arg == option and args[i + 1:i + 2] == [ '-' ]:
+                return True
+            if option.startswith('--') and arg == option + '=-':
+                return True
+            if not option.startswith('--') and arg == option + '-':
+                return True
+    return False
+
+def parse_root(args):
+    """Parse the options given before the subcommand. Returns the
+    options and the rest of args, or None if they don't parse (the
+    full parser reports that).
+    """
+    preparser = _PreParser(add_help_option=False)
+    add_root_options(preparser)
+    preparser.disable_interspersed_args()
+    try:
+        return preparser.parse_args(list(args))
+    except ValueError:
+        return None
+
+def forward(configpath, config, args):
+    """Run the command given by args in the library daemon, if one is
+    running. Returns the exit status, or None if the command has to be
+    run here.
+    """
+    if os.environ.get(NO_DAEMON_VAR):
+        return None
+    root = parse_root(args)
+    if root is None:
+        return None
+    options, rest = root
+    # A profiled run has to start up here to be worth profiling.
+    if options.profile_startup:
+        return None
+    if not rest or rest[0] in DAEMON_LOCAL_COMMANDS or reads_stdin(rest):
+        return None
+
+    path = socket_path(config)
+    if not os.path.exists(util.syspath(path)):
+        return None
+    from musicdir import daemon
+    return daemon.forward(path, args, configpath)
+
+def run_in_daemon(lib, config, configpath, args, requested_config):
+    """Run a command forwarded to the daemon serving lib with the
+    config read from configpath. Returns False if the command must be
+    run by the client instead: it was given another config file or
+    library, or options the daemon's library wasn't opened with.
+    """
+    from sqlalchemy.engine.url import make_url
+    if (requested_config or None) != configpath:
+        return False
+    parser = make_parser()
+    options, subcommand, suboptions, subargs = parser.parse_args(args)
+    if subcommand.name in DAEMON_LOCAL_COMMANDS or \
+            options.directory or options.path_format or \
+            str(make_url(library_path(options, config))) != str(lib.db.url):
+        return False
+    try:
+        run_command(lib, config, options, subcommand, suboptions, subargs)
+        lib.session.commit()
+    except:
+        lib.session.rollback()
+        raise
+    return True
+# }}} end library daemon
+
+def main(args=None):
+    """Run the main command-line interface for beets."""
+    if args is None:
+        args = sys.argv[1:]
+
+    # Checked before the full parser is built, so that the imports done
+    # while setting it up are timed too. Only the root options count:
+    # after the subcommand the flag is an error like any unknown option.
+    profiler = None
+    root = parse_root(args)
+    if root is not None and root[0].profile_startup:
+        from musicdir.util.startup import ImportProfiler
+        profiler = ImportProfiler()
+        profiler.install()
+    mark = profiler.mark if profiler is not None else lambda label: None
+
+    try:
+        # {{{ read the config file
+        configpath = config_path()
+        config = read_config(configpath)
+        mark('read config')
+        # }}} end read config file
+
+        # Let the library daemon run the command if there is one.
+        status = forward(configpath, config, args)
+        if status is not None:
+            mark('run command in daemon')
+            sys.exit(status)
+
+        # Parse the command-line!
+        parser = make_parser()
+        options, subcommand, suboptions, subargs = parser.parse_args(args)
+        mark('parse arguments')
 
+        lib = open_library(options, config)
+        mark('open library')
+        run_command(lib, config, options, subcommand, suboptions, subargs)
+        mark('run command')
+    finally:
+        if profiler is not None:
+            profiler.uninstall()
+            profiler.report(sys.stderr)
@@ -15,24 +15,24 @@
 from musicdir import ui
 from musicdir.ui import print_
 from musicdir.util import *
-from musicdir.library import *
-from musicdir.mediafile import UnreadableFileError
-from musicdir import importer
 
 import logging
 import codecs
+import threading
 
-from sqlalchemy import func
+# Commands import what they need when they run, so that every command
+# doesn't pay for loading SQLAlchemy, mutagen and the rest.
 
 # The list of default subcommands. This is populated with Subcommand
 # objects that can be fed to a SubcommandsOptionParser.
 default_commands = []
 
 # {{{ list: Query and show library contents.
-def list_items(lib, query, release, path):
+def list_items(lib, query, release, path, rank=False):
     """Print out items in lib matching query. If album, then search for
     albums instead of single items. If path, print the matched objects'
-    paths instead of human-readable information about them.
+    paths instead of human-readable information about them. If rank,
+    order them by the weight of the queried tags.
     """
     fields = [ ]
     if isinstance(query, list):
@@ -41,11 +41,19 @@ def list_items(lib, query, release, path):
         fields = [ query.decode('utf8', 'replace') ]
     
     if release:
-        for rls in lib.releases(fields):
+        releases = lib.releases(fields)
+        if rank:
+            from musicdir import tagindex
+            releases = tagindex.rank(lib, 'releases', releases, fields)
+        for rls in releases:
             aname = rls.artist.name if rls.artist != None else 'Unknown Artist'
             print_(aname + u' - ' + rls.name)
     else:
-        for track in lib.tracks(fields):
+        tracks = lib.tracks(fields)
+        if rank:
+            from musicdir import tagindex
+            tracks = tagindex.rank(lib, 'tracks', tracks, fields)
+        for track in tracks:
             if path:
                 if track.files is not None:
                     for trackfile in track.files:
@@ -55,20 +63,127 @@ def list_items(lib, query, release, path):
                 rname = track.release.name if track.release != None else 'Unknown Release'
                 print_(aname + u' - ' + rname + u' - ' + track.title)
 
+def list_page(lib, query, order, limit, after, path):
+    """Print a page of the tracks in lib matching query, sorted by
+    order. If the page is full, says on stderr where the next one
+    starts.
+    """
+    fields = [ q.decode('utf8', 'replace') for q in query ]
+    try:
+        tracks = lib.track_page(fields, order or 'artist',
+                                None if limit is None else limit + 1, after)
+    except ValueError, exc:
+        raise ui.UserError(str(exc))
+    more = limit is not None and len(tracks) > limit
+    if more:
+        tracks = tracks[:limit]
+    for track in tracks:
+        if path:
+            for trackfile in track.files:
+                print_(trackfile.file.path)
+        else:
+            aname = track.artist.name if track.artist != None else 'Unknown Artist'
+            rname = track.release.name if track.release != None else 'Unknown Release'
+            print_(aname + u' - ' + rname + u' - ' + track.title)
+    if more:
+        sys.stderr.write('more: --after %i\n' % tracks[-1].id)
+
 list_cmd = ui.Subcommand('list', help='query the library', aliases=('ls',))
 list_cmd.parser.add_option('-r', '--release', action='store_true',
     help='show matching releases instead of tracks')
 list_cmd.parser.add_option('-p', '--path', action='store_true',
     help='print paths for matched items or albums')
+list_cmd.parser.add_option('-w', '--rank', action='store_true',
+    help='order by the summed weight of the +tag terms, highest first')
+list_cmd.parser.add_option('-s', '--sort', type='choice',
+    choices=('artist', 'album', 'date', 'added', 'length', 'bitrate'),
+    help='sort tracks by artist, album, date, added, length or bitrate')
+list_cmd.parser.add_option('-n', '--limit', type='int',
+    help='show at most LIMIT tracks')
+list_cmd.parser.add_option('--after', type='int', metavar='ID',
+    help='start after the track with id ID (as printed after a full page)')
+def list_snapshot(lib, config, args):
+    """List the tracks matching args from the catalog snapshot, if it
+    can answer the query. Returns whether it did.
+    """
+    from musicdir import snapshot
+    path = ui.catalog_path(config, lib)
+    groups = snapshot.parse([ arg.decode('utf8', 'replace') for arg in args ])
+    if path is None or groups is None:
+        return False
+    try:
+        snap = snapshot.update(lib, path)
+    except (IOError, OSError, snapshot.SnapshotError):
+        return False
+    for i in snap.find(groups):
+        aname = snap.value('artist', i) or u'Unknown Artist'
+        rname = snap.value('release', i) or u'Unknown Release'
+        print_(aname + u' - ' + rname + u' - ' + snap.value('title', i))
+    return True
+
+def refresh_snapshot(lib, config):
+    """Bring the catalog snapshot up to date, if there is one, so that
+    the next list doesn't have to.
+    """
+    from musicdir import snapshot
+    path = ui.catalog_path(config, lib)
+    if path is None or not os.path.exists(syspath(path)):
+        return
+    try:
+        snapshot.update(lib, path).close()
+    except (IOError, OSError, snapshot.SnapshotError):
+        # the next list tries again
+        pass
+
 def list_func(lib, config, opts, args):
-    list_items(lib, args, opts.release, opts.path)
+    if opts.sort or opts.limit is not None or opts.after is not None:
+        if opts.release or opts.rank:
+            raise ui.UserError('--sort, --limit and --after list tracks only')
+        if opts.limit is not None and opts.limit < 1:
+            raise ui.UserError('--limit must be at least 1')
+        list_page(lib, args, opts.sort, opts.limit, opts.after, opts.path)
+        return
+    if not (opts.release or opts.path or opts.rank) and list_snapshot(lib, config, args):
+        return
+    list_items(lib, args, opts.release, opts.path, opts.rank)
 list_cmd.func = list_func
 default_commands.append(list_cmd)
 # }}} end list: Query and show library contents
 
+# {{{ random: show random matching tracks
+random_cmd = ui.Subcommand('random', help='show random matching tracks')
+random_cmd.parser.add_option('-n', '--count', type='int', default=10,
+    help='number of tracks to choose (default: %default)')
+random_cmd.parser.add_option('-w', '--weight',
+    help='favour tracks by "tags" (the weight of their tags) or by a '
+         'numeric track field, such as length')
+random_cmd.parser.add_option('-p', '--path', action='store_true',
+    help='print paths for the chosen tracks')
+random_cmd.parser.add_option('--seed', type='int',
+    help='seed for the choice, to repeat it')
+def random_func(lib, config, opts, args):
+    fields = [ arg.decode('utf8', 'replace') for arg in args ]
+    try:
+        tracks = lib.sample(max(opts.count, 0), fields, opts.weight, opts.seed)
+    except ValueError, exc:
+        raise ui.UserError(str(exc))
+    for track in tracks:
+        if opts.path:
+            for trackfile in track.files:
+                print_(trackfile.file.path)
+        else:
+            aname = track.artist.name if track.artist != None else 'Unknown Artist'
+            rname = track.release.name if track.release != None else 'Unknown Release'
+            print_(aname + u' - ' + rname + u' - ' + track.title)
+random_cmd.func = random_func
+default_commands.append(random_cmd)
+# }}} end random
+
 # {{{ stats: Query and show library stats
 stats_cmd = ui.Subcommand('stats', help='show library stats')
 def stats_func(lib, config, opts, args):
+    from sqlalchemy import func
+    from musicdir.library import File, Track, Artist, Release
     total_size = lib.session.query(func.sum(File.size)).scalar()
     if total_size is None:
         total_size = 0
@@ -95,6 +210,10 @@ def stats_func(lib, config, opts, args):
             , total_artists
             , total_releases
             , total_files) )
+    if lib.query_cache is not None:
+        print_("Query cache: %(hits)i hits, %(disk_hits)i from disk, %(misses)i misses, "
+               "%(evictions)i evictions, %(invalidations)i invalidations"
+               % lib.query_cache.stats)
 
 stats_cmd.func = stats_func
 default_commands.append(stats_cmd)
@@ -108,13 +227,188 @@ import_cmd.parser.add_option('-v', '--verbose', action='store_true',
 import_cmd.parser.add_option('-l', '--log', dest='logpath',
     help='file to log untaggable albums for later review')
 import_cmd.parser.add_option('-a', '--attachments', action='store_true',
-    help='attach files in same directory as audio files')
+    help='attach files in same directory as audio files and cache cover art')
 import_cmd.parser.add_option('-c', '--checksum', action='store_true',
-    help='add checksum to new files. NOTE: this will take awhile')
+    help='add checksum to new files, hashing in one process per CPU')
+import_cmd.parser.add_option('-t', '--threads', type='int', default=8,
+    help='maximum number of threads reading tags (default: %default)')
 #import_cmd.parser.add_option('', '', action='store_false',
 #    help='')
 
+# Seconds between progress lines of import --verbose.
+PROGRESS_INTERVAL = 5
+
+# Directories per chunk sent to the checksum processes.
+CHECKSUM_CHUNK_SIZE = 2
+
+# The import runs as a pipeline: one stage walks the directories,
+# the next reads tags (which is where the time goes on slow disks, so
+# it is autoscaled up to --threads readers) and the last one, which
+# owns the library session, adds the files. With --checksum, the
+# files are hashed in a pool of processes between walking and reading.
+def import_walk(lib, topdirs, attachments):
+    """First import stage. Yields a task per directory holding the
+    paths of its audio files, attachments and folder art that are not
+    in the library yet.
+    """
+    from musicdir.importer import AUDIO_RE, ATTACHMENT_RE, COVER_RE
+    for topdir in topdirs:
+        topdir = bytestring_path(topdir)
+        for root, dirs, files in sorted_walk(topdir):
+            paths = [ os.path.join(root, file) for file in files ]
+
+            # skip duplicates for now
+            known = lib.known_paths(paths)
+
+            task = { 'root': root, 'audio': [ ], 'attachments': [ ],
+                     'cover': None }
+            for path in paths:
+                if path in known:
+                    continue
+                if AUDIO_RE.search(path):
+                    task['audio'].append(path)
+                elif attachments and task['cover'] is None \
+                        and COVER_RE.search(path):
+                    task['cover'] = path
+                elif attachments and ATTACHMENT_RE.search(path):
+                    task['attachments'].append(path)
+            yield task
+
+def import_checksum(task):
+    """Checksum import stage, run in worker processes. Hashes the
+    files of a task and records the sums by path.
+    """
+    from musicdir.library import checksums
+    task['checksums'] = { }
+    paths = task['audio'] + task['attachments']
+    if task['cover'] is not None:
+        paths.append(task['cover'])
+    for path in paths:
+        try:
+            task['checksums'][path] = checksums(path)
+        except (IOError, OSError):
+            pass
+    return task
+
+def import_read():
+    """Second import stage. Reads the tags of each task's audio files;
+    files that can't be read are recorded as None.
+    """
+    from musicdir.mediafile import MediaFile, UnreadableFileError
+    task = yield
+    while True:
+        task['tags'] = { }
+        for path in task['audio']:
+            try:
+                task['tags'][path] = MediaFile(syspath(path))
+            except UnreadableFileError:
+                task['tags'][path] = None
+        task = yield task
+
+def import_apply(lib, opts, artcache, logfile):
+    """Last import stage. Adds each task's files to the library."""
+    from sqlalchemy import func
+    from musicdir.library import File, Attachment, Track
+    from musicdir import importer
+    while True:
+        task = yield
+        print_(task['root'])
+        # tracks up to here were in the library before the task
+        newest = lib.session.query(func.max(Track.id)).scalar() or 0
+
+        afiles = [ ] # attachments
+        apaths = [ ]
+        cover = None # folder art, from the art cache
+        if task['cover'] is not None:
+            if opts.verbose:
+                print_(task['cover'])
+            # the cached copy is the files' attachment too, so an
+            # image found in many folders is still stored once
+            cover = artcache.store_file(task['cover'])
+            afiles.append(cover)
+            apaths.append(task['cover'])
+        for path in task['attachments']:
+            if opts.verbose:
+                print_(path)
+            afiles.append(Attachment(file=File(path=path), name=path.decode('utf8','replace')) )
+            apaths.append(path)
+
+        mfiles = [ ] # audio files
+        mpaths = [ ]
+        trackfiles = [ ]
+        for path in task['audio']:
+            if opts.verbose:
+                print_(path)
+            mfile = File(path=syspath(path), size=os.path.getsize(syspath(path)))
+            mediafile = task['tags'][path]
+            if mediafile is None:
+                if logfile != None:
+                    logfile.write(u'FAILED: ' + path.decode('utf8', 'replace') + u'\n')
+                continue
+            mfiles.append(mfile)
+            mpaths.append(path)
+
+            track = importer.import_track( \
+                    lib=lib, \
+                    file=mfile, \
+                    attachments=afiles, \
+                    cover=cover, \
+                    mediafile=mediafile )
+            if track is None:
+                continue
+            lib.session.add(track)
+            trackfiles.append(track)
+            if artcache is not None and track.cover is None:
+                artcache.extract(track)
+
+        # checksums come from the checksum stage
+        if opts.checksum == True:
+            sums = task['checksums']
+            for file, path in zip(mfiles, mpaths):
+                if path in sums:
+                    file.sha1_checksum, file.sha1_presum = sums[path]
+            if mfiles:
+                for atch, path in zip(afiles, apaths):
+                    if path in sums:
+                        atch.file.sha1_checksum, atch.file.sha1_presum = sums[path]
+
+        # Commit per directory. This also hands the session's
+        # connection back, so the main thread can use it afterwards.
+        if artcache is not None:
+            artcache.collect()
+        if mfiles:
+            # files may have been added to tracks already in the library
+            lib.session.flush()
+            lib.update_keys([ tf.track_id for tf in trackfiles ])
+            lib.bump_generation(edited=any(tf.track_id <= newest
+                                           for tf in trackfiles))
+        lib.session.commit()
+
+class ImportProgress(threading.Thread):
+    """Prints the import pipeline's statistics every interval seconds
+    until stop() is called.
+    """
+    def __init__(self, pipeline, interval=PROGRESS_INTERVAL):
+        super(ImportProgress, self).__init__()
+        self.daemon = True
+        self.pipeline = pipeline
+        self.interval = interval
+        self.done = threading.Event()
+
+    def run(self):
+        from musicdir.util import pipeline
+        while not self.done.wait(self.interval):
+            print_('progress: ' + pipeline.format_snapshot(self.pipeline.snapshot()))
+
+    def stop(self):
+        from musicdir.util import pipeline
+        self.done.set()
+        self.join()
+        print_('progress: ' + pipeline.format_snapshot(self.pipeline.snapshot()))
+
 def import_func(lib, config, opts, args):
+    from musicdir.util import pipeline
+    from musicdir.artcache import ArtCache
     logger = logging.getLogger('importer')
     if opts.verbose:
         logger.setLevel(logging.DEBUG)
@@ -125,75 +419,356 @@ def import_func(lib, config, opts, args):
     if opts.logpath:
         logfile = codecs.open(opts.logpath, 'w', 'utf-8')
 
-    for topdir in args:
-        topdir = bytestring_path(topdir)
-        for root, dirs, files in sorted_walk(topdir):
-            lib.session.commit()
-            # logger.info(root)
-            print_(root)
-
-            mre = re.compile(r'\.(m4a|mp4|mp3|flac|ogg|ape|wv|mpc)$', re.I)
-            are = re.compile(r'\.(nfo|cue|log|xml)$', re.I)
-            cover_re = re.compile(r'(folder|cover|cd|front)\.(jpg|jpeg|png|bmp|tiff|svg)$', re.I)
+    # covers are kept in the content-addressed art cache
+    artcache = None
+    if opts.attachments:
+        artcache = ArtCache(lib,
+                ui.config_val(config, 'musicdir', 'art_directory',
+                    ui.DEFAULT_ART_DIRECTORY),
+                int(ui.config_val(config, 'musicdir', 'art_cache_size',
+                    ui.DEFAULT_ART_CACHE_SIZE)) * 1024 * 1024 )
 
-            mfiles = [ ] # audio files
-            afiles = [ ] # attachments
-            cover = None
+    stages = [ import_walk(lib, args, opts.attachments) ]
+    names = [ 'walk' ]
+    if opts.checksum:
+        # forked here, before the progress thread is started
+        stages.append(pipeline.ProcessStage(import_checksum,
+                chunksize=CHECKSUM_CHUNK_SIZE).start())
+        names.append('checksum')
+    stages.append(pipeline.Autoscale(import_read, 1, max(opts.threads, 1)))
+    stages.append(import_apply(lib, opts, artcache, logfile))
+    names.extend([ 'read', 'apply' ])
 
-            for file in files:
-                file = os.path.join(root, file)
+    # the session is used from the pipeline's last thread
+    lib.session.commit()
+    pl = pipeline.Pipeline(stages, instrument=opts.verbose, names=names)
 
-                # skip duplicates for now
-                if lib.session.query(File.path).filter(File.path == file).count() > 0:
-                    continue
+    progress = None
+    if opts.verbose:
+        progress = ImportProgress(pl)
+        progress.start()
+    try:
+        pl.run_parallel()
+    finally:
+        if progress is not None:
+            progress.stop()
 
-                if mre.search(file):
-                    if opts.verbose:
-                        print_(file)
-                    mfiles.append(File(path=syspath(file), size=os.path.getsize(syspath(file))) )
-
-                elif opts.attachments == True and cover == None and cover_re.search(file):
-                    if opts.verbose:
-                        print_(file)
-                    cover = Attachment(file=File(path=file), name=u'cover')
-                    afiles.append(cover)
-
-                elif opts.attachments == True and are.search(file):
-                    if opts.verbose:
-                        print_(file)
-                    afiles.append(Attachment(file=File(path=file), name=file.decode('utf8','replace')) )
-
-            if len(mfiles) > 0:
-                tracks = [ ]
-                for mfile in mfiles:
-                    try:
-                        track = importer.import_track( \
-                                lib=lib, \
-                                file=mfile, \
-                                attachments=afiles, \
-                                cover=cover )
-                        tracks.append(track)
-                    except UnreadableFileError:
-                        if logfile != None:
-                            logfile.write(u'FAILED: ' + mfile.path.decode('utf8', 'replace') + u'\n')
-
-                # do checksum
-                if opts.checksum == True:
-                    for file in  mfiles:
-                        if opts.checksum == True:
-                            if file is not None:
-                                file.checksum()
-
-                            for atch in afiles:
-                                atch.file.checksum()
-
-                for track in tracks:
-                    lib.session.add(track)
-                
+    if artcache is not None:
+        artcache.close()
     if logfile != None:
         logfile.close()
     lib.session.commit()
+    refresh_snapshot(lib, config)
 
 import_cmd.func = import_func
 default_commands.append(import_cmd)
 # }}}
+
+# {{{ watch: keep the library in sync with directories
+watch_cmd = ui.Subcommand('watch',
+    help='import, move and drop files as they change in directories')
+watch_cmd.parser.add_option('--poll', action='store_true',
+    help='scan the directories instead of using inotify')
+watch_cmd.parser.add_option('-i', '--interval', type='float', default=5.0,
+    help='seconds between scans when polling (default: %default)')
+watch_cmd.parser.add_option('-w', '--wait', type='float', default=1.0,
+    help='seconds of quiet before changes are applied (default: %default)')
+watch_cmd.parser.add_option('-t', '--threads', type='int', default=4,
+    help='number of threads reading tags (default: %default)')
+def watch_func(lib, config, opts, args):
+    from musicdir import watch
+    if not args:
+        raise ui.UserError('no directories to watch')
+    def report(counts):
+        print_('watch: %(added)i added, %(updated)i updated, %(moved)i moved, '
+               '%(deleted)i deleted, %(unreadable)i unreadable' % counts)
+
+    # the session is used from this thread only
+    lib.session.commit()
+    try:
+        watch.watch(lib, args, poll=opts.poll, interval=opts.interval,
+                    debounce=opts.wait, threads=max(opts.threads, 1),
+                    report=report)
+    except KeyboardInterrupt:
+        pass
+watch_cmd.func = watch_func
+default_commands.append(watch_cmd)
+# }}} end watch
+
+# {{{ check: find files that moved, changed or went away
+check_cmd = ui.Subcommand('check',
+    help='find library files that are missing or changed on disk')
+check_cmd.parser.add_option('--prune', action='store_true',
+    help='drop missing files from the library')
+check_cmd.parser.add_option('-r', '--relink', action='append', default=[ ],
+    metavar='DIR', help='look for missing files in DIR (may be repeated)')
+check_cmd.parser.add_option('-t', '--threads', type='int', default=8,
+    help='number of threads checking directories (default: %default)')
+def check_func(lib, config, opts, args):
+    from musicdir import check
+    counts = { check.MISSING: 0, check.RESIZED: 0, check.MODIFIED: 0,
+               'relinked': 0, 'pruned': 0 }
+    missing = [ ]
+    for kind, row in check.check(lib, args, threads=max(opts.threads, 1)):
+        counts[kind] += 1
+        if kind == check.MISSING:
+            missing.append(row)
+        print_('%s: %s' % (kind, row[1]))
+
+    # the rows have all been read, so the library can be written to
+    if missing and opts.relink:
+        candidates = check.find_candidates(opts.relink)
+        targets = check.relink_targets(lib, missing, candidates)
+        for row, path in targets:
+            print_('relinked: %s -> %s' % (row[1], path))
+        counts['relinked'] = check.relink(lib, targets)
+        relinked = set(row[0] for row, path in targets)
+        missing = [ row for row in missing if row[0] not in relinked ]
+    if missing and opts.prune:
+        counts['pruned'] = check.prune(lib, [ row[0] for row in missing ])
+
+    print_('check: %(missing)i missing, %(resized)i resized, '
+           '%(modified)i modified, %(relinked)i relinked, '
+           '%(pruned)i pruned' % counts)
+check_cmd.func = check_func
+default_commands.append(check_cmd)
+# }}} end check
+
+# {{{ export: dump the library as a table
+export_cmd = ui.Subcommand('export',
+    help='write the library as CSV, JSON Lines or Parquet')
+export_cmd.parser.add_option('-f', '--format', choices=('csv', 'jsonl', 'parquet'),
+    help='csv, jsonl or parquet (default: from the output file name, or csv)')
+export_cmd.parser.add_option('-o', '--output',
+    help='file to write to (default: standard output)')
+export_cmd.parser.add_option('-c', '--chunk-size', type='int', default=5000,
+    help='tracks read per query (default: %default)')
+def export_func(lib, config, opts, args):
+    from musicdir import export
+    format = opts.format
+    if format is None:
+        ext = os.path.splitext(opts.output or '')[1].lstrip('.').lower()
+        format = ext if ext in export.WRITERS else 'csv'
+    if format == 'parquet' and not opts.output:
+        raise ui.UserError('Parquet can only be written to a file (-o)')
+
+    if opts.output:
+        out = open(opts.output, 'wb')
+    else:
+        out = sys.stdout
+    try:
+        count = export.export(lib, out, format, max(opts.chunk_size, 1))
+    except export.ExportError, exc:
+        raise ui.UserError(str(exc))
+    finally:
+        if opts.output:
+            out.close()
+    if opts.output:
+        print_('exported %i rows to %s' % (count, opts.output))
+export_cmd.func = export_func
+default_commands.append(export_cmd)
+# }}} end export
+
+# {{{ modify: apply a file of edits
+modify_cmd = ui.Subcommand('modify', help='change tracks from an edit file',
+    aliases=('mod',))
+modify_cmd.parser.add_option('-f', '--from', dest='editfile', metavar='FILE',
+    help='JSON or YAML file of edits keyed by track id (- for standard input)')
+modify_cmd.parser.add_option('-n', '--no-write', action='store_true',
+    help="change the library only, not the files' tags")
+modify_cmd.parser.add_option('-t', '--threads', type='int', default=4,
+    help='number of threads writing tags (default: %default)')
+def modify_func(lib, config, opts, args):
+    import time
+    from musicdir import modify
+    if not opts.editfile:
+        raise ui.UserError('no edit file given (--from)')
+    try:
+        edits = modify.read_edits(opts.editfile)
+    except modify.EditError, exc:
+        raise ui.UserError(str(exc))
+
+    start = time.time()
+    changes, current, unknown = modify.plan(lib, edits)
+    for id in unknown:
+        print_('modify: no track %i' % id)
+    count = modify.apply(lib, changes, current)
+    lib.session.commit()
+    elapsed = time.time() - start
+    print_('modify: %i tracks changed, %i unchanged, %i unknown in %.1f s' %
+           (count, len(edits) - count - len(unknown), len(unknown), elapsed))
+    if opts.no_write or not changes:
+        return
+
+    jobs = modify.tag_jobs(lib, changes)
+    start = time.time()
+    shown = [ start ]
+    def progress(done):
+        now = time.time()
+        if now - shown[0] >= PROGRESS_INTERVAL:
+            shown[0] = now
+            print_('progress: %i/%i files (%.0f/s)' %
+                   (done, len(jobs), done / (now - start)))
+    errors = modify.write_tags(jobs, max(opts.threads, 1), progress)
+    for error in errors:
+        print_('modify: cannot write %s' % error)
+    elapsed = time.time() - start
+    print_('modify: %i files written, %i failed in %.1f s (%.0f files/s)' %
+           (len(jobs) - len(errors), len(errors), elapsed,
+            len(jobs) / elapsed if elapsed else 0))
+modify_cmd.func = modify_func
+default_commands.append(modify_cmd)
+# }}} end modify
+
+# {{{ remove: take tracks out of the library
+remove_cmd = ui.Subcommand('remove', help='remove matching items from the library',
+    aliases=('rm',))
+remove_cmd.parser.add_option('-r', '--release', action='store_true',
+    help='remove matching releases (and all of their tracks)')
+remove_cmd.parser.add_option('-d', '--delete', action='store_true',
+    help="also delete the tracks' files from disk")
+remove_cmd.parser.add_option('-n', '--pretend', action='store_true',
+    help='only show how many tracks would be removed')
+remove_cmd.parser.add_option('-t', '--threads', type='int', default=4,
+    help='number of threads deleting files (default: %default)')
+def remove_func(lib, config, opts, args):
+    import time
+    from multiprocessing.pool import ThreadPool
+    from musicdir.library import Track
+    if not args:
+        raise ui.UserError('no query given (an empty query would remove everything)')
+    fields = [ arg.decode('utf8', 'replace') for arg in args ]
+
+    start = time.time()
+    if opts.release:
+        releases = lib.release_ids(fields)
+        ids = [ ]
+        for i in range(0, len(releases), 500):
+            ids.extend(id for (id,) in lib.session.query(Track.id)
+                       .filter(Track.release_id.in_(releases[i:i+500])))
+    else:
+        ids = lib.track_ids(fields)
+    if opts.pretend:
+        print_('remove: would remove %i tracks' % len(ids))
+        return
+
+    paths = lib.track_paths(ids) if opts.delete else [ ]
+    counts = lib.remove_tracks(ids)
+    lib.session.commit()
+    print_('remove: %(tracks)i tracks, %(files)i files, %(releases)i releases, '
+           '%(artists)i artists, %(tags)i tags, %(attachments)i attachments'
+           % counts + ' in %.1f s' % (time.time() - start))
+
+    # only once the library no longer refers to them
+    def delete(path):
+        try:
+            soft_remove(path)
+        except OSError, exc:
+            return '%s: %s' % (path, exc.strerror)
+    if paths:
+        pool = ThreadPool(max(opts.threads, 1))
+        try:
+            errors = [ error for error in pool.map(delete, paths) if error ]
+        finally:
+            pool.terminate()
+            pool.join()
+        for error in errors:
+            print_('remove: cannot delete %s' % error)
+        print_('remove: deleted %i files' % (len(paths) - len(errors)))
+remove_cmd.func = remove_func
+default_commands.append(remove_cmd)
+# }}} end remove
+
+# {{{ similar: artists like the matching ones
+similar_cmd = ui.Subcommand('similar', help='show artists similar to the matching ones')
+similar_cmd.parser.add_option('-n', '--count', type='int', default=10,
+    help='number of artists to show (default: %default)')
+similar_cmd.parser.add_option('-k', '--hops', type='int', default=1,
+    help='follow similarities this many steps away (default: %default)')
+similar_cmd.parser.add_option('-p', '--pagerank', action='store_true',
+    help='rank by PageRank personalized to the matching artists')
+def similar_func(lib, config, opts, args):
+    from musicdir import graph
+    from musicdir.library import Artist
+    if not args:
+        raise ui.UserError('no query given')
+    fields = [ arg.decode('utf8', 'replace') for arg in args ]
+    seeds = [ artist.id for artist in lib.artists(fields) ]
+    if not seeds:
+        raise ui.UserError('no matching artists')
+
+    g = graph.graph(lib)
+    if opts.pagerank:
+        similar = g.pagerank(seeds, opts.count)
+    elif opts.hops > 1 or len(seeds) > 1:
+        similar = g.expand(seeds, max(opts.hops, 1), opts.count)
+    else:
+        similar = g.neighbours(seeds[0], opts.count)
+    if not similar:
+        return
+    names = dict(lib.session.query(Artist.id, Artist.name)
+                 .filter(Artist.id.in_([ id for id, score in similar ])))
+    for id, score in similar:
+        print_(u'%s (%.3f)' % (names.get(id) or u'Unknown Artist', score))
+similar_cmd.func = similar_func
+default_commands.append(similar_cmd)
+# }}} end similar
+
+# {{{ playlist: write the matching tracks as a playlist
+playlist_cmd = ui.Subcommand('playlist', help='write a playlist of matching tracks')
+playlist_cmd.parser.add_option('-f', '--format', choices=('m3u', 'm3u8', 'pls'),
+    help='m3u, m3u8 or pls (default: from the output file name, or m3u)')
+playlist_cmd.parser.add_option('-o', '--output',
+    help='file to write to (default: standard output)')
+playlist_cmd.parser.add_option('-s', '--sort', default='artist',
+    choices=('artist', 'album', 'track', 'random', 'shuffle-album'),
+    help='artist, album, track, random or shuffle-album (default: %default)')
+playlist_cmd.parser.add_option('--seed', type='int',
+    help='seed for the random orders, to repeat a shuffle')
+def playlist_func(lib, config, opts, args):
+    from musicdir import playlist
+    fields = [ arg.decode('utf8', 'replace') for arg in args ]
+    format = opts.format
+    if format is None:
+        ext = os.path.splitext(opts.output or '')[1].lstrip('.').lower()
+        format = ext if ext in playlist.WRITERS else 'm3u'
+
+    if opts.output:
+        out = open(opts.output, 'wb')
+    else:
+        out = sys.stdout
+    try:
+        count = playlist.write(lib, out, fields, format, opts.sort, opts.seed)
+    except playlist.PlaylistError, exc:
+        raise ui.UserError(str(exc))
+    finally:
+        if opts.output:
+            out.close()
+    if opts.output:
+        print_('wrote %i entries to %s' % (count, opts.output))
+playlist_cmd.func = playlist_func
+default_commands.append(playlist_cmd)
+# }}} end playlist
+
+# {{{ serve: keep the library open for other invocations
+serve_cmd = ui.Subcommand('serve',
+    help='keep the library open and run commands sent to its socket')
+serve_cmd.parser.add_option('-s', '--socket',
+    help='socket to listen on (default: the socket config value)')
+def serve_func(lib, config, opts, args):
+    from musicdir import daemon
+    path = opts.socket or ui.socket_path(config)
+    configpath = ui.config_path()
+    def run(argv, requested_config):
+        return ui.run_in_daemon(lib, config, configpath, argv, requested_config)
+
+    # the daemon answers from this thread only
+    lib.session.commit()
+    print_('listening on %s' % path)
+    try:
+        daemon.serve(path, run)
+    except IOError, exc:
+        raise ui.UserError('%s: %s' % (path, exc.strerror))
+serve_cmd.func = serve_func
+default_commands.append(serve_cmd)
+# }}} end serve
@@ -15,7 +15,9 @@
 
 """Simple but robust implementation of generator/coroutine-based
 pipelines in Python. The pipelines may be run either sequentially
-(single-threaded) or in parallel (one thread per pipeline stage).
+(single-threaded), in parallel (one thread per pipeline stage) or
+asynchronously (one scheduling thread plus a shared pool of threads
+for the stages that block; see run_async).
 
 This implementation supports pipeline bubbles (indications that the
 processing for a certain item should abort). To use them, yield the
@@ -30,17 +32,87 @@ multiple coroutines for the same pipeline stage; this lets you speed
 up a bottleneck stage by dividing its work among multiple threads.
 To do so, pass an iterable of coroutines to the Pipeline constructor
 in place of any single coroutine.
+
+The number of threads for a middle stage does not have to be fixed:
+pass an Autoscale object wrapping a coroutine factory instead, and
+run_parallel will add workers while the stage is the bottleneck and
+retire them again when it is starved or blocked by the next stage.
+
+When stages do very little work per message, the locking in the
+queues between them dominates. run_parallel(batch_size=n) sends
+messages between threads in batches of up to n instead; batching is
+invisible to the stage coroutines, which still receive and yield one
+message (or BUBBLE, or multiple(...)) at a time. A partial batch is
+sent on when its thread is about to wait for input, or at its next
+put once it is flush_timeout seconds old, so a slow trickle of
+messages is not held back for long. (A batch can't be flushed while
+the thread is busy inside its coroutine, so stages that spend a long
+time on each message gain little from batching anyway.)
+
+run_async drives the same coroutines from a single scheduling thread
+with bounded buffers between the stages. Stages wrapped in blocking()
+have their steps run on a shared Executor instead, so many coroutines
+of an I/O-bound stage (say, 64 tag readers) can be in flight without
+the cost of a dedicated thread each: idle coroutines are just
+generator objects, and the executor's threads use small stacks and
+are shared by every blocking stage. Outside run_async, blocking() has
+no effect.
+
+CPU-bound middle stages gain nothing from more threads while the GIL
+is held. Such a stage can be given as a ProcessStage instead: a plain
+function, run on chunks of messages in a pool of worker processes.
+Results keep their order (except under run_async, which may reorder
+them as it does for any stage with several coroutines), BUBBLE and
+multiple(...) work as usual, and an exception raised in a worker
+process aborts the pipeline like any other (with the worker's
+traceback in its remote_traceback attribute). run_sequential calls the
+function directly, and run_async waits for the pool from executor
+threads.
+
+A parallel pipeline can also be instrumented: pass instrument=True to
+the constructor and call snapshot() at any time (from any thread) to
+see, for every stage, how many messages went in and out, how long its
+threads spent working versus waiting on their queues, and percentiles
+of its input queue depth and per-message latency.
 """
 from __future__ import with_statement # for Python 2.5
 import Queue
 from threading import Thread, Lock
+import threading
+import bisect
+import collections
+import multiprocessing
+import pickle
 import sys
+import time
+import traceback
 import types
 
 BUBBLE = '__PIPELINE_BUBBLE__'
 POISON = '__PIPELINE_POISON__'
 
 DEFAULT_QUEUE_SIZE = 16
+DEFAULT_FLUSH_TIMEOUT = 0.05
+
+# Messages per task sent to the processes of a ProcessStage.
+DEFAULT_CHUNKSIZE = 16
+
+# Executor defaults for run_async. The stack size only has to fit the
+# C stack of the blocking stages' code, not a whole program.
+DEFAULT_WORKERS = 16
+EXECUTOR_STACK_SIZE = 512 * 1024
+
+# Histogram buckets for instrumented pipelines: queue depths are
+# counted exactly up to the default queue size, latencies in
+# power-of-two steps from a microsecond to a couple of minutes.
+DEPTH_BOUNDS = range(DEFAULT_QUEUE_SIZE + 1) + [2 ** i for i in range(5, 17)]
+LATENCY_BOUNDS = [0.000001 * 2 ** i for i in range(28)]
+
+# Autoscaling defaults: workers are reconsidered every AUTOSCALE_INTERVAL
+# seconds, and a stage counts as stalled when its workers spend more
+# than AUTOSCALE_WAIT of their time waiting on a queue.
+AUTOSCALE_INTERVAL = 0.5
+AUTOSCALE_WAIT = 0.5
 
 def _invalidate_queue(q, val=None, sync=True):
     """Breaks a Queue such that it never blocks, always has size 1,
@@ -74,11 +146,19 @@ class CountedQueue(Queue.Queue):
     """A queue that keeps track of the number of threads that are
     still feeding into it. The queue is poisoned when all threads are
     finished with the queue.
+
+    If batch_size is more than one, the threads on either side of the
+    queue exchange lists of up to batch_size messages (and maxsize
+    counts those lists); flush_timeout bounds how long a partial batch
+    may wait before it is sent.
     """
-    def __init__(self, maxsize=0):
+    def __init__(self, maxsize=0, batch_size=1,
+                 flush_timeout=DEFAULT_FLUSH_TIMEOUT):
         Queue.Queue.__init__(self, maxsize)
         self.nthreads = 0
         self.poisoned = False
+        self.batch_size = batch_size
+        self.flush_timeout = flush_timeout
 
     def acquire(self):
         """Indicate that a thread will start putting into this queue.
@@ -89,6 +169,17 @@ class CountedQueue(Queue.Queue):
             assert self.nthreads >= 0
             self.nthreads += 1
 
+    def try_acquire(self):
+        """Like acquire(), but for threads joining while the pipeline
+        runs: returns False instead of failing if every thread feeding
+        the queue has already finished.
+        """
+        with self.mutex:
+            if self.poisoned or self.nthreads == 0:
+                return False
+            self.nthreads += 1
+            return True
+
     def release(self):
         """Indicate that a thread that was putting into this queue has
         exited. If this is the last thread using the queue, the queue
@@ -117,6 +208,118 @@ class CountedQueue(Queue.Queue):
                     # No items. Invalidate immediately.
                     _invalidate_queue(self, POISON, False)
 
+class Histogram(object):
+    """Counts observations in fixed buckets. bounds are the inclusive
+    upper edges of the buckets; anything larger falls into a final
+    overflow bucket.
+    """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+
+    def percentile(self, pct):
+        """Return the upper edge of the bucket holding the pct-th
+        percentile (None if nothing was recorded, inf if it is in the
+        overflow bucket).
+        """
+        if not self.total:
+            return None
+        rank = self.total * pct / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                break
+        if i < len(self.bounds):
+            return self.bounds[i]
+        return float('inf')
+
+    def buckets(self):
+        """Return (upper edge, count) pairs for non-empty buckets."""
+        edges = self.bounds + [float('inf')]
+        return [(edges[i], c) for i, c in enumerate(self.counts) if c]
+
+class StageStats(object):
+    """Counters for one stage of an instrumented pipeline, shared by
+    all the threads running that stage.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.lock = Lock()
+        self.workers = 0
+        self.items_in = 0
+        self.items_out = 0
+        self.busy = 0.0
+        self.get_wait = 0.0
+        self.put_wait = 0.0
+        self.depth = Histogram(DEPTH_BOUNDS)
+        self.latency = Histogram(LATENCY_BOUNDS)
+
+    def got(self, depth, waited, count=1):
+        """count messages were taken from the input queue, which held
+        depth entries when the thread asked for them.
+        """
+        with self.lock:
+            self.items_in += count
+            self.get_wait += waited
+            self.depth.add(depth)
+
+    def worked(self, elapsed):
+        """The stage's coroutine handled one message."""
+        with self.lock:
+            self.busy += elapsed
+            self.latency.add(elapsed)
+
+    def put(self, waited, count=1):
+        """count messages were handed to the next stage."""
+        with self.lock:
+            self.items_out += count
+            self.put_wait += waited
+
+    def retired(self):
+        """One of the stage's threads has been retired."""
+        with self.lock:
+            self.workers -= 1
+
+    def totals(self):
+        """Return the (busy, get_wait, put_wait) times so far."""
+        with self.lock:
+            return self.busy, self.get_wait, self.put_wait
+
+    def snapshot(self):
+        """Return the counters as a dictionary."""
+        with self.lock:
+            total = self.busy + self.get_wait + self.put_wait
+            return {
+                'name': self.name,
+                'workers': self.workers,
+                'in': self.items_in,
+                'out': self.items_out,
+                'busy': self.busy,
+                'get_wait': self.get_wait,
+                'put_wait': self.put_wait,
+                'utilization': self.busy / total if total else 0.0,
+                'depth': dict(('p%i' % p, self.depth.percentile(p))
+                              for p in (50, 90, 99)),
+                'latency': dict(('p%i' % p, self.latency.percentile(p))
+                                for p in (50, 90, 99)),
+                'latency_histogram': self.latency.buckets(),
+            }
+
+def format_snapshot(snapshot):
+    """Format a Pipeline.snapshot() as a single progress line."""
+    parts = [ ]
+    for stage in snapshot:
+        parts.append('%s %i>%i busy %i%% get %.1fs put %.1fs' % (
+            stage['name'], stage['in'], stage['out'],
+            stage['utilization'] * 100, stage['get_wait'], stage['put_wait']))
+    return ' | '.join(parts)
+
 class MultiMessage(object):
     """A message yielded by a pipeline stage encapsulating multiple
     values to be sent to the next stage.
@@ -143,12 +346,94 @@ def _allmsgs(obj):
 
 class PipelineThread(Thread):
     """Abstract base class for pipeline-stage threads."""
-    def __init__(self, all_threads):
+    def __init__(self, all_threads, stats=None):
         super(PipelineThread, self).__init__()
         self.abort_lock = Lock()
         self.abort_flag = False
         self.all_threads = all_threads
         self.exc_info = None
+        self.stats = stats
+        if stats is not None:
+            with stats.lock:
+                stats.workers += 1
+
+        # Messages of the current input batch, in reverse order, and
+        # the output batch being filled (batched queues only).
+        self.inbox = [ ]
+        self.outbox = [ ]
+        self.outbox_deadline = None
+
+    def get(self):
+        """Get the next message from the input queue."""
+        if self.inbox:
+            return self.inbox.pop()
+
+        if self.stats is None:
+            msg = self._get()
+        else:
+            depth = self.in_queue.qsize()
+            start = time.time()
+            msg = self._get()
+            if msg is not POISON:
+                count = len(msg) if self.in_queue.batch_size > 1 else 1
+                self.stats.got(depth, time.time() - start, count)
+
+        if self.in_queue.batch_size > 1 and isinstance(msg, list):
+            msg.reverse()
+            self.inbox = msg
+            return self.inbox.pop()
+        return msg
+
+    def _get(self):
+        if self.outbox:
+            # Don't sit on a partial batch while waiting for input.
+            wait = self.outbox_deadline - time.time()
+            if wait > 0:
+                try:
+                    return self.in_queue.get(True, wait)
+                except Queue.Empty:
+                    pass
+            self.flush()
+        return self.in_queue.get()
+
+    def put(self, msg):
+        """Send a message to the output queue."""
+        if self.out_queue.batch_size > 1:
+            if not self.outbox:
+                self.outbox_deadline = time.time() + \
+                                       self.out_queue.flush_timeout
+            self.outbox.append(msg)
+            if len(self.outbox) >= self.out_queue.batch_size or \
+                    time.time() >= self.outbox_deadline:
+                self.flush()
+            return
+        self._put(msg)
+
+    def flush(self):
+        """Send the partial output batch, if any."""
+        if self.outbox:
+            batch, self.outbox = self.outbox, [ ]
+            self._put(batch, len(batch))
+
+    def _put(self, item, count=1):
+        if self.stats is None:
+            self.out_queue.put(item)
+            return
+
+        start = time.time()
+        self.out_queue.put(item)
+        self.stats.put(time.time() - start, count)
+
+    def invoke(self, func, *args):
+        """Run one step of the stage's coroutine."""
+        if self.stats is None:
+            return func(*args)
+
+        start = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.stats.worked(time.time() - start)
 
     def abort(self):
         """Shut down the thread at the next chance possible.
@@ -173,8 +458,8 @@ class FirstPipelineThread(PipelineThread):
     """The thread running the first stage in a parallel pipeline setup.
     The coroutine should just be a generator.
     """
-    def __init__(self, coro, out_queue, all_threads):
-        super(FirstPipelineThread, self).__init__(all_threads)
+    def __init__(self, coro, out_queue, all_threads, stats=None):
+        super(FirstPipelineThread, self).__init__(all_threads, stats)
         self.coro = coro
         self.out_queue = out_queue
         self.out_queue.acquire()
@@ -191,7 +476,7 @@ class FirstPipelineThread(PipelineThread):
                 
                 # Get the value from the generator.
                 try:
-                    msg = self.coro.next()
+                    msg = self.invoke(self.coro.next)
                 except StopIteration:
                     break
                 
@@ -200,25 +485,36 @@ class FirstPipelineThread(PipelineThread):
                     with self.abort_lock:
                         if self.abort_flag:
                             return
-                    self.out_queue.put(msg)
+                    self.put(msg)
 
         except:
             self.abort_all(sys.exc_info())
             return
 
         # Generator finished; shut down the pipeline.
+        try:
+            self.flush()
+        except:
+            self.abort_all(sys.exc_info())
+            return
         self.out_queue.release()
     
 class MiddlePipelineThread(PipelineThread):
     """A thread running any stage in the pipeline except the first or
     last.
     """
-    def __init__(self, coro, in_queue, out_queue, all_threads):
-        super(MiddlePipelineThread, self).__init__(all_threads)
+    def __init__(self, coro, in_queue, out_queue, all_threads, stats=None):
+        super(MiddlePipelineThread, self).__init__(all_threads, stats)
         self.coro = coro
         self.in_queue = in_queue
         self.out_queue = out_queue
         self.out_queue.acquire()
+        self.retire_flag = False
+
+    def retire(self):
+        """Exit (normally) before taking the next message."""
+        with self.abort_lock:
+            self.retire_flag = True
 
     def run(self):
         try:
@@ -229,9 +525,11 @@ class MiddlePipelineThread(PipelineThread):
                 with self.abort_lock:
                     if self.abort_flag:
                         return
+                    if self.retire_flag and not self.inbox:
+                        break
 
                 # Get the message from the previous stage.
-                msg = self.in_queue.get()
+                msg = self.get()
                 if msg is POISON:
                     break
                 
@@ -240,28 +538,33 @@ class MiddlePipelineThread(PipelineThread):
                         return
 
                 # Invoke the current stage.
-                out = self.coro.send(msg)
+                out = self.invoke(self.coro.send, msg)
                 
                 # Send messages to next stage.
                 for msg in _allmsgs(out):
                     with self.abort_lock:
                         if self.abort_flag:
                             return
-                    self.out_queue.put(msg)
+                    self.put(msg)
 
         except:
             self.abort_all(sys.exc_info())
             return
         
         # Pipeline is shutting down normally.
+        try:
+            self.flush()
+        except:
+            self.abort_all(sys.exc_info())
+            return
         self.out_queue.release()
 
 class LastPipelineThread(PipelineThread):
     """A thread running the last stage in a pipeline. The coroutine
     should yield nothing.
     """
-    def __init__(self, coro, in_queue, all_threads):
-        super(LastPipelineThread, self).__init__(all_threads)
+    def __init__(self, coro, in_queue, all_threads, stats=None):
+        super(LastPipelineThread, self).__init__(all_threads, stats)
         self.coro = coro
         self.in_queue = in_queue
 
@@ -276,7 +579,7 @@ class LastPipelineThread(PipelineThread):
                         return
                     
                 # Get the message from the previous stage.
-                msg = self.in_queue.get()
+                msg = self.get()
                 if msg is POISON:
                     break
                 
@@ -285,37 +588,601 @@ class LastPipelineThread(PipelineThread):
                         return
 
                 # Send to consumer.
-                self.coro.send(msg)
+                self.invoke(self.coro.send, msg)
 
         except:
             self.abort_all(sys.exc_info())
             return
 
+class ProcessPipelineThread(PipelineThread):
+    """The thread feeding a ProcessStage. It takes chunks of messages
+    from the input queue, hands each chunk to the stage's process pool
+    as one task and sends the results on in their original order.
+    Several chunks are kept in flight so that every process has work.
+    """
+    def __init__(self, stage, pool, in_queue, out_queue, all_threads,
+                 stats=None):
+        super(ProcessPipelineThread, self).__init__(all_threads, stats)
+        self.stage = stage
+        self.pool = pool
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.out_queue.acquire()
+
+        # Finished chunks arrive here from the pool's result thread.
+        self.results = Queue.Queue()
+        self.ready = { }
+
+    def abort(self):
+        super(ProcessPipelineThread, self).abort()
+        # Wake the thread if it is waiting for a chunk.
+        self.results.put(None)
+
+    def aborted(self):
+        with self.abort_lock:
+            return self.abort_flag
+
+    def read_chunk(self):
+        """Take up to chunksize messages, stopping early rather than
+        waiting once the input queue is empty. Returns the chunk and
+        whether the input is exhausted.
+        """
+        chunk = [ ]
+        while len(chunk) < self.stage.chunksize:
+            if chunk and not self.inbox and self.in_queue.qsize() == 0:
+                break
+            msg = self.get()
+            if msg is POISON or self.aborted():
+                return chunk, True
+            chunk.append(msg)
+        return chunk, False
+
+    def submit(self, seq, chunk):
+        def done(result):
+            self.results.put((seq, result))
+        self.pool.apply_async(_process_chunk, (self.stage.func, chunk),
+                              callback=done)
+
+    def collect(self, seq):
+        """Wait for chunk seq and return its outputs. Returns None if
+        the thread was aborted meanwhile.
+        """
+        start = time.time()
+        while seq not in self.ready:
+            result = self.results.get()
+            if result is None:
+                return None
+            self.ready[result[0]] = result[1]
+        if self.stats is not None:
+            self.stats.worked(time.time() - start)
+
+        ok, outs = self.ready.pop(seq)
+        if not ok:
+            exc, tb = outs
+            exc.remote_traceback = tb
+            raise exc
+        return outs
+
+    def run(self):
+        pending = collections.deque()
+        window = self.stage.processes * 2
+        seq = 0
+        finished = False
+        try:
+            while not self.aborted():
+                # Read more while there is room in the window, unless
+                # that means waiting for input when finished chunks
+                # could be sent on instead.
+                if not finished and len(pending) < window and \
+                        (not pending or self.inbox or self.in_queue.qsize()):
+                    chunk, finished = self.read_chunk()
+                    if chunk and not self.aborted():
+                        self.submit(seq, chunk)
+                        pending.append(seq)
+                        seq += 1
+                    continue
+                if not pending:
+                    break
+
+                outs = self.collect(pending.popleft())
+                if outs is None:
+                    return
+                for out in outs:
+                    for msg in _allmsgs(out):
+                        if self.aborted():
+                            return
+                        self.put(msg)
+
+            if self.aborted():
+                return
+            self.flush()
+        except:
+            self.abort_all(sys.exc_info())
+            return
+        self.out_queue.release()
+
+class Autoscale(object):
+    """A middle pipeline stage whose number of threads adapts to the
+    load. factory is called with no arguments to make the coroutine
+    for each new thread; between min_workers and max_workers threads
+    run the stage.
+    """
+    def __init__(self, factory, min_workers=1, max_workers=8,
+                 interval=AUTOSCALE_INTERVAL):
+        if min_workers < 1 or max_workers < min_workers:
+            raise ValueError('need 1 <= min_workers <= max_workers')
+        self.factory = factory
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.interval = interval
+
+class _Scaler(object):
+    """Adds and retires the threads of an Autoscale stage while a
+    parallel pipeline runs.
+
+    Every interval it looks at how the stage's threads spent their
+    time since the last look and at the depth of the stage's input
+    queue:
+     - mostly blocked putting: the next stage is the bottleneck, so
+       retire a thread;
+     - mostly blocked getting with an empty input queue: the stage is
+       starved, so retire a thread;
+     - mostly busy with a backlog in the input queue: the stage is the
+       bottleneck, so add a thread.
+    """
+    def __init__(self, stage, in_queue, out_queue, all_threads, stats):
+        self.stage = stage
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.all_threads = all_threads
+        self.stats = stats
+        self.workers = [ ]
+        self.last = (0.0, 0.0, 0.0)
+        self.next_check = 0.0
+
+    def active(self):
+        return [t for t in self.workers if t.isAlive() and not t.retire_flag]
+
+    def spawn(self, started=False):
+        """Make a new thread for the stage. When the pipeline is
+        already running, the thread is only added (and started) if the
+        stage hasn't finished yet; returns the thread or None.
+        """
+        if started:
+            # Hold a reference on the output queue so it cannot be
+            # poisoned while the new thread registers itself.
+            if not self.out_queue.try_acquire():
+                return None
+        try:
+            thread = MiddlePipelineThread(self.stage.factory(),
+                    self.in_queue, self.out_queue, self.all_threads,
+                    self.stats)
+        finally:
+            if started:
+                self.out_queue.release()
+        self.workers.append(thread)
+        self.all_threads.append(thread)
+        if started:
+            thread.start()
+        return thread
+
+    def adjust(self):
+        """Add or retire at most one thread. Returns +1, -1 or 0."""
+        now = time.time()
+        if now < self.next_check:
+            return 0
+        self.next_check = now + self.stage.interval
+
+        totals = self.stats.totals()
+        busy, get_wait, put_wait = [a - b for a, b in zip(totals, self.last)]
+        self.last = totals
+        spent = busy + get_wait + put_wait
+        if spent <= 0 or self.in_queue.poisoned:
+            # Nothing happened, or the stage is draining.
+            return 0
+
+        active = self.active()
+        depth = self.in_queue.qsize()
+        backlog = self.in_queue.maxsize // 2 or len(active)
+
+        if put_wait / spent > AUTOSCALE_WAIT or \
+                (get_wait / spent > AUTOSCALE_WAIT and depth == 0):
+            if len(active) > self.stage.min_workers:
+                active[-1].retire()
+                self.stats.retired()
+                return -1
+        elif depth >= backlog and busy / spent > AUTOSCALE_WAIT:
+            if len(active) < self.stage.max_workers:
+                if self.spawn(started=True) is not None:
+                    return 1
+        return 0
+
+class ProcessStage(object):
+    """A middle pipeline stage run in a pool of worker processes, for
+    CPU-bound work that the GIL would otherwise serialize. Rather than
+    a coroutine, the stage is a function: func(msg) returns what the
+    coroutine would have yielded (a message, BUBBLE or multiple(...)).
+    func, its messages and its results are pickled, so func must be
+    defined at the top level of a module and keep no state between
+    calls. Messages cross to the processes in chunks of chunksize.
+    """
+    def __init__(self, func, processes=None, chunksize=DEFAULT_CHUNKSIZE):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if processes < 1 or chunksize < 1:
+            raise ValueError('need at least one process and chunks of one')
+        self.func = func
+        self.processes = processes
+        self.chunksize = chunksize
+        self.pool = None
+
+    def start(self):
+        """Fork the worker processes now instead of when the pipeline
+        runs. The workers are forked from the running process, so if
+        it will have threads of its own running by then (a progress
+        reporter, say), start the stage before starting them: a thread
+        holding a lock at the fork leaves the lock held for good in
+        the workers. The next run uses, and shuts down, this pool.
+        """
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        return self
+
+    def _take_pool(self):
+        """The pool for a run: the one start() forked, or a new one."""
+        pool, self.pool = self.start().pool, None
+        return pool
+
+def _process_chunk(func, msgs):
+    """Apply func to each message of a chunk in a worker process.
+    Returns (True, outputs), or (False, (exception, traceback text))
+    if func raised; the traceback doesn't survive pickling, so it is
+    sent along as text.
+    """
+    try:
+        return True, [func(msg) for msg in msgs]
+    except Exception, exc:
+        tb = traceback.format_exc()
+        try:
+            pickle.dumps(exc, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            exc = RuntimeError('%s: %s' % (type(exc).__name__, exc))
+        return False, (exc, tb)
+
+def _call_coroutine(func):
+    """A coroutine applying func to each message in the current
+    thread; stands in for a ProcessStage in run_sequential.
+    """
+    msg = yield
+    while True:
+        msg = yield func(msg)
+
+def _pool_coroutine(pool, func):
+    """A coroutine sending each message to a process pool and waiting
+    for the result; stands in for a ProcessStage in run_async.
+    """
+    msg = yield
+    while True:
+        ok, outs = pool.apply(_process_chunk, (func, [msg]))
+        if not ok:
+            exc, tb = outs
+            exc.remote_traceback = tb
+            raise exc
+        msg = yield outs[0]
+
+def _close_pools(pools, failed):
+    """Shut down the process pools of a finished pipeline: let them
+    exit once idle or, if the pipeline failed, kill them outright.
+    """
+    for pool in pools:
+        if failed:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+
+class Blocking(object):
+    """A stage whose steps block (on I/O, usually); see blocking()."""
+    def __init__(self, stage):
+        self.stage = stage
+
+def blocking(stage):
+    """Mark a pipeline stage (a coroutine, a tuple of coroutines or an
+    Autoscale) as blocking, so run_async runs its steps on the
+    executor rather than in the scheduling thread.
+    """
+    return Blocking(stage)
+
+class Executor(object):
+    """A fixed pool of threads running the steps of blocking stages
+    for run_async. One executor may be shared by several pipelines.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS,
+                 stack_size=EXECUTOR_STACK_SIZE):
+        self.tasks = Queue.Queue()
+        self.threads = [ ]
+
+        old_size = None
+        if stack_size:
+            old_size = threading.stack_size(stack_size)
+        try:
+            for i in range(workers):
+                thread = Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            if stack_size:
+                threading.stack_size(old_size)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args, done = task
+            done.put(func(*args))
+
+    def submit(self, func, args, done):
+        """Call func(*args) on a pool thread and put its result on the
+        queue done. func must not raise.
+        """
+        self.tasks.put((func, args, done))
+
+    def shutdown(self):
+        """Stop the threads once the queued work is done."""
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+_EXHAUSTED = '__PIPELINE_EXHAUSTED__'
+
+class _EventLoop(object):
+    """The scheduler behind Pipeline.run_async.
+
+    Each stage has a pool of idle coroutines and (except the last) a
+    buffer for the messages it produced. A step of stage i is started
+    whenever stage i has an idle coroutine, a message to work on and
+    room in its output buffer. As with the threads of run_parallel,
+    each coroutine of a stage may still be holding a message when the
+    buffer after it fills up, so a buffer can exceed queue_size by at
+    most the stage's number of coroutines (plus multiple() messages).
+    Steps of non-blocking stages run right away in the
+    scheduling thread; steps of blocking stages go to the executor,
+    whose results come back through the done queue.
+    """
+    def __init__(self, pipeline, queue_size, executor, pools=None):
+        self.pipeline = pipeline
+        self.queue_size = queue_size
+        self.executor = executor
+        self.done = Queue.Queue()
+        self.nstages = len(pipeline.stages)
+        self.buffers = [collections.deque() for i in range(self.nstages - 1)]
+        self.blocking = list(pipeline.blocking)
+        self.idle = [ ]
+        self.spare = [ ]
+        for i, stage in enumerate(pipeline.stages):
+            if isinstance(stage, Autoscale):
+                # Coroutines are cheap here; make them as needed.
+                self.idle.append([ ])
+                self.spare.append(stage.max_workers)
+            elif isinstance(stage, ProcessStage):
+                # One coroutine per process, each waiting on the pool
+                # from an executor thread.
+                self.idle.append([_pool_coroutine(pools[i], stage.func)
+                                  for j in range(stage.processes)])
+                self.spare.append(0)
+                self.blocking[i] = True
+            else:
+                self.idle.append(list(stage))
+                self.spare.append(0)
+        self.generators = len(self.idle[0])
+        self.inflight = 0
+        self.exc_info = None
+        self.aborted = False
+
+    def runnable(self, i):
+        if not self.idle[i] and not self.spare[i]:
+            return False
+        if i == 0:
+            if not self.generators:
+                return False
+        elif not self.buffers[i-1]:
+            return False
+        if i < self.nstages - 1 and len(self.buffers[i]) >= self.queue_size:
+            return False
+        return True
+
+    def step(self, i, coro, func, args):
+        """Run one step of a coroutine, returning (stage, coroutine,
+        output, exc_info). May run on an executor thread.
+        """
+        stats = self.pipeline._stage_stats(i)
+        start = time.time()
+        try:
+            try:
+                out = func(*args)
+            except StopIteration:
+                if i != 0:
+                    raise
+                out = _EXHAUSTED
+            return i, coro, out, None
+        except:
+            return i, coro, None, sys.exc_info()
+        finally:
+            if stats is not None:
+                stats.worked(time.time() - start)
+
+    def start(self, i):
+        if self.idle[i]:
+            coro = self.idle[i].pop()
+        else:
+            self.spare[i] -= 1
+            coro = self.pipeline.stages[i].factory()
+            coro.next()
+
+        stats = self.pipeline._stage_stats(i)
+        if i == 0:
+            func, args = coro.next, ()
+        else:
+            if stats is not None:
+                stats.got(len(self.buffers[i-1]), 0.0)
+            func, args = coro.send, (self.buffers[i-1].popleft(),)
+
+        if self.blocking[i]:
+            self.inflight += 1
+            self.executor.submit(self.step, (i, coro, func, args), self.done)
+        else:
+            self.complete(*self.step(i, coro, func, args))
+
+    def complete(self, i, coro, out, exc_info):
+        if exc_info is not None:
+            if self.exc_info is None:
+                self.exc_info = exc_info
+            return
+        if out is _EXHAUSTED:
+            self.generators -= 1
+            return
+
+        self.idle[i].append(coro)
+        if i < self.nstages - 1:
+            msgs = _allmsgs(out)
+            self.buffers[i].extend(msgs)
+            stats = self.pipeline._stage_stats(i)
+            if stats is not None:
+                stats.put(0.0, len(msgs))
+
+    def schedule(self):
+        """Start every step that can run, downstream stages first so
+        that buffers drain before they are filled further.
+        """
+        progress = True
+        while progress and self.exc_info is None:
+            progress = False
+            for i in reversed(range(self.nstages)):
+                while self.exc_info is None and self.runnable(i):
+                    self.start(i)
+                    progress = True
+
+    def finished(self):
+        return not self.generators and not self.inflight and \
+               not any(self.buffers)
+
+    def wait(self):
+        """Handle the results the executor has ready, waiting for at
+        least one. (No timeout here: in Python 2 a timed wait polls,
+        which would delay every result; run_async watches for ^C
+        instead and wakes us with abort().)
+        """
+        results = [self.done.get()]
+        try:
+            while True:
+                results.append(self.done.get_nowait())
+        except Queue.Empty:
+            pass
+
+        for result in results:
+            if result is None:
+                # Woken up by abort().
+                continue
+            self.inflight -= 1
+            self.complete(*result)
+
+    def abort(self):
+        """Stop scheduling and abandon whatever is in flight. May be
+        called from any thread.
+        """
+        self.aborted = True
+        self.done.put(None)
+
+    def run(self):
+        try:
+            for i in range(1, self.nstages):
+                for coro in self.idle[i]:
+                    coro.next()
+
+            while not self.aborted:
+                self.schedule()
+                if self.exc_info is not None or self.finished() or \
+                        not self.inflight:
+                    break
+                self.wait()
+
+            # Let in-flight steps finish so nothing runs on after we
+            # return.
+            while self.inflight and not self.aborted:
+                self.wait()
+        except:
+            if self.exc_info is None:
+                self.exc_info = sys.exc_info()
+
 class Pipeline(object):
     """Represents a staged pattern of work. Each stage in the pipeline
     is a coroutine that receives messages from the previous stage and
     yields messages to be sent to the next stage.
     """
-    def __init__(self, stages):
+    def __init__(self, stages, instrument=False, names=None):
         """Makes a new pipeline from a list of coroutines. There must
-        be at least two stages.
+        be at least two stages. If instrument is set, parallel and
+        asynchronous runs keep per-stage statistics (see snapshot());
+        names optionally labels the stages in those statistics.
         """
         if len(stages) < 2:
             raise ValueError('pipeline must have at least two stages')
         self.stages = []
+        self.blocking = []
         for stage in stages:
+            self.blocking.append(isinstance(stage, Blocking))
+            if isinstance(stage, Blocking):
+                stage = stage.stage
             if isinstance(stage, types.GeneratorType):
                 # Default to one thread per stage.
                 self.stages.append((stage,))
             else:
                 self.stages.append(stage)
+
+        for i, stage in enumerate(self.stages):
+            if isinstance(stage, Autoscale) and \
+                    not 0 < i < len(self.stages) - 1:
+                raise ValueError('only middle stages can be autoscaled')
+            if isinstance(stage, ProcessStage) and \
+                    not 0 < i < len(self.stages) - 1:
+                raise ValueError('only middle stages can run in processes')
+
+        self.stats = None
+        if instrument:
+            if names is None:
+                names = ['stage%i' % i for i in range(len(self.stages))]
+            self.stats = [StageStats(name) for name in names]
+
+    def _stage_stats(self, i):
+        if self.stats is None:
+            return None
+        return self.stats[i]
+
+    def snapshot(self):
+        """Return a list with a dictionary of statistics for each
+        stage, or None if the pipeline is not instrumented. Safe to
+        call while the pipeline is running.
+        """
+        if self.stats is None:
+            return None
+        return [stats.snapshot() for stats in self.stats]
         
     def run_sequential(self):
         """Run the pipeline sequentially in the current thread. The
         stages are run one after the other. Only the first coroutine
         in each stage is used.
         """
-        coros = [stage[0] for stage in self.stages]
+        coros = [ ]
+        for stage in self.stages:
+            if isinstance(stage, Autoscale):
+                coros.append(stage.factory())
+            elif isinstance(stage, ProcessStage):
+                coros.append(_call_coroutine(stage.func))
+            else:
+                coros.append(stage[0])
 
         # "Prime" the coroutines.
         for coro in coros[1:]:
@@ -331,44 +1198,87 @@ class Pipeline(object):
                     next_msgs.extend(_allmsgs(out))
                 msgs = next_msgs
     
-    def run_parallel(self, queue_size=DEFAULT_QUEUE_SIZE):
-        """Run the pipeline in parallel using one thread per stage. The
-        messages between the stages are stored in queues of the given
-        size.
+    def run_parallel(self, queue_size=DEFAULT_QUEUE_SIZE, batch_size=1,
+                     flush_timeout=DEFAULT_FLUSH_TIMEOUT):
+        """Run the pipeline in parallel using one thread per stage
+        (or per coroutine, for stages given several, or as many as
+        needed for Autoscale stages). The messages between the stages
+        are stored in queues of the given size, in batches of up to
+        batch_size messages.
         """
-        queues = [CountedQueue(queue_size) for i in range(len(self.stages)-1)]
+        queues = [CountedQueue(queue_size, batch_size, flush_timeout)
+                  for i in range(len(self.stages)-1)]
         threads = []
+        scalers = []
+        pools = { }
 
         # Set up first stage.
         for coro in self.stages[0]:
-            threads.append(FirstPipelineThread(coro, queues[0], threads))
+            threads.append(FirstPipelineThread(
+                coro, queues[0], threads, self._stage_stats(0)
+            ))
 
         # Middle stages.
         for i in range(1, len(self.stages)-1):
-            for coro in self.stages[i]:
+            stage = self.stages[i]
+            if isinstance(stage, Autoscale):
+                # Scaling decisions need the stage's counters, even
+                # if the pipeline itself is not instrumented.
+                stats = self._stage_stats(i) or StageStats('stage%i' % i)
+                scaler = _Scaler(stage, queues[i-1], queues[i], threads, stats)
+                for j in range(stage.min_workers):
+                    scaler.spawn()
+                scalers.append(scaler)
+                continue
+            if isinstance(stage, ProcessStage):
+                # Fork before the pipeline's threads are running (the
+                # caller's have to be started after stage.start()).
+                pools[i] = stage._take_pool()
+                threads.append(ProcessPipelineThread(
+                    stage, pools[i], queues[i-1], queues[i], threads,
+                    self._stage_stats(i)
+                ))
+                continue
+            for coro in stage:
                 threads.append(MiddlePipelineThread(
-                    coro, queues[i-1], queues[i], threads
+                    coro, queues[i-1], queues[i], threads, self._stage_stats(i)
                 ))
 
         # Last stage.
         for coro in self.stages[-1]:
-            threads.append(
-                LastPipelineThread(coro, queues[-1], threads)
-            )
+            threads.append(LastPipelineThread(
+                coro, queues[-1], threads, self._stage_stats(-1)
+            ))
         
         # Start threads.
-        for thread in threads:
-            thread.start()
+        try:
+            for thread in threads:
+                thread.start()
+        except:
+            for pool in pools.values():
+                pool.terminate()
+            raise
+
+        # Autoscaled stages append threads as they go; keep hold of
+        # the final one.
+        final = threads[-1]
+        timeout = 1
+        if scalers:
+            timeout = min([1] + [sc.stage.interval for sc in scalers])
         
         # Wait for termination. The final thread lasts the longest.
+        interrupted = False
         try:
             # Using a timeout allows us to receive KeyboardInterrupt
             # exceptions during the join().
-            while threads[-1].isAlive():
-                threads[-1].join(1)
+            while final.isAlive():
+                final.join(timeout)
+                for scaler in scalers:
+                    scaler.adjust()
 
         except:
             # Stop all the threads immediately.
+            interrupted = True
             for thread in threads:
                 thread.abort()
             raise
@@ -377,8 +1287,11 @@ class Pipeline(object):
             # Make completely sure that all the threads have finished
             # before we return. They should already be either finished,
             # in normal operation, or aborted, in case of an exception.
-            for thread in threads[:-1]:
-                thread.join()
+            for thread in threads:
+                if thread is not final:
+                    thread.join()
+            _close_pools(pools.values(), interrupted or
+                         any(thread.exc_info for thread in threads))
 
         for thread in threads:
             exc_info = thread.exc_info
@@ -386,7 +1299,52 @@ class Pipeline(object):
                 # Make the exception appear as it was raised originally.
                 raise exc_info[0], exc_info[1], exc_info[2]
 
+    def run_async(self, queue_size=DEFAULT_QUEUE_SIZE,
+                  workers=DEFAULT_WORKERS, executor=None):
+        """Run the pipeline from the current thread, with the steps of
+        blocking() stages on an executor of the given number of
+        workers (or on executor, which is then left running). Every
+        coroutine of a stage, or up to max_workers coroutines of an
+        Autoscale stage, may be working at the same time; the buffer
+        after each stage holds up to queue_size messages.
+        """
+        pools = { }
+        for i, stage in enumerate(self.stages):
+            if isinstance(stage, ProcessStage):
+                pools[i] = stage._take_pool()
+
+        own_executor = executor is None and \
+                       (any(self.blocking) or bool(pools))
+        if own_executor:
+            executor = Executor(workers)
+        loop = _EventLoop(self, queue_size, executor, pools)
+        thread = Thread(target=loop.run)
+        try:
+            thread.start()
+            # As in run_parallel, a timeout allows us to receive
+            # KeyboardInterrupt exceptions during the join().
+            while thread.isAlive():
+                thread.join(1)
+        except:
+            loop.abort()
+            raise
+        finally:
+            thread.join()
+            if own_executor:
+                executor.shutdown()
+            _close_pools(pools.values(), loop.exc_info or loop.aborted)
+
+        if loop.exc_info is not None:
+            exc_info = loop.exc_info
+            raise exc_info[0], exc_info[1], exc_info[2]
+
 # Smoke test.
+def _square(num):
+    # Process stages need a top-level function.
+    if num % 5 == 0:
+        return BUBBLE
+    return num * num
+
 if __name__ == '__main__':
     import time
     
@@ -420,6 +1378,66 @@ if __name__ == '__main__':
     print 'Multiply-parallel time:', ts_end - ts_par
     print
 
+    # Test an instrumented pipeline.
+    pl = Pipeline([produce(), (work(), work()), consume()], instrument=True,
+                  names=['produce', 'work', 'consume'])
+    pl.run_parallel()
+    print 'Stats:', format_snapshot(pl.snapshot())
+    print
+
+    # Test an autoscaled pipeline: work() is the bottleneck, so it
+    # should grow to several threads.
+    def fast_produce():
+        for i in range(40):
+            yield i
+    def slow_work():
+        num = yield
+        while True:
+            time.sleep(0.2)
+            num = yield num*2
+    def quiet_consume():
+        while True:
+            num = yield
+    pl = Pipeline([fast_produce(), Autoscale(slow_work, 1, 8, 0.2),
+                   quiet_consume()], instrument=True,
+                  names=['produce', 'work', 'consume'])
+    ts_start = time.time()
+    pl.run_parallel()
+    print 'Autoscaled time:', time.time() - ts_start
+    print 'Stats:', format_snapshot(pl.snapshot())
+    print
+
+    # Test an asynchronous pipeline: 32 sleeping workers share the
+    # executor's threads.
+    def sleepy_work():
+        num = yield
+        while True:
+            time.sleep(0.5)
+            num = yield num*2
+    ts_start = time.time()
+    Pipeline([fast_produce(),
+              blocking([sleepy_work() for i in range(32)]),
+              quiet_consume()]).run_async(workers=32)
+    print 'Asynchronous time:', time.time() - ts_start
+    print
+
+    # Test a process stage: the squares are computed in two worker
+    # processes, in chunks (run_async doesn't keep their order).
+    squares = [ ]
+    def collect_squares():
+        while True:
+            squares.append((yield))
+    for run in ('run_sequential', 'run_parallel', 'run_async'):
+        del squares[:]
+        pl = Pipeline([fast_produce(), ProcessStage(_square, 2, 4),
+                       collect_squares()])
+        getattr(pl, run)()
+        if run == 'run_async':
+            squares.sort()
+        print 'Process stage (%s):' % run, \
+              squares == [i * i for i in range(40) if i % 5]
+    print
+
     # Test a pipeline that raises an exception.
     def exc_produce():
         for i in range(10):
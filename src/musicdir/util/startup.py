@@ -0,0 +1,91 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Import timing for musicdir --profile-startup."""
+import sys
+import time
+import __builtin__
+
+# Imports quicker than this (in seconds) are left out of the report.
+REPORT_THRESHOLD = 0.0005
+
+class ImportProfiler(object):
+    """Times the imports done while it is installed, keeping for each
+    imported name the total time spent (including the modules it
+    imported in turn) and the time spent in the module itself.
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.times = { }
+        self.stack = [ ]
+        self.marks = [ ]
+        self.original = None
+
+    def mark(self, label):
+        """Note that the step called label has just finished."""
+        self.marks.append((label, time.time()))
+
+    def install(self):
+        self.original = __builtin__.__import__
+        __builtin__.__import__ = self._import
+
+    def uninstall(self):
+        if self.original is not None:
+            __builtin__.__import__ = self.original
+            self.original = None
+
+    def _import(self, name, globals=None, locals=None, fromlist=None,
+                level=-1):
+        if name in sys.modules and not fromlist:
+            return self.original(name, globals, locals, fromlist, level)
+        # For "from package import module", the time goes to the
+        # submodules that weren't loaded yet.
+        submodules = [ ]
+        if fromlist:
+            submodules = ['%s.%s' % (name, item) for item in fromlist
+                          if '%s.%s' % (name, item) not in sys.modules]
+
+        # Time spent in nested imports is added to the top of the
+        # stack, to be taken off the importing module's own time.
+        self.stack.append(0.0)
+        start = time.time()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            loaded = [sub for sub in submodules if sub in sys.modules]
+            key = ', '.join(loaded) or name
+            entry = self.times.setdefault(key, [0.0, 0.0])
+            entry[0] += elapsed
+            entry[1] += elapsed - nested
+
+    def report(self, out, limit=30):
+        """Write the slowest imports to out."""
+        total = time.time() - self.start
+        importing = sum(own for inclusive, own in self.times.values())
+        print >>out, 'startup: %.1f ms in total, %.1f ms importing' % \
+                     (total * 1000, importing * 1000)
+        last = self.start
+        for label, when in self.marks:
+            print >>out, '%10.1f ms  %s' % ((when - last) * 1000, label)
+            last = when
+        print >>out, '%10s %10s  %s' % ('self ms', 'total ms', 'module')
+        rows = sorted(self.times.items(), key=lambda item: -item[1][1])
+        for name, (inclusive, own) in rows[:limit]:
+            if own < REPORT_THRESHOLD:
+                break
+            print >>out, '%10.1f %10.1f  %s' % (own * 1000, inclusive * 1000, name)
@@ -0,0 +1,439 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Keep the library in sync with directories as they change.
+
+A watcher reports changes below its directories as events:
+    ('change', path)      a file was written, or a directory appeared
+    ('delete', path)      a file or directory is gone
+    ('move', src, dst)    a file or directory was renamed
+The Inotify watcher gets them from the kernel (through ctypes, so
+there is nothing to install); the Poller finds them by comparing
+periodic scans, for systems or file systems without inotify.
+
+Events are collected into a Batch until things have been quiet for a
+moment (copying an album is a burst of hundreds of events) and then
+applied at once: renames only rewrite File.path, deletes drop the
+files' rows (Library.forget_files), and only changed or new audio
+files have their tags read, in a thread pool.
+"""
+import os
+import sys
+import time
+import errno
+import struct
+import select
+import logging
+import ctypes
+import ctypes.util
+from multiprocessing.pool import ThreadPool
+
+from musicdir.util import bytestring_path, syspath, sorted_walk
+
+DEBOUNCE = 1.0   # seconds of quiet before a batch is applied
+MAX_DELAY = 10.0 # ... but never wait longer than this
+POLL_INTERVAL = 5.0
+DEFAULT_THREADS = 4
+
+# How long a rename may take to show up on both sides in inotify.
+MOVE_TIMEOUT = 0.5
+
+log = logging.getLogger('musicdir')
+
+class WatchError(Exception):
+    pass
+
+# {{{ inotify
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+             IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+EVENT = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+class Inotify(object):
+    """Watches directory trees with inotify, one watch per directory."""
+    def __init__(self, roots):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+            fd = libc.inotify_init()
+        except (OSError, AttributeError), exc:
+            raise WatchError('inotify is not available: %s' % exc)
+        if fd < 0:
+            raise WatchError('inotify_init: %s' % os.strerror(ctypes.get_errno()))
+        self.fd = fd
+        self.roots = roots
+        self.watches = { } # watch descriptor -> directory
+        self.moved = { } # cookie -> (path, is directory, time)
+        for root in roots:
+            self.watch_tree(root)
+
+    def watch_tree(self, top):
+        for root, dirs, files in sorted_walk(top):
+            if not os.path.isdir(syspath(root)):
+                continue
+            wd = self._add_watch(self.fd, syspath(root), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err in (errno.ENOENT, errno.ENOTDIR):
+                    # Gone already; its delete event is on the way.
+                    continue
+                raise WatchError('cannot watch %s: %s' % (root, os.strerror(err)))
+            self.watches[wd] = root
+
+    def unwatch_tree(self, top):
+        for wd, path in self.watches.items():
+            if path == top or path.startswith(top + os.sep):
+                self._rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def rename_tree(self, src, dst):
+        for wd, path in self.watches.items():
+            if path == src or path.startswith(src + os.sep):
+                self.watches[wd] = dst + path[len(src):]
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds (or forever) for events; returns
+        a list of events, empty on timeout.
+        """
+        if self.moved:
+            # Unmatched renames have to be expired in time.
+            if timeout is None or timeout > MOVE_TIMEOUT:
+                timeout = MOVE_TIMEOUT
+        ready = select.select([self.fd], [ ], [ ], timeout)[0]
+        events = [ ]
+        if ready:
+            data = os.read(self.fd, READ_SIZE)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = EVENT.unpack_from(data, offset)
+                offset += EVENT.size
+                name = data[offset:offset + size].rstrip('\0')
+                offset += size
+                self._event(events, wd, mask, cookie, name)
+
+        # A rename whose other half never came moved something out of
+        # the watched directories.
+        now = time.time()
+        for cookie, (path, isdir, when) in self.moved.items():
+            if now - when >= MOVE_TIMEOUT:
+                del self.moved[cookie]
+                if isdir:
+                    self.unwatch_tree(path)
+                events.append(('delete', path))
+        return events
+
+    def _event(self, events, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost; look for anything new from the top.
+            log.warning(u'watch: inotify queue overflowed, rescanning')
+            events.extend(('change', root) for root in self.roots)
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        path = os.path.join(directory, name) if name else directory
+        isdir = bool(mask & IN_ISDIR)
+
+        if mask & IN_MOVED_FROM:
+            self.moved[cookie] = (path, isdir, time.time())
+        elif mask & IN_MOVED_TO:
+            if cookie in self.moved:
+                src, srcdir, when = self.moved.pop(cookie)
+                if isdir:
+                    self.rename_tree(src, path)
+                events.append(('move', src, path))
+            else:
+                if isdir:
+                    self.watch_tree(path)
+                events.append(('change', path))
+        elif mask & IN_CREATE:
+            # Files are reported once they are written and closed.
+            if isdir:
+                self.watch_tree(path)
+                events.append(('change', path))
+        elif mask & IN_CLOSE_WRITE:
+            events.append(('change', path))
+        elif mask & IN_DELETE:
+            events.append(('delete', path))
+        elif mask & IN_DELETE_SELF:
+            if directory in self.roots:
+                events.append(('delete', directory))
+
+    def close(self):
+        os.close(self.fd)
+# }}} end inotify
+
+# {{{ polling
+class Poller(object):
+    """Finds changes by scanning the directory trees every interval
+    seconds and comparing sizes and modification times with the last
+    scan. A file that disappears while one with the same size and time
+    appears is taken to have been renamed.
+    """
+    def __init__(self, roots, interval=POLL_INTERVAL):
+        self.roots = roots
+        self.interval = interval
+        self.files = self.scan()
+        self.next_scan = time.time() + interval
+
+    def scan(self):
+        files = { }
+        for top in self.roots:
+            for root, dirs, names in sorted_walk(top):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(syspath(path))
+                    except OSError:
+                        continue
+                    files[path] = (st.st_size, st.st_mtime)
+        return files
+
+    def read(self, timeout=None):
+        wait = self.next_scan - time.time()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(timeout, 0))
+            return [ ]
+        if wait > 0:
+            time.sleep(wait)
+        self.next_scan = time.time() + self.interval
+
+        old, self.files = self.files, self.scan()
+        events = [ ]
+        gone = dict((stat, path) for path, stat in old.items()
+                    if path not in self.files)
+        for path, stat in sorted(self.files.items()):
+            if path not in old:
+                if stat in gone:
+                    events.append(('move', gone.pop(stat), path))
+                else:
+                    events.append(('change', path))
+            elif old[path] != stat:
+                events.append(('change', path))
+        for stat, path in sorted(gone.items()):
+            events.append(('delete', path))
+        return events
+
+    def close(self):
+        pass
+# }}} end polling
+
+def open_watcher(roots, poll=False, interval=POLL_INTERVAL):
+    """Return an Inotify watcher for roots, or a Poller if inotify
+    can't be used or poll is set.
+    """
+    if not poll:
+        try:
+            return Inotify(roots)
+        except WatchError, exc:
+            log.warning(u'watch: %s; polling instead' % exc)
+    return Poller(roots, interval)
+
+# {{{ batches
+class Batch(object):
+    """The changes collected since the last batch was applied. Later
+    events override earlier ones for the same path.
+    """
+    def __init__(self):
+        self.moves = [ ]
+        self.deleted = set()
+        self.changed = set()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, event):
+        self.count += 1
+        if event[0] == 'change':
+            self.changed.add(event[1])
+            self.deleted.discard(event[1])
+        elif event[0] == 'delete':
+            self.deleted.add(event[1])
+            self.changed.discard(event[1])
+        elif event[0] == 'move':
+            src, dst = event[1:]
+            self.moves.append((src, dst))
+            self.deleted.discard(dst)
+            if src in self.changed:
+                # Written, then renamed: read it under its new name.
+                self.changed.discard(src)
+                self.changed.add(dst)
+
+def _read_tags(path):
+    from musicdir.mediafile import MediaFile, UnreadableFileError
+    try:
+        return MediaFile(syspath(path))
+    except (UnreadableFileError, IOError, OSError):
+        return None
+
+def _files_under(session, files, path):
+    """The (id, path) rows of the file at path or below it."""
+    from sqlalchemy import select, or_, and_
+    # Everything below path sorts between path/ and path0.
+    below = and_(files.c.path > path + os.sep,
+                 files.c.path < path + chr(ord(os.sep) + 1))
+    return session.execute(select([files.c.id, files.c.path],
+                           or_(files.c.path == path, below))).fetchall()
+
+class Syncer(object):
+    """Applies batches of changes to the library."""
+    def __init__(self, lib, threads=DEFAULT_THREADS):
+        self.lib = lib
+        self.pool = ThreadPool(threads)
+
+    def apply(self, batch):
+        """Apply a batch, committing the renames and deletes before
+        reading any files. Returns a dictionary of counts of what was
+        done.
+        """
+        from musicdir.library import File
+        session = self.lib.session
+        files = File.__table__
+        counts = {'moved': 0, 'deleted': 0, 'added': 0, 'updated': 0,
+                  'unreadable': 0}
+
+        # Renames and deletes just rewrite paths.
+        for src, dst in batch.moves:
+            counts['moved'] += self.lib.set_paths(
+                    (id, dst + str(path)[len(src):])
+                    for id, path in _files_under(session, files, src))
+        ids = set()
+        for path in batch.deleted:
+            ids.update(id for id, p in _files_under(session, files, path))
+        counts['deleted'] = self.lib.forget_files(ids)
+        session.commit()
+
+        # Only new or rewritten audio files are read.
+        paths = self.audio_paths(batch.changed)
+        tags = self.pool.map(_read_tags, paths)
+        touched = set()
+        trackfiles = [ ]
+        for path, mediafile in zip(paths, tags):
+            if mediafile is None:
+                log.debug(u'watch: cannot read %s' % path.decode('utf8', 'replace'))
+                counts['unreadable'] += 1
+                continue
+            trackfile = self.apply_file(path, mediafile, counts, touched)
+            if trackfile is not None:
+                trackfiles.append(trackfile)
+
+        if counts['added'] or counts['updated']:
+            session.flush()
+            touched.update(tf.track_id for tf in trackfiles)
+            self.lib.update_keys(touched)
+            self.lib.bump_generation()
+        session.commit()
+        return counts
+
+    def audio_paths(self, changed):
+        """The audio files to read for the changed paths: each changed
+        file, and the files in new directories not yet in the library.
+        """
+        from musicdir.importer import AUDIO_RE
+        paths = set()
+        for path in changed:
+            if os.path.isdir(syspath(path)):
+                found = [ ]
+                for root, dirs, names in sorted_walk(path):
+                    found.extend(os.path.join(root, name) for name in names
+                                 if AUDIO_RE.search(name))
+                paths.update(set(found) - self.lib.known_paths(found))
+            elif AUDIO_RE.search(path) and os.path.exists(syspath(path)):
+                paths.add(path)
+        return sorted(paths)
+
+    def apply_file(self, path, mediafile, counts, touched):
+        """Add or refresh the file at path, returning its track file (or
+        None). The ids of tracks it is taken from are added to touched.
+        """
+        from musicdir.library import File, TrackFile
+        from musicdir import importer
+        session = self.lib.session
+        file = session.query(File).filter(File.path == path).first()
+        if file is not None:
+            trackfile = session.query(TrackFile)\
+                    .filter(TrackFile.file_id == file.id).first()
+            if trackfile is not None and trackfile.track is not None:
+                touched.add(trackfile.track_id)
+                trackfile = importer.refresh_track(lib=self.lib,
+                        trackfile=trackfile, mediafile=mediafile)
+                counts['updated'] += 1
+                return trackfile
+        else:
+            file = File(path=path)
+        track = importer.import_track(lib=self.lib, file=file,
+                                      mediafile=mediafile)
+        if track is not None:
+            session.add(track)
+            counts['added'] += 1
+        return track
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+# }}} end batches
+
+def watch(lib, roots, poll=False, interval=POLL_INTERVAL,
+          debounce=DEBOUNCE, max_delay=MAX_DELAY, threads=DEFAULT_THREADS,
+          report=None):
+    """Keep lib in sync with the directories in roots until
+    interrupted. report, if given, is called with the counts of each
+    applied batch.
+    """
+    roots = [bytestring_path(os.path.abspath(root)) for root in roots]
+    watcher = open_watcher(roots, poll, interval)
+    syncer = Syncer(lib, threads)
+    batch = Batch()
+    first = last = None
+    try:
+        while True:
+            timeout = None
+            if batch:
+                timeout = max(0, min(last + debounce, first + max_delay)
+                                 - time.time())
+            events = watcher.read(timeout)
+            now = time.time()
+            if events:
+                for event in events:
+                    batch.add(event)
+                if first is None:
+                    first = now
+                last = now
+            if batch and (now >= last + debounce or now >= first + max_delay):
+                counts = syncer.apply(batch)
+                if report is not None:
+                    report(counts)
+                batch = Batch()
+                first = last = None
+    finally:
+        watcher.close()
+        syncer.close()
@@ -0,0 +1,72 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""What the tests share: a library in a temporary directory."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from musicdir.library import Library, Artist, Release, Track, Session
+
+class LibraryTestCase(unittest.TestCase):
+    """A test with an empty library, self.lib, in self.dir."""
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='musicdir-test-')
+        Session.remove()
+        self.lib = Library('sqlite:///' + os.path.join(self.dir, 'musicdir.db'),
+                           directory=self.dir)
+
+    def tearDown(self):
+        Session.remove()
+        shutil.rmtree(self.dir)
+
+    def artist(self, name):
+        """The artist called name, added if there is none."""
+        artist = self.lib.session.query(Artist).filter(Artist.name == name).first()
+        if artist is None:
+            artist = Artist(name=name)
+            self.lib.add(artist)
+        return artist
+
+    def release(self, name, artist):
+        """The release called name by artist, added if there is none."""
+        artist = self.artist(artist)
+        release = self.lib.session.query(Release) \
+                .filter(Release.name == name) \
+                .filter(Release.artist == artist).first()
+        if release is None:
+            release = Release(name=name, artist=artist)
+            self.lib.add(release)
+        return release
+
+    def track(self, title, artist=u'Artist', release=None, **values):
+        """Add a track (of release, by artist, if given) and return it;
+        values are further Track columns.
+        """
+        track = Track(artist=self.artist(artist), title=title,
+                      release=self.release(release, artist) if release else None)
+        for name, value in values.items():
+            setattr(track, name, value)
+        self.lib.add(track)
+        return track
+
+    def commit(self, edited=True):
+        """Commit what was added, with its keys and a new generation."""
+        self.lib.update_keys()
+        self.lib.bump_generation(edited)
+        self.lib.session.commit()
+
+    def titles(self, fields):
+        return sorted(t.title for t in self.lib.tracks(fields))
@@ -0,0 +1,79 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+
+"""Cover art is stored once, whether it was found in a folder or
+embedded in the files.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import os
+import sys
+import unittest
+import ConfigParser
+from StringIO import StringIO
+
+import _common
+from musicdir.library import File, Attachment, TrackFile, ArtBlob
+from musicdir.ui import commands
+from musicdir.artcache import ArtCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'benchmarks'))
+import synth
+
+class FolderArtTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(FolderArtTest, self).setUp()
+        self.music = os.path.join(self.dir, 'music')
+        # every folder.png and embedded cover is the same image
+        synth.generate(self.music, 1, 2, 2, formats=('mp3',))
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('musicdir')
+        config.set('musicdir', 'art_directory', os.path.join(self.dir, 'art'))
+        opts, args = commands.import_cmd.parser.parse_args([ '-a', self.music ])
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            commands.import_func(self.lib, config, opts, args)
+        finally:
+            sys.stdout = stdout
+
+    def test_one_attachment_for_cover_and_folder_art(self):
+        session = self.lib.session
+        self.assertEqual(session.query(ArtBlob).count(), 1)
+        self.assertEqual(session.query(Attachment).count(), 1)
+        cover = session.query(Attachment).one()
+        trackfiles = session.query(TrackFile).all()
+        self.assertEqual(len(trackfiles), 4)
+        for trackfile in trackfiles:
+            self.assertTrue(trackfile.cover is cover)
+            self.assertEqual(trackfile.attachments, [ cover ])
+        # nothing refers to the folder.png files themselves
+        self.assertEqual(session.query(File)
+                         .filter(File.path.like(u'%folder.png')).count(), 0)
+
+    def test_eviction_drops_the_attachment(self):
+        cache = ArtCache(self.lib, os.path.join(self.dir, 'art'), max_size=0)
+        self.assertEqual(cache.evict(), 1)
+        self.lib.session.commit()
+        self.assertEqual(self.lib.session.query(Attachment).count(), 0)
+        for trackfile in self.lib.session.query(TrackFile):
+            self.assertEqual(trackfile.cover, None)
+            self.assertEqual(trackfile.attachments, [ ])
+        # embedded art comes back on demand
+        trackfile = self.lib.session.query(TrackFile).first()
+        self.assertTrue(cache.cover(trackfile) is not None)
+
+if __name__ == '__main__':
+    unittest.main()
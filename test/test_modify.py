@@ -0,0 +1,102 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""Edit files, planning edits and applying them."""
+import os
+import sys
+import unittest
+import ConfigParser
+from StringIO import StringIO
+
+import _common
+from musicdir import modify, ui
+from musicdir.library import Artist, Release, Track
+
+class StdinTest(unittest.TestCase):
+    def test_read_edits_from_stdin(self):
+        stdin = sys.stdin
+        sys.stdin = StringIO('[{"id": 3, "title": "Intro", "bpm": "120"}]')
+        try:
+            edits = modify.read_edits('-')
+        finally:
+            sys.stdin = stdin
+        self.assertEqual(edits, { 3: { 'title': u'Intro', 'bpm': 120 } })
+
+    def test_reads_stdin(self):
+        for args in ([ 'modify', '--from', '-' ], [ 'modify', '-f', '-' ],
+                     [ 'mod', '--from=-' ], [ 'modify', '-n', '-f-' ]):
+            self.assertTrue(ui.reads_stdin(args), args)
+        for args in ([ 'modify', '--from', 'edits.json' ], [ 'ls', '-' ],
+                     [ 'modify', '-f' ]):
+            self.assertFalse(ui.reads_stdin(args), args)
+
+    def test_stdin_commands_are_not_forwarded(self):
+        # a socket path that exists: anything else would be forwarded
+        config = ConfigParser.SafeConfigParser()
+        config.add_section('musicdir')
+        config.set('musicdir', 'socket', os.path.abspath(__file__))
+        saved = os.environ.pop(ui.NO_DAEMON_VAR, None)
+        try:
+            self.assertEqual(ui.forward(None, config,
+                                        [ 'modify', '--from', '-' ]), None)
+        finally:
+            if saved is not None:
+                os.environ[ui.NO_DAEMON_VAR] = saved
+
+class PlanTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(PlanTest, self).setUp()
+        self.one = self.track(u'One', artist=u'The Beatles', release=u'Help!')
+        self.two = self.track(u'Two', artist=u'The Beatles', release=u'Help!')
+        self.commit()
+
+    def apply(self, edits):
+        changes, current, unknown = modify.plan(self.lib, edits)
+        count = modify.apply(self.lib, changes, current)
+        self.lib.session.commit()
+        return count
+
+    def test_plan_keeps_only_changes(self):
+        changes, current, unknown = modify.plan(self.lib, {
+                self.one.id: { 'title': u'One', 'genre': u'Pop' },
+                self.two.id: { 'title': u'Two' },
+                999: { 'title': u'Nothing' } })
+        self.assertEqual(changes, { self.one.id: { 'genre': u'Pop' } })
+        self.assertEqual(unknown, [ 999 ])
+
+    def test_apply_updates_keys(self):
+        self.assertEqual(self.apply({ self.one.id: { 'title': u'Uno' } }), 1)
+        self.assertEqual(self.titles([ u'title=uno' ]), [ u'Uno' ])
+
+    def test_artist_found_by_search_key(self):
+        self.apply({ self.one.id: { 'artist': u'Beatles, The' },
+                     self.two.id: { 'artist': u'the beatles' } })
+        self.assertEqual(self.lib.session.query(Artist).count(), 1)
+
+    def test_new_names_sharing_a_key_add_one_artist(self):
+        self.apply({ self.one.id: { 'artist': u'Wings' },
+                     self.two.id: { 'artist': u'WINGS' } })
+        artists = self.lib.session.query(Artist).order_by(Artist.id).all()
+        self.assertEqual(len(artists), 2)
+        self.assertEqual(artists[1].search_name, u'wings')
+        self.assertEqual(self.titles([ u'artist=wings' ]), [ u'One', u'Two' ])
+
+    def test_release_found_by_search_key(self):
+        self.apply({ self.one.id: { 'album': u'help' } })
+        self.assertEqual(self.lib.session.query(Release).count(), 1)
+        self.apply({ self.one.id: { 'album': u'Rubber Soul' } })
+        self.assertEqual(self.lib.session.query(Release).count(), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+
+"""Keyset paging of sorted tracks: pages put together are the sorted
+tracks, whatever the page size and however many tracks share a key.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import datetime
+import unittest
+
+import _common
+from musicdir.library import SORT_ORDERS
+
+class TrackPageTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(TrackPageTest, self).setUp()
+        # few distinct values, so that pages end inside runs of ties,
+        # and some missing ones
+        for n in range(23):
+            self.track(u'Track %02i' % n, artist=u'Artist %i' % (n % 3),
+                       release=u'Release %i' % (n % 4),
+                       length=None if n % 5 == 0 else 100 * (n % 4),
+                       date=None if n % 7 == 0 else datetime.date(2000 + n % 3, 1, 1))
+        self.commit()
+
+    def pages(self, order, limit, fields=None):
+        ids, after = [ ], None
+        while True:
+            page = self.lib.track_page(fields, order, limit, after)
+            self.assertTrue(len(page) <= limit)
+            if not page:
+                return ids
+            ids.extend(track.id for track in page)
+            after = page[-1].id
+
+    def test_pages_make_up_the_order(self):
+        for order in SORT_ORDERS:
+            whole = [ track.id for track in self.lib.track_page(None, order) ]
+            self.assertEqual(sorted(whole), range(1, 24))
+            for limit in (1, 2, 5, 23, 50):
+                self.assertEqual(self.pages(order, limit), whole,
+                                 (order, limit))
+
+    def test_ties_are_in_id_order(self):
+        tracks = self.lib.track_page(None, 'length')
+        lengths = [ track.length if track.length is not None else -1
+                    for track in tracks ]
+        self.assertEqual(lengths, sorted(lengths))
+        for a, b in zip(tracks, tracks[1:]):
+            if a.length == b.length:
+                self.assertTrue(a.id < b.id)
+
+    def test_matching_tracks_only(self):
+        fields = [ u'artist=Artist 1' ]
+        matching = sorted(track.id for track in self.lib.tracks(fields))
+        self.assertEqual(sorted(self.pages('date', 3, fields)), matching)
+
+    def test_unknown_after(self):
+        self.assertRaises(ValueError, self.lib.track_page, None, 'artist', 5, 999)
+        self.assertRaises(ValueError, self.lib.track_page, None, 'nope')
+
+if __name__ == '__main__':
+    unittest.main()
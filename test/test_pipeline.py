@@ -0,0 +1,59 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+
+"""Process stages fork their workers when asked to, and the pipeline
+runs on them.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import multiprocessing.pool
+import unittest
+
+from musicdir.util import pipeline
+
+def _double(n):
+    return n * 2
+
+def _produce(out):
+    for n in range(20):
+        yield n
+
+def _consume(out):
+    while True:
+        out.append((yield))
+
+class ProcessStageTest(unittest.TestCase):
+    def run_on(self, stage, run):
+        out = []
+        run(pipeline.Pipeline([ _produce(out), stage, _consume(out) ]))
+        return out
+
+    def test_started_pool_is_used_and_shut_down(self):
+        stage = pipeline.ProcessStage(_double, processes=2, chunksize=3)
+        pool = stage.start().pool
+        self.assertTrue(stage.start().pool is pool)
+        out = self.run_on(stage, lambda pl: pl.run_parallel())
+        self.assertEqual(out, [ n * 2 for n in range(20) ])
+        self.assertEqual(stage.pool, None)
+        self.assertNotEqual(pool._state, multiprocessing.pool.RUN)
+
+    def test_unstarted_stage_forks_when_run(self):
+        stage = pipeline.ProcessStage(_double, processes=2)
+        out = self.run_on(stage, lambda pl: pl.run_async())
+        self.assertEqual(sorted(out), [ n * 2 for n in range(20) ])
+        self.assertEqual(stage.pool, None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+
+"""Playlists of the tracks matching a query, in each format and order.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import unittest
+from StringIO import StringIO
+
+import _common
+from musicdir import playlist
+from musicdir.library import File, TrackFile
+
+class PlaylistTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(PlaylistTest, self).setUp()
+        for artist, release, n, title, length in (
+                (u'B\xe9la', u'Second', 1, u'Caf\xe9', 61.4),
+                (u'Abba', u'First', 2, u'Two', 120),
+                (u'Abba', u'First', 1, u'One', None),
+                (u'Abba', u'Other', 1, u'Alone', 30)):
+            track = self.track(title, artist, release, track=n, length=length)
+            path = '/music/%s.mp3' % title.encode('utf8')
+            self.lib.add(TrackFile(track=track, file=File(path=path)))
+        # a track without a file has no entry
+        self.track(u'Missing', u'Abba', u'First', track=3)
+        self.commit()
+
+    def write(self, format, fields=None, order='artist', seed=None):
+        out = StringIO()
+        count = playlist.write(self.lib, out, fields, format, order, seed)
+        return count, out.getvalue()
+
+    def titles(self, order, fields=None, seed=None):
+        return [ title for path, length, artist, title
+                 in playlist.entries(self.lib, fields, order, seed) ]
+
+    def test_m3u(self):
+        count, text = self.write('m3u', [ u'artist=B\xe9la' ])
+        self.assertEqual(count, 1)
+        self.assertEqual(text, '#EXTM3U\n#EXTINF:61,B\xe9la - Caf\xe9\n'
+                               '/music/Caf\xc3\xa9.mp3\n')
+
+    def test_m3u8(self):
+        count, text = self.write('m3u8', [ u'title=One' ])
+        self.assertEqual(text, '#EXTM3U\n#EXTINF:-1,Abba - One\n/music/One.mp3\n')
+        count, text = self.write('m3u8', [ u'artist=B\xe9la' ])
+        self.assertTrue('B\xc3\xa9la - Caf\xc3\xa9' in text)
+
+    def test_pls(self):
+        count, text = self.write('pls', [ u'artist=Abba' ], 'album')
+        self.assertEqual(count, 3)
+        self.assertEqual(text.splitlines(), [
+            '[playlist]',
+            'File1=/music/One.mp3', 'Title1=Abba - One', 'Length1=-1',
+            'File2=/music/Two.mp3', 'Title2=Abba - Two', 'Length2=120',
+            'File3=/music/Alone.mp3', 'Title3=Abba - Alone', 'Length3=30',
+            'NumberOfEntries=3', 'Version=2' ])
+
+    def test_orders(self):
+        self.assertEqual(self.titles('artist'),
+                         [ u'One', u'Two', u'Alone', u'Caf\xe9' ])
+        self.assertEqual(self.titles('album'),
+                         [ u'One', u'Two', u'Alone', u'Caf\xe9' ])
+        self.assertEqual(self.titles('track'),
+                         [ u'Alone', u'Caf\xe9', u'One', u'Two' ])
+
+    def test_shuffles_are_seeded(self):
+        shuffled = self.titles('random', seed=1)
+        self.assertEqual(sorted(shuffled), [ u'Alone', u'Caf\xe9', u'One', u'Two' ])
+        self.assertEqual(self.titles('random', seed=1), shuffled)
+
+    def test_shuffled_albums_stay_together(self):
+        for seed in range(5):
+            titles = self.titles('shuffle-album', seed=seed)
+            first = titles.index(u'One')
+            self.assertEqual(titles[first + 1], u'Two')
+
+    def test_errors(self):
+        self.assertRaises(playlist.PlaylistError, self.write, 'xspf')
+        self.assertRaises(playlist.PlaylistError, self.titles, 'backwards')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""get_filter's date and range fields."""
+import datetime
+import unittest
+
+import _common
+from musicdir.library import parse_range, date_span, number_span, \
+        File, TrackFile
+
+class ParseRangeTest(unittest.TestCase):
+    def test_one_value(self):
+        self.assertEqual(parse_range('1999', date_span),
+                         (datetime.date(1999, 1, 1), datetime.date(2000, 1, 1)))
+        self.assertEqual(parse_range('1999-12', date_span),
+                         (datetime.date(1999, 12, 1), datetime.date(2000, 1, 1)))
+        self.assertEqual(parse_range('120', number_span), (120, 121))
+
+    def test_ranges_and_bounds(self):
+        self.assertEqual(parse_range('1990..1999', date_span),
+                         (datetime.date(1990, 1, 1), datetime.date(2000, 1, 1)))
+        self.assertEqual(parse_range('..1999', date_span),
+                         (None, datetime.date(2000, 1, 1)))
+        self.assertEqual(parse_range('>1999', date_span),
+                         (datetime.date(2000, 1, 1), None))
+        self.assertEqual(parse_range('<=5', number_span), (None, 6))
+        self.assertEqual(parse_range('>=5', number_span), (5, None))
+
+    def test_unparsed(self):
+        for text in ('..', 'abc', '1999-02-30', '19', '1..x'):
+            self.assertEqual(parse_range(text, date_span), None)
+
+class DateFieldTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(DateFieldTest, self).setUp()
+        self.track(u'Old', release=u'Eighties', date=datetime.date(1985, 6, 1))
+        self.track(u'Early', release=u'Nineties', date=datetime.date(1991, 3, 2))
+        self.track(u'Late', release=u'Nineties', date=datetime.date(1999, 12, 31))
+        self.track(u'New', release=u'Now', date=datetime.date(2010, 6, 15))
+        self.track(u'Undated', release=u'Now')
+        self.commit()
+
+    def releases(self, fields):
+        return sorted(r.name for r in self.lib.releases(fields))
+
+    def test_year(self):
+        self.assertEqual(self.titles([ u'year=1999' ]), [ u'Late' ])
+        self.assertEqual(self.titles([ u'year:1990..1999' ]), [ u'Early', u'Late' ])
+        self.assertEqual(self.titles([ u'year:>1999' ]), [ u'New' ])
+
+    def test_date(self):
+        self.assertEqual(self.titles([ u'date:1991-03' ]), [ u'Early' ])
+        self.assertEqual(self.titles([ u'date=1999-12-31' ]), [ u'Late' ])
+        self.assertEqual(self.titles([ u'date:1991-03-03..' ]),
+                         [ u'Late', u'New' ])
+
+    def test_month_and_day(self):
+        self.assertEqual(self.titles([ u'month=6' ]), [ u'New', u'Old' ])
+        self.assertEqual(self.titles([ u'month:3..6', u'day=2' ]), [ u'Early' ])
+
+    def test_years_or_together(self):
+        self.assertEqual(self.titles([ u'year=1985', u'year=2010' ]),
+                         [ u'New', u'Old' ])
+
+    def test_releases_by_their_tracks(self):
+        self.assertEqual(self.releases([ u'year:1990..1999' ]), [ u'Nineties' ])
+        self.assertEqual(self.releases([ u'year=1999' ]), [ u'Nineties' ])
+        self.assertEqual(self.releases([ u'month=6' ]), [ u'Eighties', u'Now' ])
+        self.assertEqual(self.releases([ u'year:<1980' ]), [ ])
+
+    def test_artists_by_their_tracks(self):
+        self.assertEqual([ a.name for a in self.lib.artists([ u'year=2010' ]) ],
+                         [ u'Artist' ])
+        self.assertEqual(self.lib.artists([ u'year=2000' ]), [ ])
+
+class RangeFieldTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(RangeFieldTest, self).setUp()
+        # added and bitrate are copied from the files by update_keys
+        for title, length, bpm, bitrate, size, added in (
+                (u'Short', 120, 90, 96000, 2000000, (2026, 9, 1, 12)),
+                (u'Medium', 240, 120, 128000, 4000000, (2026, 10, 1, 0)),
+                (u'Long', 600, 174, 320000, 20000000, (2026, 10, 1, 23)),
+                (u'Bare', None, None, None, None, None)):
+            track = self.track(title, length=length, bpm=bpm)
+            if size is not None:
+                file = File(path='/music/%s.mp3' % title, size=size,
+                            dateadded=datetime.datetime(*added))
+                self.lib.add(TrackFile(track=track, file=file, bitrate=bitrate))
+        self.commit()
+
+    def test_numbers(self):
+        self.assertEqual(self.titles([ u'length:200..600' ]),
+                         [ u'Long', u'Medium' ])
+        self.assertEqual(self.titles([ u'bpm=120' ]), [ u'Medium' ])
+        self.assertEqual(self.titles([ u'bpm:>=120' ]), [ u'Long', u'Medium' ])
+        self.assertEqual(self.titles([ u'bitrate:<128000' ]), [ u'Short' ])
+
+    def test_sizes_through_files(self):
+        self.assertEqual(self.titles([ u'size:>3000000' ]), [ u'Long', u'Medium' ])
+        self.assertEqual(self.titles([ u'size:..2000000' ]), [ u'Short' ])
+
+    def test_added_by_day(self):
+        self.assertEqual(self.titles([ u'added=2026-10-01' ]),
+                         [ u'Long', u'Medium' ])
+        self.assertEqual(self.titles([ u'added:<2026-10' ]), [ u'Short' ])
+
+    def test_fields_and_together(self):
+        self.assertEqual(self.titles([ u'bpm:>100', u'length:<300' ]),
+                         [ u'Medium' ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+
+"""Cached query results are used until the library changes, in memory
+and on disk.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import os
+import unittest
+
+import _common
+from musicdir import modify
+from musicdir.querycache import QueryCache, normalize
+
+class NormalizeTest(unittest.TestCase):
+    def test_order_and_repetition(self):
+        self.assertEqual(normalize('tracks', [ u'b', u' a', u'b', u'' ]),
+                         normalize('tracks', [ u'a', u'b' ]))
+        self.assertEqual(normalize('tracks', None), normalize('tracks', [ ]))
+        self.assertNotEqual(normalize('tracks', [ u'a' ]),
+                            normalize('releases', [ u'a' ]))
+
+class LibraryCacheTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(LibraryCacheTest, self).setUp()
+        self.cachedir = os.path.join(self.dir, 'queries')
+        self.lib.query_cache = QueryCache(directory=self.cachedir)
+        self.track(u'One', track=1)
+        self.track(u'Two', track=2)
+        self.commit()
+
+    def stats(self):
+        return self.lib.query_cache.stats
+
+    def test_hits_until_the_generation_moves(self):
+        self.assertEqual(self.titles([ u'artist=Artist' ]), [ u'One', u'Two' ])
+        self.assertEqual(self.titles([ u'artist=Artist' ]), [ u'One', u'Two' ])
+        self.assertEqual(self.stats()['hits'], 1)
+        self.track(u'Three')
+        self.commit(edited=False)
+        self.assertEqual(self.titles([ u'artist=Artist' ]),
+                         [ u'One', u'Three', u'Two' ])
+        self.assertEqual(self.stats()['invalidations'], 1)
+
+    def test_edits_invalidate(self):
+        self.assertEqual(self.titles([ u'title:one' ]), [ u'One' ])
+        changes, current, unknown = modify.plan(self.lib, { 1: { 'title': u'Uno' } })
+        modify.apply(self.lib, changes, current)
+        self.lib.session.commit()
+        self.assertEqual(self.titles([ u'title:one' ]), [ ])
+        self.assertEqual(self.titles([ u'title:uno' ]), [ u'Uno' ])
+
+    def test_entries_on_disk(self):
+        self.lib.track_ids([ u'title=Two' ])
+        # a new process finds the entry on disk
+        self.lib.query_cache = QueryCache(directory=self.cachedir)
+        self.assertEqual(self.lib.track_ids([ u'title=Two' ]), [ 2 ])
+        self.assertEqual(self.stats()['disk_hits'], 1)
+        # and drops it once the library has changed
+        self.commit()
+        self.lib.query_cache = QueryCache(directory=self.cachedir)
+        self.assertEqual(self.lib.track_ids([ u'title=Two' ]), [ 2 ])
+        self.assertEqual(self.stats()['disk_hits'], 0)
+        self.assertEqual(self.stats()['misses'], 1)
+
+    def test_size_limit(self):
+        self.lib.query_cache = QueryCache(size=3)
+        self.lib.track_ids([ u'title=One' ])
+        self.lib.track_ids([ ])
+        self.lib.track_ids([ u'title=Two' ])
+        self.assertEqual(self.stats()['evictions'], 1)
+        self.lib.track_ids([ ])
+        self.assertEqual(self.stats()['hits'], 1)
+        self.lib.track_ids([ u'title=One' ])
+        self.assertEqual(self.stats()['misses'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
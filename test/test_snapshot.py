@@ -0,0 +1,94 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+"""The catalog snapshot follows edits to the library, not only the
+tracks added to it.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from musicdir.library import Library, Artist, Release, Track, Session
+from musicdir import modify, snapshot
+
+class SnapshotEditTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='musicdir-test-')
+        Session.remove()
+        self.lib = Library('sqlite:///' + os.path.join(self.dir, 'musicdir.db'))
+        artist = Artist(name=u'Artist 0000')
+        release = Release(name=u'Release 0000-00', artist=artist)
+        for n in range(1, 4):
+            self.lib.add(Track(artist=artist, release=release,
+                               title=u'Track %02i' % n, track=n))
+        self.lib.update_keys()
+        self.lib.bump_generation()
+        self.lib.session.commit()
+        self.path = os.path.join(self.dir, 'catalog')
+
+    def tearDown(self):
+        Session.remove()
+        shutil.rmtree(self.dir)
+
+    def titles(self, *fields):
+        snap = snapshot.update(self.lib, self.path)
+        try:
+            return [ snap.value('title', i)
+                     for i in snap.find(snapshot.parse(list(fields))) ]
+        finally:
+            snap.close()
+
+    def edit(self, edits):
+        changes, current, unknown = modify.plan(self.lib, edits)
+        modify.apply(self.lib, changes, current)
+        self.lib.session.commit()
+
+    def test_title_edit_of_same_length(self):
+        self.assertEqual(self.titles(u'title:01'), [ u'Track 01' ])
+        self.edit({ 1: { 'title': u'Track XX' } })
+        self.assertEqual(self.titles(u'title:XX'), [ u'Track XX' ])
+        self.assertEqual(self.titles(u'title:01'), [ ])
+        self.assertEqual(self.titles(u'artist=Artist 0000'),
+                         [ u'Track XX', u'Track 02', u'Track 03' ])
+
+    def test_artist_change(self):
+        self.titles(u'artist=Artist 0000')
+        self.edit({ 2: { 'artist': u'Other Artist' } })
+        self.assertEqual(self.titles(u'artist=Other Artist'), [ u'Track 02' ])
+        self.assertEqual(self.titles(u'artist=Artist 0000'),
+                         [ u'Track 01', u'Track 03' ])
+
+    def test_added_tracks_are_appended(self):
+        self.titles()
+        artist = self.lib.session.query(Artist).first()
+        self.lib.add(Track(artist=artist, title=u'Track 04', track=4))
+        self.lib.update_keys()
+        self.lib.bump_generation(edited=False)
+        self.lib.session.commit()
+        self.assertEqual(self.titles(u'title:04'), [ u'Track 04' ])
+
+    def test_substrings_in_place(self):
+        self.assertEqual(self.titles(u'title:ack 0'),
+                         [ u'Track 01', u'Track 02', u'Track 03' ])
+        self.assertEqual(self.titles(u'title:TRACK 02'), [ u'Track 02' ])
+        # the keys are stored end to end: no match across two of them
+        self.assertEqual(self.titles(u'title:01track'), [ ])
+        self.assertEqual(self.titles(u'artist:0000', u'title:3'),
+                         [ u'Track 03' ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+
+"""Tag queries answered from the posting lists of the tag index.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import array
+import unittest
+
+import _common
+from musicdir import tagindex
+from musicdir.library import Tag, TrackTag
+
+def ids(*values):
+    return array.array('l', values)
+
+class PostingListTest(unittest.TestCase):
+    def test_intersect(self):
+        self.assertEqual(tagindex.intersect(ids(1, 3, 5, 7), ids(2, 3, 7, 9)),
+                         ids(3, 7))
+        self.assertEqual(tagindex.intersect(ids(), ids(1, 2)), ids())
+
+    def test_intersect_gallops_through_long_lists(self):
+        large = array.array('l', range(0, 1000, 3))
+        small = ids(0, 4, 9, 500, 501, 999, 2000)
+        self.assertTrue(len(large) > tagindex.GALLOP_RATIO * len(small))
+        self.assertEqual(tagindex.intersect(small, large), ids(0, 9, 501, 999))
+        self.assertEqual(tagindex.intersect(large, small), ids(0, 9, 501, 999))
+
+    def test_union_and_difference(self):
+        self.assertEqual(tagindex.union(ids(1, 4), ids(2, 4, 6)), ids(1, 2, 4, 6))
+        self.assertEqual(tagindex.difference(ids(1, 2, 4, 6), ids(2, 3, 6)),
+                         ids(1, 4))
+
+class TagQueryTest(_common.LibraryTestCase):
+    def setUp(self):
+        super(TagQueryTest, self).setUp()
+        self.tags = { }
+        for title, names in ((u'One', u'rock live'), (u'Two', u'rock'),
+                             (u'Three', u'jazz live'), (u'Four', u'')):
+            track = self.track(title)
+            for name in names.split():
+                self.tag(track, name)
+        self.commit()
+
+    def tag(self, track, name, weight=1):
+        if name not in self.tags:
+            self.tags[name] = Tag(name=name)
+        tagging = TrackTag()
+        tagging.tag, tagging.weight = self.tags[name], weight
+        track.tags.append(tagging)
+        return tagging
+
+    def test_intersections(self):
+        self.assertEqual(self.titles([ u'+rock' ]), [ u'One', u'Two' ])
+        self.assertEqual(self.titles([ u'+rock', u'+live' ]), [ u'One' ])
+        self.assertEqual(self.titles([ u'+rock|jazz', u'+live' ]),
+                         [ u'One', u'Three' ])
+        self.assertEqual(self.titles([ u'+live', u'^jazz' ]), [ u'One' ])
+        self.assertEqual(self.titles([ u'^rock' ]), [ u'Four', u'Three' ])
+        self.assertEqual(self.titles([ u'+rock', u'+jazz' ]), [ ])
+
+    def test_reloads_when_the_generation_moves(self):
+        self.assertEqual(self.titles([ u'+jazz' ]), [ u'Three' ])
+        four = list(self.lib.tracks([ u'title=Four' ]))[0]
+        self.tag(four, u'jazz')
+        self.lib.session.commit()
+        # not seen until the writer moves the generation
+        self.assertEqual(self.titles([ u'+jazz' ]), [ u'Three' ])
+        self.lib.bump_generation()
+        self.lib.session.commit()
+        self.assertEqual(self.titles([ u'+jazz' ]), [ u'Four', u'Three' ])
+
+if __name__ == '__main__':
+    unittest.main()
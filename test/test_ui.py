@@ -0,0 +1,53 @@
+# This file is part of musicdir.
+# Copyright 2011, coolkehon
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+
+
+"""What the command line runs here and what it leaves to the daemon.
+
+    $ PYTHONPATH=src python -m unittest discover -s test
+"""
+import os
+import unittest
+import ConfigParser
+
+from musicdir import ui
+
+class ForwardTest(unittest.TestCase):
+    def setUp(self):
+        # a socket path that exists: anything run here is not forwarded
+        self.config = ConfigParser.SafeConfigParser()
+        self.config.add_section('musicdir')
+        self.config.set('musicdir', 'socket', os.path.abspath(__file__))
+        self.saved = os.environ.pop(ui.NO_DAEMON_VAR, None)
+
+    def tearDown(self):
+        if self.saved is not None:
+            os.environ[ui.NO_DAEMON_VAR] = self.saved
+
+    def test_profiled_runs_are_not_forwarded(self):
+        self.assertEqual(ui.forward(None, self.config,
+                                    [ '--profile-startup', 'ls' ]), None)
+
+    def test_profile_startup_is_a_root_option(self):
+        options, rest = ui.parse_root([ '--profile-startup', 'ls' ])
+        self.assertTrue(options.profile_startup)
+        options, rest = ui.parse_root([ 'ls', '--profile-startup' ])
+        self.assertFalse(options.profile_startup)
+        self.assertEqual(rest, [ 'ls', '--profile-startup' ])
+
+    def test_unparsable_root_options_are_left_to_the_parser(self):
+        self.assertEqual(ui.parse_root([ '--no-such-option', 'ls' ]), None)
+
+if __name__ == '__main__':
+    unittest.main()